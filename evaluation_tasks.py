@@ -18,6 +18,8 @@ from rblur.fixation_prediction.models import RetinaFilterWithFixationPrediction,
 from rblur.retina_preproc import AbstractRetinaFilter, GaussianNoiseLayer, VOneBlock
 from rblur.models import GeneralClassifier, LogitAverageEnsembler, XResNet34, IdentityLayer, CommonModelParams, MultiheadSelfAttentionEnsembler
 from rblur.fixation_prediction.fixation_aware_attack import FixationAwareAPGDAttack
+from rblur.warm_start_attacks import WarmStartAPGDAttack, WarmStartPGDAttack
+from rblur.stacked_attacks import StackedEpsilonAPGDAttack
 from mllib.param import BaseParameters
 import numpy as np
 
@@ -321,6 +323,70 @@ def get_precomputed_fixation_apgd_l2_25s_atk(eps):
     atk_p._cls = PrecomputedFixationAPGDAttack
     return atk_p
 
+# The warm-started attacks start from the adversarial examples found with the previous
+# epsilon if epsilon ladder pruning is enabled, and are identical to the regular attacks
+# otherwise.
+def get_warm_start_apgd_atk(eps):
+    atk_p = get_apgd_atk(eps)
+    atk_p._cls = WarmStartAPGDAttack
+    return atk_p
+
+def get_warm_start_apgd_25s_atk(eps):
+    atk_p = get_apgd_25s_atk(eps)
+    atk_p._cls = WarmStartAPGDAttack
+    return atk_p
+
+def get_warm_start_apgd_10s_atk(eps):
+    atk_p = get_apgd_10s_atk(eps)
+    atk_p._cls = WarmStartAPGDAttack
+    return atk_p
+
+def get_warm_start_apgd_l2_atk(eps):
+    atk_p = get_apgd_l2_atk(eps)
+    atk_p._cls = WarmStartAPGDAttack
+    return atk_p
+
+def get_warm_start_apgd_l2_25s_atk(eps):
+    atk_p = get_apgd_l2_25s_atk(eps)
+    atk_p._cls = WarmStartAPGDAttack
+    return atk_p
+
+def get_warm_start_pgd_atk(eps):
+    atk_p = get_pgd_atk(eps)
+    atk_p._cls = WarmStartPGDAttack
+    return atk_p
+
+def get_warm_start_pgd_25s_atk(eps):
+    atk_p = get_pgd_25s_atk(eps)
+    atk_p._cls = WarmStartPGDAttack
+    return atk_p
+
+# All the epsilons of the stacked attacks are run in a single batch
+def get_stacked_apgd_atk(eps):
+    atk_p = get_apgd_atk(eps)
+    atk_p._cls = StackedEpsilonAPGDAttack
+    return atk_p
+
+def get_stacked_apgd_25s_atk(eps):
+    atk_p = get_apgd_25s_atk(eps)
+    atk_p._cls = StackedEpsilonAPGDAttack
+    return atk_p
+
+def get_stacked_apgd_10s_atk(eps):
+    atk_p = get_apgd_10s_atk(eps)
+    atk_p._cls = StackedEpsilonAPGDAttack
+    return atk_p
+
+def get_stacked_apgd_l2_atk(eps):
+    atk_p = get_apgd_l2_atk(eps)
+    atk_p._cls = StackedEpsilonAPGDAttack
+    return atk_p
+
+def get_stacked_apgd_l2_25s_atk(eps):
+    atk_p = get_apgd_l2_25s_atk(eps)
+    atk_p._cls = StackedEpsilonAPGDAttack
+    return atk_p
+
 def get_adv_attack_params(atk_types):
     atktype_to_paramfn = {
         SupportedAttacks.PGDLINF: get_pgd_atk,
@@ -591,7 +657,8 @@ def get_adversarial_battery_task(task_cls, num_test, batch_size, atk_param_fns,
                                 add_fixed_noise_patch=False, use_common_corruption_testset=False, disable_reconstruction=False, use_residual_img=False,
                                 fixate_in_bbox=False, enable_random_noise=False, apply_rand_affine_augments=False, num_affine_augments=5, fixate_on_max_loc=False,
                                 clickme_data=False, use_precomputed_fixations=False, num_fixations=1, precompute_fixation_map=False, add_fixation_predictor=False,
-                                retina_after_fixation=False, fixation_prediction_model='deepgazeII', straight_through_retina=False):
+                                retina_after_fixation=False, fixation_prediction_model='deepgazeII', straight_through_retina=False,
+                                epsilon_ladder_pruning='off', attack_cascade=False, checkpoint_battery=True):
     class AdversarialAttackBatteryEvalTask(task_cls):
         _cls = task_cls
         def __init__(self) -> None:
@@ -699,6 +766,9 @@ def get_adversarial_battery_task(task_cls, num_test, batch_size, atk_param_fns,
             p.batch_size = batch_size
             adv_config = p.trainer_params.adversarial_params
             adv_config.training_attack_params = None
+            adv_config.epsilon_ladder_pruning = epsilon_ladder_pruning
+            adv_config.attack_cascade = attack_cascade
+            adv_config.checkpoint_battery = checkpoint_battery
             atk_params = []
             for name, atkfn in atk_param_fns.items():
                 if apply_rand_affine_augments:
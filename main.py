@@ -70,6 +70,18 @@ attacks =  {
             'AutoAttackLinf': eval.get_autoattack_linf_atk,
             'AutoAttackL2': eval.get_autoattack_l2_atk,
             'TAAutoAttackLinf': eval.get_torchattack_autoattack_linf_atk,
+            'WS-APGD': eval.get_warm_start_apgd_atk,
+            'WS-APGD_25': eval.get_warm_start_apgd_25s_atk,
+            'WS-APGD_10': eval.get_warm_start_apgd_10s_atk,
+            'WS-APGDL2': eval.get_warm_start_apgd_l2_atk,
+            'WS-APGDL2_25': eval.get_warm_start_apgd_l2_25s_atk,
+            'WS-PGD': eval.get_warm_start_pgd_atk,
+            'WS-PGD_25': eval.get_warm_start_pgd_25s_atk,
+            'S-APGD': eval.get_stacked_apgd_atk,
+            'S-APGD_25': eval.get_stacked_apgd_25s_atk,
+            'S-APGD_10': eval.get_stacked_apgd_10s_atk,
+            'S-APGDL2': eval.get_stacked_apgd_l2_atk,
+            'S-APGDL2_25': eval.get_stacked_apgd_l2_25s_atk,
         }
 
 if __name__ == '__main__':
@@ -106,6 +118,25 @@ if __name__ == '__main__':
                         help='Adversarial attacks to run.')
     parser.add_argument('--eps_list', nargs='+', type=float, default=[0.],
                         help='List of perturbation sizes to run attacks with. The size metric is defined by the attack.')
+    parser.add_argument('--epsilon_ladder_pruning', type=str, default='off', choices=['off', 'monotone', 'exact'],
+                        help='''
+                        Run the attacks in `--attacks` in increasing order of epsilon and do not attack samples
+                        that are already misclassified at a smaller epsilon. In the `exact` mode the adversarial
+                        examples reused from the smaller epsilon are re-evaluated and the samples that are no longer
+                        misclassified are attacked. The WS-* attacks are warm-started from the adversarial
+                        examples found with the previous epsilon.
+                        ''')
+    parser.add_argument('--attack_cascade', action='store_true',
+                        help='''
+                        For each epsilon, run the attacks in the order given in `--attacks`, from the cheapest
+                        to the most expensive, and only on the samples that the previous attacks did not break.
+                        The per-stage and cumulative robust accuracy and time are written to attack_cascade_stats.json.
+                        ''')
+    parser.add_argument('--disable_battery_checkpoints', action='store_true',
+                        help='''
+                        Do not checkpoint the results of the attack battery after every batch. By default an
+                        interrupted battery resumes from the last completed (attack, batch) pair when it is rerun.
+                        ''')
     # Randomized smoothing settings
     parser.add_argument('--run_randomized_smoothing_eval', action='store_true',
                         help='''
@@ -205,7 +236,7 @@ if __name__ == '__main__':
     runner_kwargs={}
     if args.run_adv_attack_battery:
         task = eval.get_adversarial_battery_task(task_cls, args.num_test, args.batch_size, 
-                                                   {k:v for k,v in attacks.items() if k in args.attacks},
+                                                   {k:attacks[k] for k in args.attacks} if args.attack_cascade else {k:v for k,v in attacks.items() if k in args.attacks},
                                                     args.eps_list, center_fixation=args.center_fixation,
                                                     five_fixation_ensemble=args.five_fixations, 
                                                     hscan_fixation_ensemble=args.hscan_fixations,
@@ -225,6 +256,9 @@ if __name__ == '__main__':
                                                     fixation_prediction_model=args.fixation_prediction_model,
                                                     retina_after_fixation=args.retina_after_fixation,
                                                     straight_through_retina=args.straight_through_retina,
+                                                    epsilon_ladder_pruning=args.epsilon_ladder_pruning,
+                                                    attack_cascade=args.attack_cascade,
+                                                    checkpoint_battery=(not args.disable_battery_checkpoints),
                                                     )()
         runner_cls = AdversarialAttackBatteryRunner
         runner_kwargs = {
@@ -0,0 +1,182 @@
+'''
+Microbenchmarks for the retina and front-end layers. For every combination of layer,
+image size, batch size, dtype, number of threads and fixation mode, the forward pass
+(under no_grad) and the backward pass w.r.t. the input are timed separately. The
+results are written as one JSON record per line so that runs can be compared. Every
+configuration is run in a fresh process, so that the peak RSS reported for it is its
+own, e.g.
+
+    python -m rblur.benchmark_frontend --layers rblur rblur2 --image_sizes 32 224 --output bench.jsonl
+'''
+from argparse import ArgumentParser
+from itertools import product
+from time import perf_counter
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import traceback
+import numpy as np
+import torch
+from rblur.retina_preproc import (
+    RetinaBlurFilter, RetinDoGBlurFilter, RetinaSampleFilter, RetinaNonUniformPatchEmbedding,
+    RetinaWarp, VOneBlock, GaussianNoiseLayer, GaussianBlurLayer)
+from rblur.retina_blur2 import RetinaBlurFilter as RBlur2
+
+def _rblur_params(input_shape, loc_mode):
+    return RetinaBlurFilter.ModelParams(RetinaBlurFilter, input_shape, cone_std=0.12, rod_std=0.09, max_rod_density=0.12, loc_mode=loc_mode)
+
+def _rblur2_params(input_shape, loc_mode):
+    return RBlur2.ModelParams(RBlur2, input_shape, cone_std=0.12, rod_std=0.09, max_rod_density=0.12, loc_mode=loc_mode)
+
+def _dog_params(input_shape, loc_mode):
+    return RetinDoGBlurFilter.ModelParams(RetinDoGBlurFilter, input_shape, cone_std=0.12, rod_std=0.09, max_rod_density=0.12, loc_mode=loc_mode)
+
+def _sampler_params(input_shape, loc_mode):
+    return RetinaSampleFilter.ModelParams(RetinaSampleFilter, input_shape, 0.12, 0.09, 0.12, 9, loc_mode=loc_mode)
+
+def _patch_embedding_params(input_shape, loc_mode):
+    return RetinaNonUniformPatchEmbedding.ModelParams(RetinaNonUniformPatchEmbedding, input_shape=input_shape, hidden_size=64, loc_mode=loc_mode)
+
+def _warp_params(input_shape, loc_mode):
+    return RetinaWarp.ModelParams(RetinaWarp, input_shape, loc_mode=loc_mode)
+
+def _vone_params(input_shape, loc_mode):
+    return VOneBlock.ModelParams(VOneBlock, image_size=input_shape[1])
+
+def _gnoise_params(input_shape, loc_mode):
+    return GaussianNoiseLayer.ModelParams(GaussianNoiseLayer, std=0.25, max_input_size=input_shape, add_noise_during_inference=True)
+
+def _gblur_params(input_shape, loc_mode):
+    return GaussianBlurLayer.ModelParams(GaussianBlurLayer, std=1.5)
+
+# name -> (params factory, supported fixation modes). Layers without fixations have
+# a single mode, None.
+LAYERS = {
+    'rblur': (_rblur_params, ['center', 'random_uniform', 'five_fixations']),
+    'rblur2': (_rblur2_params, ['center', 'random_uniform', 'five_fixations']),
+    'dog_rblur': (_dog_params, ['center', 'random_uniform', 'five_fixations']),
+    'retina_sampler': (_sampler_params, ['center', 'random_uniform']),
+    'nonuniform_patch_embedding': (_patch_embedding_params, ['center', 'random_uniform']),
+    'retina_warp': (_warp_params, ['center', 'random_uniform', 'five_fixations']),
+    'voneblock': (_vone_params, [None]),
+    'gaussian_noise': (_gnoise_params, [None]),
+    'gaussian_blur': (_gblur_params, [None]),
+}
+
+def _peak_rss_mb():
+    # peak RSS of the process so far, which is only the peak of a configuration if it
+    # is run in its own process (see run_in_subprocess).
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024**2 if platform.system() == 'Darwin' else 1024)
+
+def _time_fn(fn, nreps, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(nreps):
+        t0 = perf_counter()
+        fn()
+        times.append(perf_counter() - t0)
+    return np.array(times)
+
+def _summarize(times, batch_size):
+    return {
+        'images_per_sec': batch_size / times.mean(),
+        'mean_ms': times.mean() * 1000,
+        'p50_ms': np.percentile(times, 50) * 1000,
+        'p99_ms': np.percentile(times, 99) * 1000,
+    }
+
+def benchmark_layer(name, image_size, batch_size, dtype, nthreads, loc_mode, nreps=20, warmup=3, device='cpu', backward=True):
+    torch.set_num_threads(nthreads)
+    input_shape = [3, image_size, image_size]
+    params_fn = LAYERS[name][0]
+    record = {
+        'layer': name, 'image_size': image_size, 'batch_size': batch_size, 'dtype': str(dtype).replace('torch.', ''),
+        'num_threads': nthreads, 'loc_mode': loc_mode, 'device': device,
+    }
+    if device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats(device)
+    try:
+        params = params_fn(input_shape, loc_mode)
+        model = params.cls(params).to(device=device, dtype=dtype).eval()
+        x = torch.rand(batch_size, *input_shape, device=device, dtype=dtype)
+        def sync():
+            if x.is_cuda:
+                torch.cuda.synchronize()
+        def fwd():
+            with torch.no_grad():
+                model(x)
+            sync()
+        record['forward'] = _summarize(_time_fn(fwd, nreps, warmup), batch_size)
+        if backward:
+            xg = x.clone().requires_grad_(True)
+            # the forward pass is recomputed for every backward pass but only the
+            # backward pass is timed.
+            bwd_times = []
+            for i in range(warmup + nreps):
+                out = model(xg)
+                loss = out.float().sum()
+                sync()
+                t0 = perf_counter()
+                loss.backward()
+                sync()
+                if i >= warmup:
+                    bwd_times.append(perf_counter() - t0)
+                xg.grad = None
+            record['backward'] = _summarize(np.array(bwd_times), batch_size)
+        record['peak_rss_mb'] = _peak_rss_mb()
+        if device.startswith('cuda'):
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated(device) / 1024**2
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        traceback.print_exc()
+    return record
+
+def run_in_subprocess(*args, **kwargs):
+    # runs benchmark_layer in a new process, which exits afterwards, so that the peak
+    # RSS does not include the memory used by previous configurations.
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(benchmark_layer, args, kwargs)
+
+def get_environment_info():
+    return {
+        'torch_version': torch.__version__,
+        'numpy_version': np.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--layers', type=str, nargs='+', default=list(LAYERS.keys()), choices=list(LAYERS.keys()))
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[32, 64, 224, 320])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['float32'], choices=['float32', 'float64', 'bfloat16', 'float16'])
+    parser.add_argument('--num_threads', type=int, nargs='+', default=[1, torch.get_num_threads()])
+    parser.add_argument('--loc_modes', type=str, nargs='+', default=None, help='fixation modes to benchmark, all the modes supported by a layer if not set')
+    parser.add_argument('--nreps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--no_backward', action='store_true')
+    parser.add_argument('--in_process', action='store_true', help='run all the configurations in this process, peak_rss_mb is then the peak so far')
+    parser.add_argument('--output', type=str, default='frontend_benchmark.jsonl')
+    args = parser.parse_args()
+
+    env = get_environment_info()
+    with open(args.output, 'a') as f:
+        for name in args.layers:
+            loc_modes = [m for m in LAYERS[name][1] if (args.loc_modes is None) or (m is None) or (m in args.loc_modes)]
+            for image_size, batch_size, dtype, nthreads, loc_mode in product(args.image_sizes, args.batch_sizes, args.dtypes, args.num_threads, loc_modes):
+                run = benchmark_layer if args.in_process else run_in_subprocess
+                record = run(name, image_size, batch_size, getattr(torch, dtype), nthreads, loc_mode,
+                             nreps=args.nreps, warmup=args.warmup, device=args.device, backward=not args.no_backward)
+                record['env'] = env
+                print({k: v for k, v in record.items() if k != 'env'})
+                f.write(json.dumps(record) + '\n')
+                f.flush()
@@ -0,0 +1,189 @@
+from time import time
+import numpy as np
+import torch
+from torch import nn
+
+# Gaussian blur implementations. Every backend takes an image of shape (b, c, h, w),
+# the std of the Gaussian and the (1D or 2D) kernel used by the direct implementations,
+# and returns a blurred image of the same shape. Boundaries are handled by reflection,
+# as in RetinaBlurFilter.
+BLUR_BACKENDS = {}
+_SELECTED_BACKENDS = {}
+_RECURSIVE_GAUSSIAN_MATRICES = {}
+
+def register_blur_backend(name):
+    def decorator(fn):
+        BLUR_BACKENDS[name] = fn
+        return fn
+    return decorator
+
+def _to_1d(kernel):
+    # The 2D kernels are outer products of normalized 1D kernels, so their marginal
+    # is the 1D kernel.
+    return kernel.sum(0) if kernel.dim() == 2 else kernel
+
+def _to_2d(kernel):
+    return torch.outer(kernel, kernel) if kernel.dim() == 1 else kernel
+
+def _reflect_pad(img, p):
+    p = min(p, min(img.shape[2:])-1)
+    return nn.functional.pad(img, (p,)*4, mode='reflect'), p
+
+def _separable_conv(img, kernel):
+    c = img.shape[1]
+    ks = kernel.shape[-1]
+    W = kernel.to(img.dtype).view(1, 1, 1, ks).expand(c, 1, 1, ks)
+    img = nn.functional.conv2d(img, W, groups=c)
+    img = nn.functional.conv2d(img, W.transpose(2, 3), groups=c)
+    return img
+
+@register_blur_backend('direct')
+def direct_blur(img, sigma, kernel):
+    K = _to_2d(kernel).to(img.dtype)
+    c = img.shape[1]
+    x = nn.functional.pad(img, (K.shape[-1]//2,)*4, mode='reflect')
+    return nn.functional.conv2d(x, K.view(1, 1, *(K.shape)).expand(c, 1, -1, -1), groups=c)
+
+@register_blur_backend('separable')
+def separable_blur(img, sigma, kernel):
+    K = _to_1d(kernel)
+    x = nn.functional.pad(img, (K.shape[-1]//2,)*4, mode='reflect')
+    return _separable_conv(x, K)
+
+@register_blur_backend('fft')
+def fft_blur(img, sigma, kernel):
+    K = _to_1d(kernel)
+    ks = K.shape[-1]
+    h, w = img.shape[2:]
+    x = nn.functional.pad(img, (ks//2,)*4, mode='reflect')
+    dtype = x.dtype
+    # FFTs are not supported for half precision on all devices
+    x = x.float()
+    K = K.to(device=x.device, dtype=x.dtype)
+    hp, wp = x.shape[2:]
+    # Center the kernel on the origin, the padding prevents wrap-around in the output region.
+    kh = torch.roll(nn.functional.pad(K, (0, hp-ks)), -(ks//2))
+    kw = torch.roll(nn.functional.pad(K, (0, wp-ks)), -(ks//2))
+    Kf = torch.fft.fft(kh).unsqueeze(1) * torch.fft.rfft(kw).unsqueeze(0)
+    y = torch.fft.irfft2(torch.fft.rfft2(x) * Kf, s=(hp, wp))
+    y = y[..., ks//2:ks//2+h, ks//2:ks//2+w]
+    return y.to(dtype)
+
+def _yvv_coefficients(sigma):
+    # Young & van Vliet, "Recursive implementation of the Gaussian filter", 1995.
+    if sigma < 0.5:
+        raise ValueError(f'the recursive Gaussian is only accurate for sigma >= 0.5, but got {sigma}')
+    if sigma >= 2.5:
+        q = 0.98711*sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554*np.sqrt(1 - 0.26891*sigma)
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+    B = 1 - (b1+b2+b3)/b0
+    return B, b1/b0, b2/b0, b3/b0
+
+def _recursive_gaussian_last_dim(x, sigma):
+    B, b1, b2, b3 = _yvv_coefficients(sigma)
+    # causal pass followed by an anti-causal pass, both initialized at steady state.
+    xs = x.unbind(-1)
+    w = [xs[0]]*3
+    for xn in xs:
+        w.append(B*xn + b1*w[-1] + b2*w[-2] + b3*w[-3])
+    w = w[3:]
+    y = [w[-1]]*3
+    for wn in w[::-1]:
+        y.append(B*wn + b1*y[-1] + b2*y[-2] + b3*y[-3])
+    y = y[3:][::-1]
+    return torch.stack(y, -1)
+
+def _get_recursive_gaussian_matrix(sigma, n, device, dtype):
+    # The recursive filter, including the reflection padding and the cropping, is linear,
+    # so along an axis of length n it is the product with the (n, n) matrix of its
+    # responses to the unit impulses. The matrix is computed once with the sequential
+    # recursion, which then does not have to run on every image.
+    key = (float(sigma), n, str(device), dtype)
+    if key not in _RECURSIVE_GAUSSIAN_MATRICES:
+        p = min(int(np.ceil(3*sigma)), n-1)
+        eye = torch.eye(n, dtype=torch.float64).view(1, 1, n, n)
+        x = nn.functional.pad(eye, (p, p, 0, 0), mode='reflect')
+        M = _recursive_gaussian_last_dim(x, sigma)[0, 0, :, p:p+n]
+        _RECURSIVE_GAUSSIAN_MATRICES[key] = M.to(device=device, dtype=dtype)
+    return _RECURSIVE_GAUSSIAN_MATRICES[key]
+
+@register_blur_backend('recursive')
+def recursive_blur(img, sigma, kernel):
+    h, w = img.shape[2:]
+    Mh = _get_recursive_gaussian_matrix(sigma, h, img.device, img.dtype)
+    Mw = _get_recursive_gaussian_matrix(sigma, w, img.device, img.dtype)
+    return torch.matmul(torch.matmul(Mh.T, img), Mw)
+
+@register_blur_backend('resample')
+def resample_blur(img, sigma, kernel):
+    # Downsample by an integer factor, blur with the correspondingly smaller std and
+    # upsample back. The variance of the box filter used for downsampling is discounted.
+    f = int(sigma // 2)
+    if f < 2:
+        raise ValueError(f'resampling is not useful for sigma < 4, but got {sigma}')
+    h, w = img.shape[2:]
+    x = nn.functional.adaptive_avg_pool2d(img, (int(np.ceil(h/f)), int(np.ceil(w/f))))
+    ds_sigma = np.sqrt(max(sigma**2 - (f**2 - 1)/12, 0.25)) / f
+    ks = 2*int(np.ceil(3*ds_sigma)) + 1
+    n = torch.arange(ks, device=img.device, dtype=img.dtype) - ks//2
+    K = torch.exp(-n**2 / (2*ds_sigma**2))
+    K = K / K.sum()
+    x, p = _reflect_pad(x, ks//2)
+    x = _separable_conv(x, K[ks//2-p:ks//2+p+1])
+    return nn.functional.interpolate(x, size=(h, w), mode='bilinear', align_corners=False)
+
+def benchmark_blur_backends(img, sigma, kernel, backends=None, reference='separable', nreps=3):
+    '''
+    Times each backend on img and measures its maximum absolute error with respect to
+    the reference backend. Returns a dict mapping backend names to (time, error).
+    Backends that do not support the given sigma are skipped.
+    '''
+    if backends is None:
+        backends = list(BLUR_BACKENDS.keys())
+    img = img.detach()
+    def sync():
+        if img.is_cuda:
+            torch.cuda.synchronize(img.device)
+    results = {}
+    with torch.no_grad():
+        ref = BLUR_BACKENDS[reference](img, sigma, kernel)
+        for name in backends:
+            fn = BLUR_BACKENDS[name]
+            try:
+                out = fn(img, sigma, kernel)
+            except ValueError:
+                continue
+            sync()
+            t0 = time()
+            for _ in range(nreps):
+                fn(img, sigma, kernel)
+            sync()
+            t = (time() - t0) / nreps
+            err = (out.float() - ref.float()).abs().max().item()
+            results[name] = (t, err)
+    return results
+
+def select_blur_backend(img, sigma, kernel, tolerance=1e-3, backends=None):
+    '''
+    Returns the name of the fastest backend whose output is within tolerance of the
+    separable convolution (the reference of benchmark_blur_backends, which equals the
+    direct convolution since the kernels are separable). The choice is made by
+    benchmarking the backends the first time a (sigma, image size, device, dtype)
+    combination is seen and is cached afterwards.
+    '''
+    key = (round(float(sigma), 4), tuple(img.shape[2:]), str(img.device), img.dtype, tolerance,
+            None if backends is None else tuple(backends))
+    if key not in _SELECTED_BACKENDS:
+        results = benchmark_blur_backends(img, sigma, kernel, backends=backends)
+        candidates = [(t, name) for name, (t, err) in results.items() if err <= tolerance]
+        _SELECTED_BACKENDS[key] = min(candidates)[1] if len(candidates) > 0 else 'separable'
+        print(f'blur backend for sigma={sigma:.3f} and image size={tuple(img.shape[2:])} on {img.device}: {_SELECTED_BACKENDS[key]}', {k: (f'{t*1000:.2f}ms', f'{e:.2e}') for k, (t, e) in results.items()})
+    return _SELECTED_BACKENDS[key]
+
+def clear_selected_blur_backends():
+    _SELECTED_BACKENDS.clear()
@@ -0,0 +1,54 @@
+from copy import deepcopy
+import torch
+from torch import nn
+from rblur.retina_preproc import RetinaBlurFilter, RetinDoGBlurFilter, RetinaSampleFilter, StaticRetinaBlurFilter
+from rblur.retina_blur2 import RetinaBlurFilter as RBlur2
+
+def make_static_retina_layers(model: nn.Module, input_shape=None) -> nn.Module:
+    '''
+    Returns a copy of model in which every RetinaBlurFilter has been replaced by the
+    equivalent StaticRetinaBlurFilter, so that the model can be compiled or exported.
+    RetinaSampleFilter and the RetinaBlurFilter of retina_blur2 have no static version,
+    and models containing them are rejected rather than traced with numpy ops.
+    '''
+    unsupported = [m for m in model.modules() if isinstance(m, (RetinaSampleFilter, RBlur2))]
+    if len(unsupported) > 0:
+        raise ValueError(f'{type(unsupported[0]).__name__} does not have a static version')
+    model = deepcopy(model)
+    def _replace(module):
+        for name, child in module.named_children():
+            if isinstance(child, RetinaBlurFilter) and not isinstance(child, RetinDoGBlurFilter):
+                setattr(module, name, StaticRetinaBlurFilter(child, input_shape=input_shape))
+            else:
+                _replace(child)
+    if isinstance(model, RetinaBlurFilter):
+        return StaticRetinaBlurFilter(model, input_shape=input_shape)
+    _replace(model)
+    return model
+
+def compile_preprocessing(model: nn.Module, input_shape=None, **compile_kwargs):
+    return torch.compile(make_static_retina_layers(model, input_shape), **compile_kwargs)
+
+def export_torchscript(model: nn.Module, example_input: torch.Tensor, path: str):
+    '''
+    Traces the preprocessing stack (e.g. a SequentialLayers model) with its retina
+    layers made static, and saves it with TorchScript. The model should be in eval
+    mode, otherwise random noise layers will be traced with a fixed noise sample.
+    '''
+    model = make_static_retina_layers(model, example_input.shape[1:]).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input)
+    traced.save(path)
+    return traced
+
+def export_onnx(model: nn.Module, example_input: torch.Tensor, path: str, opset_version=17, dynamic_batch=True):
+    '''
+    Exports the preprocessing stack with its retina layers made static to ONNX. The
+    batch dimension is dynamic if dynamic_batch is True.
+    '''
+    model = make_static_retina_layers(model, example_input.shape[1:]).eval()
+    dynamic_axes = {'input': {0: 'batch'}, 'output': {0: 'batch'}} if dynamic_batch else None
+    with torch.no_grad():
+        torch.onnx.export(model, example_input, path, input_names=['input'], output_names=['output'],
+                          opset_version=opset_version, dynamic_axes=dynamic_axes)
+    return model
@@ -0,0 +1,132 @@
+'''
+Calibrates the resolution at which the fixation predictor of a fixation-aware classifier
+is run during inference. For each candidate resolution, the fixation locations selected
+by the model and its accuracy are compared against the baseline resolution (the
+min_image_dim of the fixation predictor, 768 by default). The smallest resolution whose
+fixation agreement and accuracy are within the given tolerances is recorded as the
+operating point for the task, and can be used by setting inference_image_dim in the
+parameters of the fixation predictor.
+'''
+from argparse import ArgumentParser
+from importlib import import_module
+from time import perf_counter
+import os
+import numpy as np
+import torch
+from tqdm import tqdm
+from rblur.runners import load_params_into_model
+from rblur.utils import load_json, write_json
+from rblur.fixation_prediction.models import BaseFixationPredictor, RetinaFilterWithFixationPrediction
+
+def get_task_class_from_str(s):
+    split = s.split('.')
+    modstr = '.'.join(split[:-1])
+    cls_name =  split[-1]
+    mod = import_module(modstr)
+    task_cls = getattr(mod, cls_name)
+    return task_cls
+
+def set_inference_image_dim(model, dim):
+    for m in model.modules():
+        if isinstance(m, BaseFixationPredictor):
+            m.set_inference_image_dim(dim)
+
+def get_selected_loc_idxs(model):
+    for m in model.modules():
+        if isinstance(m, RetinaFilterWithFixationPrediction) and ('selected_loc_idxs' in m.interim_outputs):
+            return m.interim_outputs['selected_loc_idxs']
+
+def evaluate_at_resolution(model, loader, dim, device):
+    set_inference_image_dim(model, dim)
+    preds, loc_idxs, times = [], [], []
+    labels = []
+    with torch.no_grad():
+        for x, y in tqdm(loader, desc=f'dim={dim}'):
+            x = x.to(device)
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            t0 = perf_counter()
+            logits = model(x)
+            if isinstance(logits, tuple):
+                logits = logits[0]
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            times.append(perf_counter() - t0)
+            preds.append(logits.argmax(-1).cpu())
+            labels.append(y)
+            locs = get_selected_loc_idxs(model)
+            if locs is not None:
+                loc_idxs.append(locs.reshape(x.shape[0], -1).cpu())
+    preds = torch.cat(preds)
+    labels = torch.cat(labels)
+    return {
+        'accuracy': (preds == labels).float().mean().item(),
+        'time_per_batch': float(np.mean(times)),
+        'loc_idxs': torch.cat(loc_idxs) if len(loc_idxs) > 0 else None,
+    }
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--task', type=str, required=True)
+    parser.add_argument('--ckp', type=str, required=True)
+    parser.add_argument('--dims', type=int, nargs='+', default=[224, 320, 448, 576])
+    parser.add_argument('--baseline_dim', type=int, default=None, help='defaults to the min_image_dim of the fixation predictor')
+    parser.add_argument('--num_test', type=int, default=2000)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--min_fixation_agreement', type=float, default=0.9)
+    parser.add_argument('--max_accuracy_drop', type=float, default=0.005)
+    parser.add_argument('--output', type=str, default=None, help='defaults to fixation_resolution_calibration.json in the experiment directory')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    task = get_task_class_from_str(args.task)()
+    model_params = task.get_model_params()
+    model = model_params.cls(model_params)
+    ckp = torch.load(args.ckp)
+    model = load_params_into_model(ckp, model)
+    model = model.eval().to(device)
+
+    baseline_dim = args.baseline_dim
+    if baseline_dim is None:
+        baseline_dim = [m.min_image_dim for m in model.modules() if isinstance(m, BaseFixationPredictor)][0]
+
+    ds_params = task.get_dataset_params()
+    ds_params.max_num_test = args.num_test
+    _, _, test_dataset, nclasses = ds_params.cls.get_image_dataset(ds_params)
+    loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False)
+
+    baseline = evaluate_at_resolution(model, loader, baseline_dim, device)
+    results = {}
+    operating_point = baseline_dim
+    for dim in sorted(args.dims, reverse=True):
+        r = evaluate_at_resolution(model, loader, dim, device)
+        if (r['loc_idxs'] is not None) and (baseline['loc_idxs'] is not None):
+            agreement = (r['loc_idxs'] == baseline['loc_idxs']).float().mean().item()
+        else:
+            agreement = np.nan
+        results[dim] = {
+            'accuracy': r['accuracy'],
+            'accuracy_drop': baseline['accuracy'] - r['accuracy'],
+            'fixation_agreement': agreement,
+            'time_per_batch': r['time_per_batch'],
+            'speedup': baseline['time_per_batch'] / r['time_per_batch'],
+        }
+        print(dim, results[dim])
+        if (dim < operating_point) and (agreement >= args.min_fixation_agreement) and (results[dim]['accuracy_drop'] <= args.max_accuracy_drop):
+            operating_point = dim
+    set_inference_image_dim(model, None)
+
+    ofn = args.output
+    if ofn is None:
+        ofn = f'{os.path.dirname(os.path.dirname(args.ckp))}/fixation_resolution_calibration.json'
+    calibration = load_json(ofn) if os.path.exists(ofn) else {}
+    calibration[args.task] = {
+        'baseline_dim': baseline_dim,
+        'baseline_accuracy': baseline['accuracy'],
+        'baseline_time_per_batch': baseline['time_per_batch'],
+        'results': results,
+        'operating_point': operating_point,
+    }
+    print(f'operating point for {args.task}: inference_image_dim={operating_point}')
+    print(f'writing results to {ofn}')
+    write_json(calibration, ofn)
@@ -0,0 +1,181 @@
+'''
+Memory-mapped cache of the ClickMe (or any webdataset with jpg and heatmap.npy entries)
+training data for fine-tuning DeepGaze. The webdataset shards are decoded and resized
+once, and the images (uint8) and density maps (float16) are written into flat .npy
+shards of shard_size samples that are memory-mapped when training, so that the data can
+be read with random access by any number of DataLoader workers. All the images in the
+cache have the same size, so a single center bias log-density, fitted on the training
+split, is stored in the root of the cache.
+
+    {root}/{split}/images_000000.npy        (n, size, size, 3) uint8
+    {root}/{split}/densities_000000.npy     (n, size, size) float16
+    {root}/{split}/labels_000000.npy        (n,) int64
+    {root}/{split}/index.json
+    {root}/centerbias.npy                   (size, size) float32
+'''
+import os
+import numpy as np
+import torch
+import torchvision
+from tqdm import tqdm
+from rblur.utils import load_json, write_json
+
+def get_clickme_sample_transform(image_size):
+    resize = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(image_size),
+        torchvision.transforms.CenterCrop(image_size),
+    ])
+    def transform(sample):
+        x = torchvision.transforms.functional.pil_to_tensor(sample['jpg'].convert('RGB'))
+        m = torch.as_tensor(np.asarray(sample['heatmap.npy'], dtype=np.float32))
+        if m.dim() == 3:
+            m = m[..., 0]
+        m = m.unsqueeze(0)
+        # resize the density map along with the image, after matching their sizes
+        if m.shape[1:] != x.shape[1:]:
+            m = torch.nn.functional.interpolate(m.unsqueeze(0), size=x.shape[1:], mode='bilinear', align_corners=False)[0]
+        x = resize(x)
+        m = resize(m)
+        return x.permute(1, 2, 0).numpy(), m[0].numpy().astype(np.float16), int(sample.get('cls', -1))
+    return transform
+
+class _ShardWriter:
+    def __init__(self, odir, shard_size, image_size) -> None:
+        self.odir = odir
+        self.shard_size = shard_size
+        self.image_size = image_size
+        self.shard_sizes = []
+        self._reset()
+        os.makedirs(odir, exist_ok=True)
+
+    def _reset(self):
+        self.images, self.densities, self.labels = [], [], []
+
+    def add(self, x, m, y):
+        self.images.append(x)
+        self.densities.append(m)
+        self.labels.append(y)
+        if len(self.images) >= self.shard_size:
+            self.flush()
+
+    def _save(self, name, arr):
+        tmp_path = f'{self.odir}/{name}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_path, f'{self.odir}/{name}')
+
+    def flush(self):
+        if len(self.images) == 0:
+            return
+        i = len(self.shard_sizes)
+        self._save(f'images_{i:06d}.npy', np.stack(self.images))
+        self._save(f'densities_{i:06d}.npy', np.stack(self.densities))
+        self._save(f'labels_{i:06d}.npy', np.array(self.labels, dtype=np.int64))
+        self.shard_sizes.append(len(self.images))
+        self._reset()
+
+    def close(self):
+        self.flush()
+        write_json({'shard_sizes': self.shard_sizes, 'image_size': self.image_size}, f'{self.odir}/index.json')
+
+def write_clickme_cache_split(dataset, odir, image_size=224, max_samples=None, shard_size=4096, num_workers=8):
+    '''
+    Decodes a webdataset (before decoding, e.g. wds.WebDataset(urls)) with num_workers
+    workers and writes it into memory-mapped shards in odir.
+    '''
+    import webdataset as wds
+    dataset = dataset.decode('pil').map(get_clickme_sample_transform(image_size))
+    loader = wds.WebLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+    writer = _ShardWriter(odir, shard_size, image_size)
+    for i, (x, m, y) in enumerate(tqdm(loader, desc=odir)):
+        if (max_samples is not None) and (i >= max_samples):
+            break
+        writer.add(x, m, y)
+    writer.close()
+    return writer.shard_sizes
+
+def density_to_fixation_batch(density, generator=None):
+    '''
+    Samples fixations from a batch of density maps (N, ...), with the probability of a
+    fixation at each pixel being proportional to the density, normalized by its maximum
+    in each map.
+    '''
+    peak = torch.flatten(density, 1).amax(1).clamp_min(1e-12)
+    prob_map = density / peak.view(-1, *([1] * (density.dim() - 1)))
+    return torch.bernoulli(prob_map.clamp(0, 1), generator=generator)
+
+def fit_clickme_centerbias(cache_root, split='train', num_samples=10_000, seed=69239841):
+    # fits the pysaliency baseline model on the first num_samples cached images, as the
+    # webdataset based fine-tuning did, and returns its log-density
+    import pysaliency
+    from pysaliency.baseline_utils import BaselineModel
+    ds = ClickmeCacheDataset(cache_root, split, load_centerbias=False)
+    idxs = range(min(num_samples, len(ds)))
+    images = [ds.get_arrays(i)[0] for i in idxs]
+    densities = torch.from_numpy(np.stack([ds.get_arrays(i)[1] for i in idxs]).astype(np.float32))
+    fixmaps = density_to_fixation_batch(densities, torch.Generator().manual_seed(seed)).numpy()
+    stimuli = pysaliency.Stimuli(images)
+    fixations = pysaliency.Fixations.from_fixation_matrices(list(fixmaps))
+    # parameters taken from an early fit for MIT1003. Since SALICON has many more fixations, the bandwidth won't be too small
+    centerbias = BaselineModel(stimuli=stimuli, fixations=fixations, bandwidth=0.0217, eps=2e-13, caching=False)
+    return centerbias._log_density(images[0]).astype(np.float32)
+
+def build_clickme_cache(cache_root, datasets, image_size=224, max_samples=None, shard_size=4096, num_workers=8, centerbias_samples=10_000):
+    # datasets maps the name of each split to its (undecoded) webdataset. Splits that are
+    # already in the cache are skipped.
+    for split, dataset in datasets.items():
+        if not os.path.exists(f'{cache_root}/{split}/index.json'):
+            write_clickme_cache_split(dataset, f'{cache_root}/{split}', image_size, max_samples, shard_size, num_workers)
+    if not os.path.exists(f'{cache_root}/centerbias.npy'):
+        np.save(f'{cache_root}/centerbias.npy', fit_clickme_centerbias(cache_root, 'train', centerbias_samples))
+
+class ClickmeCacheDataset(torch.utils.data.Dataset):
+    '''
+    Reads a split of the cache written by build_clickme_cache. Returns dicts with the
+    keys expected by deepgaze_pytorch.training._train, except that fixation_mask contains
+    the density map, from which the fixations are sampled by collate_clickme_batch.
+    '''
+    def __init__(self, root, split, load_centerbias=True) -> None:
+        super().__init__()
+        self.odir = f'{root}/{split}'
+        index = load_json(f'{self.odir}/index.json')
+        self.shard_sizes = index['shard_sizes']
+        self.offsets = np.cumsum([0] + self.shard_sizes)
+        self.centerbias = torch.from_numpy(np.load(f'{root}/centerbias.npy')) if load_centerbias else None
+        self._shards = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+        # memory maps are not pickled, each worker opens its own
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _get_shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = tuple(np.load(f'{self.odir}/{name}_{i:06d}.npy', mmap_mode='r') for name in ['images', 'densities', 'labels'])
+        return self._shards[i]
+
+    def get_arrays(self, i):
+        s = int(np.searchsorted(self.offsets, i, side='right') - 1)
+        images, densities, labels = self._get_shard(s)
+        j = i - self.offsets[s]
+        return images[j], densities[j], labels[j]
+
+    def __getitem__(self, i):
+        x, m, y = self.get_arrays(i)
+        sample = {
+            'image': torch.from_numpy(np.array(x)).permute(2, 0, 1).float() / 255,
+            'fixation_mask': torch.from_numpy(np.array(m, dtype=np.float32)).unsqueeze(0),
+            'weight': 1.,
+        }
+        if self.centerbias is not None:
+            sample['centerbias'] = self.centerbias
+        return sample
+
+def collate_clickme_batch(batch):
+    collated_batch = torch.utils.data.default_collate(batch)
+    collated_batch['fixation_mask'] = density_to_fixation_batch(collated_batch['fixation_mask'])
+    return collated_batch
@@ -0,0 +1,117 @@
+'''
+Compares the sequential and one-shot scanpath modes (see
+RetinaFilterWithFixationPrediction.get_one_shot_scanpath) of a multi-fixation model.
+For each mode the clean accuracy, the accuracy under an APGD attack, the time per batch
+and the agreement of the predictions with the sequential mode are reported.
+'''
+from argparse import ArgumentParser
+from importlib import import_module
+from time import perf_counter
+import os
+import numpy as np
+import torch
+from torch import nn
+from tqdm import tqdm
+from torchattacks import APGD
+from rblur.runners import load_params_into_model
+from rblur.utils import load_json, write_json
+from rblur.fixation_prediction.models import RetinaFilterWithFixationPrediction
+
+def get_task_class_from_str(s):
+    split = s.split('.')
+    modstr = '.'.join(split[:-1])
+    cls_name =  split[-1]
+    mod = import_module(modstr)
+    task_cls = getattr(mod, cls_name)
+    return task_cls
+
+def set_scanpath_mode(model, mode):
+    for m in model.modules():
+        if isinstance(m, RetinaFilterWithFixationPrediction):
+            m.params.scanpath_mode = mode
+
+class LogitsOnly(nn.Module):
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        logits = self.model(x)
+        if isinstance(logits, tuple):
+            logits = logits[0]
+        return logits
+
+def evaluate_mode(model, loader, mode, device, attack=None):
+    set_scanpath_mode(model, mode)
+    preds, adv_preds, labels, times = [], [], [], []
+    for x, y in tqdm(loader, desc=mode):
+        x, y = x.to(device), y.to(device)
+        with torch.no_grad():
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            t0 = perf_counter()
+            logits = model(x)
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            times.append(perf_counter() - t0)
+        preds.append(logits.argmax(-1).cpu())
+        labels.append(y.cpu())
+        if attack is not None:
+            xadv = attack(x, y)
+            with torch.no_grad():
+                adv_preds.append(model(xadv).argmax(-1).cpu())
+    preds = torch.cat(preds)
+    labels = torch.cat(labels)
+    result = {
+        'accuracy': (preds == labels).float().mean().item(),
+        'time_per_batch': float(np.mean(times)),
+        'preds': preds,
+    }
+    if attack is not None:
+        result['adv_accuracy'] = (torch.cat(adv_preds) == labels).float().mean().item()
+    return result
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--task', type=str, required=True)
+    parser.add_argument('--ckp', type=str, required=True)
+    parser.add_argument('--num_test', type=int, default=2000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--eps', type=float, default=0., help='L-inf epsilon of the APGD attack, no attack if 0')
+    parser.add_argument('--nsteps', type=int, default=25)
+    parser.add_argument('--output', type=str, default=None, help='defaults to scanpath_mode_comparison.json in the experiment directory')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    task = get_task_class_from_str(args.task)()
+    model_params = task.get_model_params()
+    model = model_params.cls(model_params)
+    ckp = torch.load(args.ckp)
+    model = load_params_into_model(ckp, model)
+    model = LogitsOnly(model).eval().to(device)
+
+    ds_params = task.get_dataset_params()
+    ds_params.max_num_test = args.num_test
+    _, _, test_dataset, nclasses = ds_params.cls.get_image_dataset(ds_params)
+    loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False)
+
+    attack = APGD(model, eps=args.eps, steps=args.nsteps) if args.eps > 0 else None
+    results = {}
+    for mode in ['sequential', 'one_shot']:
+        results[mode] = evaluate_mode(model, loader, mode, device, attack)
+    set_scanpath_mode(model, 'sequential')
+
+    seq_preds = results['sequential'].pop('preds')
+    for mode, r in results.items():
+        preds = r.pop('preds') if 'preds' in r else seq_preds
+        r['prediction_agreement'] = (preds == seq_preds).float().mean().item()
+        r['speedup'] = results['sequential']['time_per_batch'] / r['time_per_batch']
+        print(mode, r)
+
+    ofn = args.output
+    if ofn is None:
+        ofn = f'{os.path.dirname(os.path.dirname(args.ckp))}/scanpath_mode_comparison.json'
+    comparison = load_json(ofn) if os.path.exists(ofn) else {}
+    comparison[args.task] = {'eps': args.eps, 'results': results}
+    print(f'writing results to {ofn}')
+    write_json(comparison, ofn)
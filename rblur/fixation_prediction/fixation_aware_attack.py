@@ -8,7 +8,7 @@ import numpy as np
 from copy import deepcopy
 
 # from mllib.adversarial.lib.autoattack.autopgd_base import APGDAttack
-from rblur.fixation_prediction.models import RetinaFilterWithFixationPrediction, unnormalized_gkern, _update_mask
+from rblur.fixation_prediction.models import RetinaFilterWithFixationPrediction, unnormalized_gkern, stamp_inhibition_of_return
 from rblur.models import IdentityLayer
 from torchattacks.attack import Attack
 from torchattacks.attacks.apgd import APGD
@@ -284,6 +284,8 @@ class FixationAwareAPGDAttack(APGD):
         self.scanpath_length = self.rfmodule.params.num_eval_fixation_points
         self.fixation_selection_attack_num_steps = fixation_selection_attack_num_steps
         self.fixation_selection_attack = mAPGDAttack(self.model, n_iter=fixation_selection_attack_num_steps, norm=norm, eps=eps, verbose=False)
+        self._fixation_generators = {}
+        self._mask_kernels = {}
 
     def _pop_retina_fixation_module(self) -> RetinaFilterWithFixationPrediction:
         rfmodule = None
@@ -478,32 +480,41 @@ class FixationAwareAPGDAttack(APGD):
 
         return cost, adv_images
     
-    def _initialize_mask_and_kernel(self, x, shape_std_ratio=10):
+    def _get_mask_kernel(self, x, shape_std_ratio=10):
         h,w = x.shape[-2:]
-        mask = np.ones((1,1,h,w))
-        std = max(h,w) / shape_std_ratio
-        ks = int(4*std) 
-        ks += int((ks % 2) == 0)
-        mask_kernel = 1-unnormalized_gkern(ks, std) + 1e-8
-        mask_kernel = mask_kernel.cpu().detach().numpy()
-        return mask, mask_kernel
+        key = (h, w, shape_std_ratio, x.device)
+        if key not in self._mask_kernels:
+            std = max(h,w) / shape_std_ratio
+            ks = int(4*std) 
+            ks += int((ks % 2) == 0)
+            self._mask_kernels[key] = (1-unnormalized_gkern(ks, std) + 1e-8).to(x.device)
+        return self._mask_kernels[key]
+
+    def _get_fixation_generator(self, device):
+        # one seeded generator per device, since torch.multinomial requires the generator
+        # to be on the same device as the probabilities
+        key = str(device)
+        if key not in self._fixation_generators:
+            self._fixation_generators[key] = torch.Generator(device=device).manual_seed(self.seed)
+        return self._fixation_generators[key]
     
     def _sample_fixation_locations(self, x):
+        # samples a random scanpath for every image in the batch x, with inhibition of
+        # return around the previous fixations. Returns a (N, scanpath_length, 2) tensor
+        # of (row, col) locations.
+        n = x.shape[0]
         h,w = x.shape[-2:]
         if self.fixation_sampling_strategy == 'random':
-            mask, mask_kernel = self._initialize_mask_and_kernel(x)
-            mask *= 1/mask.size
-            rng = np.random.Generator(np.random.PCG64())
-            loc_idxs = []            
+            mask_kernel = self._get_mask_kernel(x)
+            mask = torch.ones((n,1,h,w), device=x.device)
+            generator = self._get_fixation_generator(x.device)
+            loc_idxs = []
             for i in range(self.scanpath_length):
-                flat_mask = mask.reshape(-1)
-                idx = rng.choice(np.arange(flat_mask.shape[0]), p=flat_mask/flat_mask.sum())
+                idx = torch.multinomial(torch.flatten(mask, 1), 1, generator=generator).squeeze(1)
                 loc_idxs.append(idx)
-                _update_mask(idx, [0], mask_kernel.shape[-1]//2, mask, mask_kernel)
-            loc_idxs = np.array(loc_idxs)
-            row_locs = loc_idxs // w
-            col_locs = loc_idxs % w
-            locs = list(zip(row_locs, col_locs))
+                mask = stamp_inhibition_of_return(mask, idx, mask_kernel)
+            loc_idxs = torch.stack(loc_idxs, 1)
+            locs = torch.stack([loc_idxs // w, loc_idxs % w], -1)
         return locs
             
         # elif self.fixation_sampling_strategy == 'grid':
@@ -560,7 +571,7 @@ class FixationAwareAPGDAttack(APGD):
         ind_to_fool = torch.ones_like(labels).nonzero().squeeze()
         acc = torch.ones_like(labels)
         loss = torch.ones_like(labels) * 1e-10
-        scanpaths = [None]*len(labels)
+        scanpaths = torch.zeros((len(labels), self.scanpath_length, 2), dtype=torch.long, device=images.device)
 
         j = 0
         while (ind_to_fool.numel() > 0) and (j < self.num_fixation_samples):
@@ -568,8 +579,9 @@ class FixationAwareAPGDAttack(APGD):
             x_to_fool = images[ind_to_fool]
             y_to_fool = labels[ind_to_fool]
 
-            curr_scanpaths = [self._sample_fixation_locations(x) for x in x_to_fool]
-            print(curr_scanpaths)
+            curr_scanpaths = self._sample_fixation_locations(x_to_fool)
+            if self.verbose:
+                print(curr_scanpaths)
             x_best, acc_curr, loss_curr, x_best_adv = self.apgd_attack_single_run(x_to_fool, y_to_fool, curr_scanpaths,
                                         self._compute_scanpath_selection_loss, self.fixation_selection_attack_num_steps)
             
@@ -581,8 +593,7 @@ class FixationAwareAPGDAttack(APGD):
 
             acc[ind_to_fool[successful_idx]] = 0
             loss[ind_to_fool[loss_improved_idx]] = loss_curr[loss_improved_idx].clone()
-            for i in loss_improved_idx:
-                scanpaths[ind_to_fool[i]] = curr_scanpaths[i]
+            scanpaths[ind_to_fool[loss_improved_idx]] = curr_scanpaths[loss_improved_idx]
             ind_to_fool = acc.nonzero().squeeze()
             if len(ind_to_fool.shape) == 0: ind_to_fool = ind_to_fool.unsqueeze(0)
             j += 1
@@ -592,9 +603,12 @@ class FixationAwareAPGDAttack(APGD):
 
     
     def _compute_scanpath_selection_loss(self, images, scanpaths, labels):
+        # the images are foveated at every fixation of their scanpaths in one batched call.
+        # The views of each image are consecutive and are reduced to one row of logits by
+        # the ensembler of the model.
+        n, L = scanpaths.shape[:2]
         self.retina.params.loc_mode='const'
-        self.retina.params.loc = scanpaths
-        blurred_images = self.retina(images)
+        blurred_images = self.rfmodule.apply_retina_at_locs(torch.repeat_interleave(images, L, 0), scanpaths.reshape(-1, 2))
 
         self.rfmodule.params.disable = True
         logits = self.model(blurred_images)
@@ -603,40 +617,25 @@ class FixationAwareAPGDAttack(APGD):
         return loss, logits
 
     def _compute_scanpath_loss(self, images, scanpaths, labels):
+        n = images.shape[0]
         h,w = images.shape[-2:]
-        scanpaths_ = [[(0,0)] + sp for sp in scanpaths]
+        # the scanpaths start at (0,0)
+        scanpaths_ = torch.cat([torch.zeros((n, 1, 2), dtype=scanpaths.dtype, device=scanpaths.device), scanpaths], 1)
 
         self.rfmodule.params.disable = False
-        self.retina.params.batch_size = 1
         self.retina.params.loc_mode='const'
 
-        blurry_images = []
-        fixation_loss = torch.zeros(images.shape[0], dtype=images.dtype, device=images.device)
-        for i in range(self.scanpath_length+1):
-            curr_locs = [sp[i] for sp in scanpaths_]
-            self.retina.params.loc = curr_locs
-            x_blur = self.retina(images)
-            if i > 0:
-                blurry_images.append(x_blur)
-
-            if i < self.scanpath_length:
-                next_locs = [sp[i+1] for sp in scanpaths_]
-                fixation_maps = self.rfmodule.fixation_model(x_blur)
-                fixation_maps = torch.log_softmax(torch.flatten(fixation_maps, 2), -1).reshape(fixation_maps.shape)
-                # print(fixation_maps.shape, torch.flatten(fixation_maps, 2).exp().sum(-1))
-                for j,(fmap, loc) in enumerate(zip(fixation_maps, next_locs)):
-                    mask, mask_kernel = self._initialize_mask_and_kernel(x_blur, 100)
-                    _update_mask(loc[0]*w+loc[1], [0], mask_kernel.shape[-1]//2, mask, mask_kernel)
-                    mask = torch.tensor(mask[0], dtype=fmap.dtype, device=fmap.device)
-                    loc_loss = (fmap * (1-mask)).sum()
-                    fixation_loss[j] += loc_loss / self.scanpath_length
-                    # print(i,j,curr_locs[j], loc, loc_loss, fixation_loss[j])
-                    # print(fixation_loss.shape, fmap.shape, mask.shape)
-                    # print(i, j, fixation_maps.shape, fmap.shape, loc, curr_locs[j])
-                    # fixation_loss[j] += fmap[..., loc[0], loc[1]].squeeze()
-
-        blurry_images = torch.stack(blurry_images, 1)
-        blurry_images = blurry_images.reshape(-1, *(blurry_images.shape[2:]))
+        mask_kernel = self._get_mask_kernel(images, 100)
+        fixation_loss = torch.zeros(n, dtype=images.dtype, device=images.device)
+        for i in range(self.scanpath_length):
+            x_blur = self.rfmodule.apply_retina_at_locs(images, scanpaths_[:, i])
+            next_locs = scanpaths_[:, i+1]
+            fixation_maps = self.rfmodule.fixation_model(x_blur)
+            fixation_maps = torch.log_softmax(torch.flatten(fixation_maps, 2), -1).reshape(fixation_maps.shape)
+            mask = stamp_inhibition_of_return(torch.ones((n,1,h,w), dtype=fixation_maps.dtype, device=fixation_maps.device),
+                                                next_locs[:, 0]*w + next_locs[:, 1], mask_kernel)
+            loc_loss = torch.flatten(fixation_maps * (1-mask), 1).sum(1)
+            fixation_loss = fixation_loss + loc_loss / self.scanpath_length
 
         self.rfmodule.params.disable = False
         logits = self.model(images)
@@ -656,7 +655,7 @@ class FixationAwareAPGDAttack(APGD):
         adv = x.clone()
         acc = self.model(x).max(1)[1] == y
         loss = -1e10 * torch.ones_like(acc).float()
-        target_scanpaths = torch.zeros((x_in.shape[0], self.scanpath_length, 2)).long()
+        target_scanpaths = torch.zeros((x_in.shape[0], self.scanpath_length, 2), dtype=torch.long, device=x.device)
         if self.verbose:
             print('-------------------------- running {}-attack with epsilon {:.4f} --------------------------'.format(self.norm, self.eps))
             print('initial accuracy: {:.2%}'.format(acc.float().mean()))
@@ -665,6 +664,9 @@ class FixationAwareAPGDAttack(APGD):
         if not best_loss:
             torch.random.manual_seed(self.seed)
             torch.cuda.random.manual_seed(self.seed)
+            # the scanpaths sampled for a batch must not depend on the batches before it
+            for g in self._fixation_generators.values():
+                g.manual_seed(self.seed)
             
             if not cheap:
                 raise ValueError('not implemented yet')
@@ -687,7 +689,7 @@ class FixationAwareAPGDAttack(APGD):
                         adv[ind_to_fool[loss_improved_idx]] = adv_curr[loss_improved_idx].clone()
                         loss[ind_to_fool[loss_improved_idx]] = loss_curr[loss_improved_idx].clone()
 
-                        scanpath_array = torch.LongTensor([[list(loc) for loc in sp] for sp in scanpaths_in])
+                        scanpath_array = scanpaths_in
                         target_scanpaths[ind_to_fool[loss_improved_idx]] = scanpath_array[loss_improved_idx]
                         if self.verbose:
                             print('restart {} - robust accuracy: {:.2%} - cum. time: {:.1f} s'.format(
@@ -0,0 +1,213 @@
+'''
+Sharded storage for precomputed fixation maps. Instead of one .npz file per image, the
+maps are stored back to back in flat .npy shards holding shard_size maps each, which
+are memory-mapped when reading. An index maps the key of each sample (label/filename
+without extension, as in save_fixation_maps.py) to its shard, offset and shape. Maps
+can be stored as float16 or quantized to uint8 with a per-map affine scale.
+
+Conversion from a directory of .npz files:
+
+    python -m rblur.fixation_prediction.fixation_map_store --npz_root <dir> --store_root <dir>
+
+The datasets with precomputed fixation maps read from the store instead of the .npz
+files when the store of every split exists under the fixation_map_root passed to
+get_dataset_params, i.e. {fixation_map_root}/{split}/shards as in save_fixation_maps.py.
+'''
+from argparse import ArgumentParser
+from copy import copy
+import os
+import numpy as np
+import torch
+from tqdm import tqdm
+from mllib.datasets.dataset_factory import ImageDatasetFactory, SupportedDatasets
+from rblur.utils import load_pickle, write_pickle
+
+def get_sample_key(fn):
+    [label, fn] = fn.split('/')[-2:]
+    return f'{label}/{fn.split(".")[0]}'
+
+class FixationMapShardWriter:
+    def __init__(self, root, shard_size=512, dtype='float16') -> None:
+        if dtype not in ['float16', 'uint8']:
+            raise ValueError(f'dtype must be float16 or uint8 but got {dtype}')
+        self.root = root
+        self.index_path = f'{root}/index.pkl'
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(self.index_path):
+            self.index = load_pickle(self.index_path)
+            if self.index['dtype'] != dtype:
+                raise ValueError(f'the existing store has dtype {self.index["dtype"]} but dtype={dtype} was given')
+        else:
+            self.index = {'dtype': dtype, 'shards': [], 'samples': {}}
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self._buffer = []
+        self._entries = {}
+        self._offset = 0
+
+    def __contains__(self, key):
+        return (key in self.index['samples']) or (key in self._entries)
+
+    def __len__(self):
+        return len(self.index['samples']) + len(self._entries)
+
+    def _quantize(self, fmap):
+        if self.dtype == 'float16':
+            return fmap.astype(np.float16), 0., 1.
+        lo, hi = float(fmap.min()), float(fmap.max())
+        scale = (hi - lo) / 255 if hi > lo else 1.
+        return np.round((fmap - lo) / scale).astype(np.uint8), lo, scale
+
+    def add(self, key, fmap, label):
+        fmap = np.asarray(fmap, dtype=np.float32).squeeze()
+        q, lo, scale = self._quantize(fmap)
+        shard_idx = len(self.index['shards'])
+        self._entries[key] = (shard_idx, self._offset, fmap.shape[0], fmap.shape[1], int(label), lo, scale)
+        self._buffer.append(q.reshape(-1))
+        self._offset += q.size
+        if len(self._entries) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        # Writes the buffered maps to a new shard and then updates the index, so that an
+        # interrupted write never leaves the index pointing to a missing shard.
+        if len(self._entries) == 0:
+            return
+        shard_name = f'shard_{len(self.index["shards"]):06d}.npy'
+        tmp_path = f'{self.root}/{shard_name}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.concatenate(self._buffer))
+        os.replace(tmp_path, f'{self.root}/{shard_name}')
+        self.index['shards'].append(shard_name)
+        self.index['samples'].update(self._entries)
+        write_pickle(self.index, f'{self.index_path}.tmp')
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+        self._buffer = []
+        self._entries = {}
+        self._offset = 0
+
+    def close(self):
+        self.flush()
+
+class FixationMapStore:
+    # Random-access reader for a store written by FixationMapShardWriter. Shards are
+    # memory-mapped lazily, so the store can be shared by DataLoader workers.
+    def __init__(self, root) -> None:
+        self.root = root
+        self.index = load_pickle(f'{root}/index.pkl')
+        self._shards = {}
+
+    def __contains__(self, key):
+        return key in self.index['samples']
+
+    def __len__(self):
+        return len(self.index['samples'])
+
+    def keys(self):
+        return self.index['samples'].keys()
+
+    def _get_shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = np.load(f'{self.root}/{self.index["shards"][i]}', mmap_mode='r')
+        return self._shards[i]
+
+    def __getstate__(self):
+        # memory maps are not pickled, each worker opens its own
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def get(self, key):
+        shard_idx, offset, h, w, label, lo, scale = self.index['samples'][key]
+        fmap = np.asarray(self._get_shard(shard_idx)[offset:offset+h*w], dtype=np.float32).reshape(h, w)
+        if self.index['dtype'] == 'uint8':
+            fmap = fmap * scale + lo
+        return fmap, label
+
+class FixationMapDataset(torch.utils.data.Dataset):
+    '''
+    Pairs the samples of an image dataset that returns (x, y) and has a samples attribute
+    containing the image paths (e.g. an ImageFolder) with their fixation maps from a
+    FixationMapStore. Returns (x, y, m) where m is a (1, h, w) tensor, as expected by
+    the trainers of the fixation prediction models.
+    '''
+    def __init__(self, dataset, store_root, fmap_transform=None) -> None:
+        super().__init__()
+        self.dataset = dataset
+        self.store = FixationMapStore(store_root)
+        self.fmap_transform = fmap_transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _get_path(self, i):
+        ds = self.dataset
+        while isinstance(ds, torch.utils.data.Subset):
+            i = ds.indices[i]
+            ds = ds.dataset
+        s = ds.samples[i]
+        return s[0] if isinstance(s, tuple) else s
+
+    def __getitem__(self, i):
+        x, y = self.dataset[i]
+        fmap, _ = self.store.get(get_sample_key(self._get_path(i)))
+        m = torch.from_numpy(fmap).unsqueeze(0)
+        if self.fmap_transform is not None:
+            m = self.fmap_transform(m)
+        return x, y, m
+
+# datasets with precomputed fixation maps and the image datasets they are built on
+_IMAGE_ONLY_DATASETS = {
+    SupportedDatasets.ECOSET10wFIXATIONMAPS_FOLDER: SupportedDatasets.ECOSET10_FOLDER,
+    SupportedDatasets.ECOSET100wFIXATIONMAPS_FOLDER: SupportedDatasets.ECOSET100_FOLDER,
+}
+# store split of the train, val and test datasets. The validation images are held out
+# from the train split.
+_STORE_SPLITS = ('train', 'train', 'test')
+
+def get_store_root(fixation_map_root, split):
+    return f'{fixation_map_root}/{split}/shards'
+
+def has_fixation_map_store(fixation_map_root):
+    return all(os.path.exists(f'{get_store_root(fixation_map_root, split)}/index.pkl') for split in set(_STORE_SPLITS))
+
+class FixationMapStoreDatasetFactory(ImageDatasetFactory):
+    # Builds the image dataset underlying a dataset with precomputed fixation maps and
+    # pairs its samples with the maps in the stores under fixation_map_root.
+    @classmethod
+    def get_image_dataset(cls, params):
+        if params.dataset not in _IMAGE_ONLY_DATASETS:
+            raise ValueError(f'fixation map stores are not supported for {params.dataset}')
+        kwargs = dict(params.kwargs)
+        fixation_map_root = kwargs.pop('fixation_map_root')
+        fmap_transform = kwargs.pop('fmap_transform', None)
+        p = copy(params)
+        p.cls = ImageDatasetFactory
+        p.dataset = _IMAGE_ONLY_DATASETS[params.dataset]
+        p.kwargs = kwargs
+        *datasets, nclasses = ImageDatasetFactory.get_image_dataset(p)
+        datasets = [FixationMapDataset(ds, get_store_root(fixation_map_root, split), fmap_transform)
+                        for ds, split in zip(datasets, _STORE_SPLITS)]
+        return (*datasets, nclasses)
+
+def convert_npz_dir_to_store(npz_root, store_root, shard_size=512, dtype='float16'):
+    writer = FixationMapShardWriter(store_root, shard_size=shard_size, dtype=dtype)
+    files = sorted(f'{d}/{fn}' for d, _, fns in os.walk(npz_root) for fn in fns if fn.endswith('.npz'))
+    for fn in tqdm(files):
+        key = get_sample_key(fn)
+        if key in writer:
+            continue
+        data = np.load(fn)
+        writer.add(key, data['fixation_probs'], data['label'])
+    writer.close()
+    return writer
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--npz_root', type=str, required=True)
+    parser.add_argument('--store_root', type=str, required=True)
+    parser.add_argument('--shard_size', type=int, default=512)
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'uint8'])
+    args = parser.parse_args()
+    writer = convert_npz_dir_to_store(args.npz_root, args.store_root, args.shard_size, args.dtype)
+    print(f'{len(writer)} fixation maps in {args.store_root}')
@@ -22,10 +22,35 @@ from einops import rearrange
 
 from rblur.models import CommonModelParams, ConvEncoder, XResNet34, convbnrelu, bnrelu
 from rblur.retina_blur2 import RetinaBlurFilter as RBlur2
+from rblur.retina_preproc import RetinaBlurFilter
 import deepgaze_pytorch
 from pathlib import Path
 import os
 
+# location of the MIT1003 center bias of DeepGaze. Can be overridden with the
+# DEEPGAZE_CENTERBIAS environment variable or the centerbias_path parameter of the
+# fixation predictors.
+DEFAULT_CENTERBIAS_PATH = os.environ.get('DEEPGAZE_CENTERBIAS', str(Path.home() / 'projects/adversarialML/biologically_inspired_models/DeepGaze/centerbias_mit1003.npy'))
+_CENTERBIAS_TEMPLATES = {}
+
+def gaussian_centerbias(h=1024, w=1024, std_frac=0.25):
+    # log-density of a Gaussian centered in the image, with stds proportional to the
+    # height and width, used when the MIT1003 center bias is not available.
+    rows = (torch.arange(h, dtype=torch.float32) - (h-1)/2) / (std_frac * h)
+    cols = (torch.arange(w, dtype=torch.float32) - (w-1)/2) / (std_frac * w)
+    cb = -0.5 * (rows.unsqueeze(1)**2 + cols.unsqueeze(0)**2)
+    return cb - torch.logsumexp(cb.reshape(-1), 0)
+
+def load_centerbias_template(path=None):
+    path = str(path or DEFAULT_CENTERBIAS_PATH)
+    if path not in _CENTERBIAS_TEMPLATES:
+        if os.path.exists(path):
+            _CENTERBIAS_TEMPLATES[path] = torch.FloatTensor(np.load(path))
+        else:
+            print(f'center bias not found at {path}, using a Gaussian center bias instead')
+            _CENTERBIAS_TEMPLATES[path] = gaussian_centerbias()
+    return _CENTERBIAS_TEMPLATES[path].clone()
+
 def convert_image_tensor_to_ndarray(img):
     return img.cpu().detach().transpose(0,1).transpose(1,2).numpy()
 
@@ -245,18 +270,36 @@ class BaseFixationPredictor(AbstractModel):
         pretrained: bool = True
         min_image_dim: int = 768
         fixation_width_frac: float = 0.1
+        # if set, the smaller side of the image is rescaled to inference_image_dim,
+        # instead of min_image_dim, in eval mode. Lower values trade the accuracy of the
+        # fixation maps for speed (see calibrate_fixation_resolution.py).
+        inference_image_dim: int = None
+        # number of fixation maps to keep in an LRU cache keyed by a fingerprint of the
+        # image, so that maps of images seen again are not recomputed in eval mode. The
+        # cache is disabled if fmap_cache_size is 0, and it is not used by predictors with
+        # an mFeatureExtractor, whose classifier output must be computed on every call.
+        fmap_cache_size: int = 0
+        fmap_cache_max_mb: float = np.inf
+        # path to the center bias (a log-density saved as .npy). A Gaussian center bias is
+        # used if the file does not exist. Defaults to DEFAULT_CENTERBIAS_PATH.
+        centerbias_path: str = None
 
     def __init__(self, params: ModelParams) -> None:
         super().__init__(params)
         print(params)
         self.random_fixation_prob = params.random_fixation_prob
         self.loc_sampling_temperature = params.loc_sampling_temperature
-        self.centerbias_template = nn.parameter.Parameter(torch.FloatTensor(np.load(Path.home() / 'projects/adversarialML/biologically_inspired_models/DeepGaze/centerbias_mit1003.npy')), requires_grad=False)
+        self.centerbias_template = nn.parameter.Parameter(load_centerbias_template(params.centerbias_path), requires_grad=False)
+        # center bias resized to each input size, keyed by (h, w, device, dtype)
+        self._centerbias_cache = {}
+        self._centerbias_version = None
         self.mask_past_fixations = params.mask_past_fixations
         self.last_input_image = None
         self.last_fixation_map = None
+        self.last_image_hash = None
         self.always_recompute_fmap = params.always_recompute_fmap
         self.min_image_dim = params.min_image_dim
+        self.fmap_cache = FixationMapCache(params.fmap_cache_size, params.fmap_cache_max_mb * 2**20)
         self._make_network()
         self.reset_history()
     
@@ -284,9 +327,7 @@ class BaseFixationPredictor(AbstractModel):
     def update_mask(self, fidx):
         if not self.mask_past_fixations:
             return
-        fidx_set = set(fidx.long().cpu().detach().numpy().tolist())
-        for fi in fidx_set:
-            self._update_mask(fi, (fidx == fi))
+        self.mask = stamp_inhibition_of_return(self.mask, fidx, self.mask_kernel)
     
     def create_mask(self, fmap):
         def gkern(kernlen=256, std=128):
@@ -311,17 +352,83 @@ class BaseFixationPredictor(AbstractModel):
             self.mask_kernel = 1-gkern(ks, std) + 1e-8
         self.mask_kernel = self.mask_kernel.to(fmap.device)
 
+    def train(self, mode: bool = True):
+        # the cached maps are stale once the weights are updated
+        if mode:
+            self.fmap_cache.clear()
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.fmap_cache.clear()
+        self._centerbias_cache.clear()
+        return super().load_state_dict(*args, **kwargs)
+
+    def get_centerbias(self, h, w):
+        # returns the center bias resized to (h, w) and normalized, computing it only the
+        # first time it is requested for a given size, device and dtype. The cache is
+        # invalidated if the template is modified in-place (e.g. a checkpoint is loaded).
+        template = self.centerbias_template
+        if self._centerbias_version != template._version:
+            self._centerbias_cache.clear()
+            self._centerbias_version = template._version
+        key = (h, w, template.device, template.dtype)
+        if key not in self._centerbias_cache:
+            with torch.no_grad():
+                centerbias = torch.nn.functional.interpolate(template.unsqueeze(0).unsqueeze(0),
+                                                            size=(h, w),
+                                                            mode='nearest').squeeze(1)
+                # normalize the centerbias
+                centerbias -= torch.logsumexp(centerbias.reshape(-1), 0)
+            self._centerbias_cache[key] = centerbias
+        return self._centerbias_cache[key]
+
+    def _can_use_fmap_cache(self, image):
+        return (self.fmap_cache.capacity > 0) and (not self.training) and not (torch.is_grad_enabled() and image.requires_grad)
+
+    def _has_side_outputs(self):
+        # mFeatureExtractor keeps the classifier output of the last forward pass, which is
+        # read by MultiFixationTiedBackboneClassifier, so the pass must not be skipped
+        features = getattr(getattr(self, 'fixation_predictor', None), 'features', None)
+        return isinstance(features, mFeatureExtractor)
+
+    def _compute_fixation_map(self, image):
+        image_scaled, centerbias = self.preprocess_image_and_center_bias(image)
+        return self.predict_fixation_map(image_scaled, centerbias)
+
+    def _compute_fixation_map_with_cache(self, image, image_hash):
+        if not self._can_use_fmap_cache(image):
+            return self._compute_fixation_map(image)
+        # the maps also depend on the resolution at which the predictor is run
+        keys = [(tuple(image.shape[1:]), self.get_image_dim(), *h) for h in image_hash.tolist()]
+        fmaps = [self.fmap_cache.get(k) for k in keys]
+        missing = [i for i, f in enumerate(fmaps) if f is None]
+        if len(missing) == len(keys):
+            fixation_map = self._compute_fixation_map(image)
+            for k, f in zip(keys, fixation_map):
+                self.fmap_cache.put(k, f)
+            return fixation_map
+        if len(missing) > 0:
+            new_fmaps = self._compute_fixation_map(image[missing])
+            for i, f in zip(missing, new_fmaps):
+                self.fmap_cache.put(keys[i], f)
+                fmaps[i] = f
+        return torch.stack(fmaps, 0)
+
+    def set_inference_image_dim(self, dim):
+        self.params.inference_image_dim = dim
+
+    def get_image_dim(self):
+        if self.training or (self.params.inference_image_dim is None):
+            return self.min_image_dim
+        return self.params.inference_image_dim
+
     def preprocess_image_and_center_bias(self, image):
-        sf = self.min_image_dim / min(image.shape[2:])        
+        sf = self.get_image_dim() / min(image.shape[2:])
         # scale and resize image and center bias to match training regime
         image = image * 255
         if sf != 1:
             image = torch.nn.functional.interpolate(image, scale_factor=sf)
-        centerbias = torch.nn.functional.interpolate(self.centerbias_template.unsqueeze(0).unsqueeze(0),
-                                                    size=(image.shape[2], image.shape[3]),
-                                                    mode='nearest').squeeze(1)
-        # normalize the centerbias
-        centerbias -= torch.logsumexp(centerbias.reshape(-1), 0)
+        centerbias = self.get_centerbias(image.shape[2], image.shape[3])
         return image, centerbias
     
     def postprocess_fixation_map(self, fixation_map, orig_image_size):
@@ -329,7 +436,7 @@ class BaseFixationPredictor(AbstractModel):
         sf = min(orig_image_size) / min(fixation_map.shape[2:])
         if sf != 1:
             fixation_map = torch.nn.functional.interpolate(fixation_map, scale_factor=sf)
-        fixation_map += self.mask.log()
+        fixation_map = fixation_map + self.mask.log()
         return fixation_map
     
     def predict_fixation_map(self, image, centerbias):
@@ -349,8 +456,8 @@ class BaseFixationPredictor(AbstractModel):
         fidx = masked_flat_prob_map.mm(index_tensor).squeeze(-1).int()
         
         rand_fidx = torch.randint_like(fidx, masked_flat_prob_map.shape[1])
-        rand_idx = (torch.rand(fidx.shape[0]) < self.random_fixation_prob)
-        fidx[rand_idx] = rand_fidx[rand_idx]
+        rand_idx = (torch.rand(fidx.shape[0], device=fidx.device) < self.random_fixation_prob)
+        fidx = torch.where(rand_idx, rand_fidx, fidx)
         return fidx
     
     def forward(self, image, last_fixation_point=None):
@@ -360,21 +467,22 @@ class BaseFixationPredictor(AbstractModel):
             self.reset_history()
             self.create_mask(image)
             self.hist = self.hist.repeat_interleave(image.shape[0], 0)
-            self.last_fixation_map = self.last_image = None
+            self.last_fixation_map = self.last_image_hash = None
         else:
             self.update_history(last_fixation_point)
         
         self.update_mask(self.hist.data[:,-1])
         
-        if (not self.always_recompute_fmap) and (self.last_fixation_map is not None) and (self.last_image == image).cpu().detach().numpy().all():
-            fixation_map = self.last_fixation_map
+        if self.always_recompute_fmap or self._has_side_outputs():
+            fixation_map = self._compute_fixation_map(image)
         else:
-            image_scaled, centerbias = self.preprocess_image_and_center_bias(image)
-            fixation_map = self.predict_fixation_map(image_scaled, centerbias)
-        
-        if not self.always_recompute_fmap:
+            image_hash = hash_images(image)
+            if (self.last_fixation_map is not None) and (self.last_image_hash.shape == image_hash.shape) and torch.equal(self.last_image_hash, image_hash):
+                fixation_map = self.last_fixation_map
+            else:
+                fixation_map = self._compute_fixation_map_with_cache(image, image_hash)
             self.last_fixation_map = fixation_map
-            self.last_image = image
+            self.last_image_hash = image_hash
         
         fixation_map = self.postprocess_fixation_map(fixation_map, (h,w))
 
@@ -667,7 +775,6 @@ class CustomBackboneDeepGazeIII(BaseFixationPredictor):
 class DeepGazeIIE(BaseFixationPredictor):
     def __init__(self, params: BaseFixationPredictor.ModelParams) -> None:
         super().__init__(params)
-        self.centerbias_template = nn.parameter.Parameter(torch.FloatTensor(np.load('/home/mshah1/projects/adversarialML/biologically_inspired_models/DeepGaze/centerbias_mit1003.npy')), requires_grad=False)
     
     def _make_network(self):
         self.fixation_predictor = deepgaze_pytorch.DeepGazeIIE(self.params.pretrained)
@@ -880,6 +987,68 @@ class FixationPredictionNetwork(BaseFixationPredictor):
         # else:
         #     return loss
 
+class DistilledFixationPredictor(BaseFixationPredictor):
+    '''
+    Lightweight fixation predictor trained to match the fixation maps of a DeepGaze
+    model (see FixationDistillationTrainer). The student network predicts the log-density
+    at a lower resolution than DeepGaze, and since it implements the BaseFixationPredictor
+    interface it can be used as the fixation_model of RetinaFilterWithFixationPrediction.
+    '''
+    @define(slots=False)
+    class ModelParams(BaseFixationPredictor.ModelParams):
+        arch: Literal['unet', 'deeplab3p', 'gala'] = 'unet'
+        num_filters: List[int] = field(factory=lambda: [16, 32, 64, 128, 256])
+        min_image_dim: int = 224
+        distillation_temperature: float = 1.
+        num_agreement_fixations: int = 5
+        agreement_downsample_factor: int = 16
+
+    def _make_network(self):
+        if self.params.arch == 'unet':
+            self.fixation_predictor = UNet(num_filters=self.params.num_filters)
+        elif self.params.arch == 'deeplab3p':
+            backbone = IntermediateLayerGetter(resnet18(), {'layer1':'low_level_feats', 'layer4':'out'})
+            self.fixation_predictor = DeepLab3p(backbone, 1)
+        elif self.params.arch == 'gala':
+            backbone = IntermediateLayerGetter(resnet18(), {'layer3':'out'})
+            self.fixation_predictor = GALA(backbone)
+        else:
+            raise ValueError(f'arch must be one of unet, deeplab3p or gala but got {self.params.arch}')
+
+    def predict_fixation_map(self, image, centerbias):
+        b,c,h,w = image.shape
+        x = image / 255
+        # the UNet downsamples 4 times so the input is resized to a multiple of 32
+        size = [int(math.ceil(s / 32)) * 32 for s in (h, w)]
+        if size != [h, w]:
+            x = nn.functional.interpolate(x, size=size, mode='bilinear', align_corners=False)
+        logits = self.fixation_predictor(x)
+        logits = nn.functional.interpolate(logits, size=(h, w), mode='bilinear', align_corners=False)
+        logits = logits + centerbias.unsqueeze(1)
+        return torch.log_softmax(torch.flatten(logits, 1), 1).reshape(b, 1, h, w)
+
+    def compute_loss(self, image, target_fmap, return_logits=True):
+        # KL divergence between the fixation densities of the teacher (target_fmap, a
+        # log-density) and the student
+        fmap = self.forward(image)
+        while target_fmap.dim() < 4:
+            target_fmap = target_fmap.unsqueeze(1)
+        target_fmap = target_fmap.to(fmap.dtype)
+        if target_fmap.shape[2:] != fmap.shape[2:]:
+            target_fmap = nn.functional.interpolate(target_fmap, size=fmap.shape[2:], mode='bilinear', align_corners=False)
+        T = self.params.distillation_temperature
+        log_p = torch.log_softmax(torch.flatten(target_fmap, 1) / T, 1)
+        log_q = torch.log_softmax(torch.flatten(fmap, 1) / T, 1)
+        loss = (log_p.exp() * (log_p - log_q)).sum(1).mean() * T**2
+
+        if return_logits:
+            return fmap, loss
+        else:
+            return loss
+
+    def fixation_agreement(self, fmap, target_fmap):
+        return topk_fixation_agreement(fmap, target_fmap, self.params.num_agreement_fixations, self.params.agreement_downsample_factor)
+
 class DenseNet(nn.Module):
     def __init__(self, inchannels, outchannels, kernel_size, nlayers) -> None:
         super().__init__()
@@ -995,6 +1164,118 @@ def _update_mask(fi, I, hks, mask, mask_kernel):
     mask[I] = M
     return mask
 
+def stamp_inhibition_of_return(mask, fidx, mask_kernel):
+    '''
+    Vectorized equivalent of calling _update_mask for every sample. mask[i] is multiplied
+    by mask_kernel centered at the flattened index fidx[i], clipped at the borders. The
+    factor at each pixel is gathered from the kernel using its offset from the fixation,
+    and is 1 outside the kernel, so the cost is O(n*h*w) regardless of the kernel size.
+    '''
+    n, _, h, w = mask.shape
+    kh, kw = mask_kernel.shape
+    fidx = fidx.long().view(-1, 1).to(mask.device)
+    rows = torch.arange(h, device=mask.device).view(1, h) - fidx // w + kh//2
+    cols = torch.arange(w, device=mask.device).view(1, w) - fidx % w + kw//2
+    inside = ((rows >= 0) & (rows < kh)).unsqueeze(2) & ((cols >= 0) & (cols < kw)).unsqueeze(1)
+    kernel = mask_kernel.to(device=mask.device, dtype=mask.dtype)
+    factor = kernel[rows.clamp(0, kh-1).unsqueeze(2), cols.clamp(0, kw-1).unsqueeze(1)]
+    factor = torch.where(inside, factor, torch.ones_like(factor))
+    return mask * factor.unsqueeze(1)
+
+def select_topk_fixations(fmap, K, mask_kernel):
+    # greedily selects the K most likely fixations in fmap, applying inhibition of return
+    # around each of them. Returns the (N, K) flat indices of the fixations.
+    mask = torch.ones_like(fmap)
+    fidxs = []
+    for k in range(K):
+        fidx = torch.flatten(fmap + mask.log(), 1).argmax(1)
+        fidxs.append(fidx)
+        if k < K-1:
+            mask = stamp_inhibition_of_return(mask, fidx, mask_kernel)
+    return torch.stack(fidxs, 1)
+
+def topk_fixation_agreement(fmap, target_fmap, K, downsample_factor=16):
+    '''
+    Fraction of the top-K fixations selected from fmap that are also among the top-K
+    fixations selected from target_fmap. Fixations are selected on a grid with cells
+    of downsample_factor x downsample_factor pixels, as in RetinaFilterWithFixationPrediction.
+    '''
+    while target_fmap.dim() < 4:
+        target_fmap = target_fmap.unsqueeze(1)
+    target_fmap = target_fmap.to(fmap.dtype)
+    if target_fmap.shape[2:] != fmap.shape[2:]:
+        target_fmap = nn.functional.interpolate(target_fmap, size=fmap.shape[2:], mode='bilinear', align_corners=False)
+    if downsample_factor > 1:
+        fmap = nn.functional.avg_pool2d(fmap, downsample_factor, stride=downsample_factor)
+        target_fmap = nn.functional.avg_pool2d(target_fmap, downsample_factor, stride=downsample_factor)
+    h, w = fmap.shape[2:]
+    std = max(h,w) / 10
+    ks = int(4*std)
+    ks += int((ks % 2) == 0)
+    mask_kernel = (1-unnormalized_gkern(ks, std) + 1e-8).to(fmap.device)
+    fidxs = select_topk_fixations(fmap, K, mask_kernel)
+    target_fidxs = select_topk_fixations(target_fmap, K, mask_kernel)
+    return (fidxs.unsqueeze(2) == target_fidxs.unsqueeze(1)).any(2).float().mean()
+
+_HASH_PROJECTIONS = {}
+
+def hash_images(images: torch.Tensor) -> torch.Tensor:
+    '''
+    Cheap per-sample fingerprint of a batch of images, computed on the device of the
+    images. Each sample is projected onto two fixed random vectors in float64, which
+    differ for any two distinct images except with negligible probability, including
+    images that differ by a small (e.g. adversarial) perturbation. Returns a (n, 2) tensor.
+    '''
+    n = images.shape[0]
+    d = images[0].numel()
+    key = (d, images.device)
+    if key not in _HASH_PROJECTIONS:
+        g = torch.Generator().manual_seed(d)
+        _HASH_PROJECTIONS[key] = torch.rand(d, 2, generator=g, dtype=torch.float64).add_(0.5).to(images.device)
+    return images.detach().reshape(n, d).double() @ _HASH_PROJECTIONS[key]
+
+class FixationMapCache:
+    '''
+    LRU cache of fixation maps keyed by the fingerprints of the images (see hash_images)
+    so that the maps of images that have already been seen, e.g. the clean images during
+    evaluation or while running several attacks, are not recomputed. Entries are evicted
+    when there are more than capacity maps or they occupy more than max_bytes.
+    '''
+    def __init__(self, capacity: int, max_bytes: float = np.inf) -> None:
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, key):
+        fmap = self.entries.get(key, None)
+        if fmap is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return fmap
+
+    def put(self, key, fmap):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        # clone so that the cache does not keep the whole batch alive
+        fmap = fmap.detach().clone()
+        self.entries[key] = fmap
+        self.nbytes += fmap.nbytes
+        while (len(self.entries) > self.capacity) or ((self.nbytes > self.max_bytes) and (len(self.entries) > 0)):
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+
 def unnormalized_gkern(kernlen=256, std=128):
     def gaussian_fn(M, std):
         n = torch.cat([torch.arange(M//2,-1,-1), torch.arange(1, M//2+1)])
@@ -1027,6 +1308,10 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
         disable: bool = False
         return_fixation_maps: bool = False
         return_fixated_images: bool = True
+        # 'sequential' recomputes the fixation map on the image foveated at the previous
+        # fixation for each of the K fixations. 'one_shot' selects all K fixations from a
+        # single fixation map (see get_one_shot_scanpath), which is faster but approximate.
+        scanpath_mode: Literal['sequential', 'one_shot'] = 'sequential'
     
     def __init__(self, params: ModelParams) -> None:
         super().__init__(params)
@@ -1107,14 +1392,13 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
         std = max(h,w) / 10
         ks = int(4*std) 
         ks += int((ks % 2) == 0)
-        hks = ks // 2
         mask = torch.ones((n,1,h,w), device=fmap.device)
         mask_kernel = 1-unnormalized_gkern(ks, std) + 1e-8
         mask_kernel = mask_kernel.to(fmap.device)
         # print(fmap.shape, mask.shape, self.mask_kernel.shape)
         
         if not self.params.salience_map_provided_as_input_channel:
-            _update_mask(0, torch.arange(mask.shape[0]), hks, mask, mask_kernel)
+            mask = stamp_inhibition_of_return(mask, torch.zeros(n, dtype=torch.long, device=fmap.device), mask_kernel)
 
         fxrows = []
         fxcols = []
@@ -1127,8 +1411,8 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
                 fidx = masked_flat_prob_map.mm(index_tensor).squeeze(-1).int()
                 
                 rand_fidx = torch.randint_like(fidx, masked_flat_prob_map.shape[1])
-                rand_idx = (torch.rand(fidx.shape[0]) < self.params.random_fixation_prob)
-                fidx[rand_idx] = rand_fidx[rand_idx]
+                rand_idx = (torch.rand(fidx.shape[0], device=fidx.device) < self.params.random_fixation_prob)
+                fidx = torch.where(rand_idx, rand_fidx, fidx)
             else:
                 fidx = torch.flatten(fmap, 1).argmax(1)
             # masked_prob_map = prob_map * mask
@@ -1145,9 +1429,7 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
             fxcols.append(fidx % fmap.shape[3])
             # print(k, fxrows[-1], fxcols[-1])
             if K > 1:
-                fidx_set = set(fidx.cpu().detach().numpy().tolist())
-                for fi in fidx_set:
-                    _update_mask(fi, (fidx == fi), hks, mask, mask_kernel)
+                mask = stamp_inhibition_of_return(mask, fidx, mask_kernel)
                 # top, bot, left, right = fxrows[-1]-hks, fxrows[-1]+hks+1, fxcols[-1]-hks, fxcols[-1]+hks+1
                 # ktop, kleft = torch.relu(-top), torch.relu(-left)
                 # kbot = self.mask_kernel.shape[0] - torch.relu(bot - mask.shape[2])
@@ -1196,11 +1478,106 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
             if isinstance(self.retina, RBlur2):
                 rows = torch.relu(self.loc_offset - rows)
                 cols = torch.relu(self.loc_offset - cols)
-            locs = torch.stack([rows, cols], -1).detach().cpu()
+            locs = torch.stack([rows, cols], -1).detach()
             # locs = list(zip(rows, cols))
         return locs
+
+    def apply_retina_at_locs(self, x, locs):
+        # locs is a (N, 2) tensor containing the fixation point of each image in x.
+        # RBlur can foveate each image at its own location in a single call, other
+        # retinas are called once per unique location. The location of the retina is
+        # restored afterwards, so that later calls do not reuse the per-sample locations.
+        prev_loc = self.retina.params.loc
+        try:
+            if isinstance(self.retina, (RetinaBlurFilter, RBlur2)):
+                self.retina.params.loc = locs
+                return self.retina(x)
+            locs = locs.cpu().numpy()
+            loc_set = list(set([tuple(l) for l in locs]))
+            x_out = torch.zeros_like(x)
+            for loc in loc_set:
+                I = (locs == np.array(loc)).all(1)
+                self.retina.params.loc = loc
+                x_out[I] = self.retina(x[I])
+            return x_out
+        finally:
+            self.retina.params.loc = prev_loc
     
+    def _apply_retina_at_center(self, x):
+        if not self.params.apply_retina_before_fixation:
+            return x
+        if isinstance(self.retina, RBlur2):
+            # self.retina.params.loc = tuple(self.loc_offset - np.array(x.shape[2:])//2)
+            self.retina.params.loc = (self.loc_offset, self.loc_offset)
+        else:
+            # self.retina.params.loc = tuple(np.array(x.shape[2:])//2)
+            self.retina.params.loc = (0,0)
+        return self.retina(x)
+
+    def _sample_fixation(self, fmap):
+        # returns the flat index, row and column of the next fixation in fmap
+        fmap_ds = self._maybe_downsample_fmap(fmap)
+        downsample_factor = self.params.target_downsample_factor
+        
+        if hasattr(self.fixation_model, 'sample_fixation'):
+            fidx_ds = self.fixation_model.sample_fixation(fmap_ds)
+        else:
+            if self.training:
+                masked_flat_prob_map = gumbel_softmax(torch.flatten(fmap_ds, 1), tau=self.params.loc_sampling_temp, hard=True)
+            else:
+                soft_masked_flat_prob_map = torch.softmax(torch.flatten(fmap_ds, 1), 1)
+                index = soft_masked_flat_prob_map.max(1, keepdim=True)[1]
+                hard_masked_flat_prob_map = torch.zeros_like(soft_masked_flat_prob_map, memory_format=torch.legacy_contiguous_format).scatter_(1, index, 1.0)
+                masked_flat_prob_map = hard_masked_flat_prob_map - soft_masked_flat_prob_map.detach() + soft_masked_flat_prob_map
+
+            index_tensor = torch.arange(masked_flat_prob_map.shape[1], dtype=masked_flat_prob_map.dtype, device=masked_flat_prob_map.device).unsqueeze(1)
+            fidx_ds = masked_flat_prob_map.mm(index_tensor).squeeze(-1).int()
+        
+        if self.training:
+            rand_fidx = torch.randint_like(fidx_ds, torch.flatten(fmap_ds, 1).shape[1])
+            rand_idx = (torch.rand(fidx_ds.shape[0], device=fidx_ds.device) < self.params.random_fixation_prob)
+            fidx_ds = torch.where(rand_idx, rand_fidx, fidx_ds)
+
+        frow = (fidx_ds // fmap_ds.shape[3]) * downsample_factor + downsample_factor//2
+        fcol = (fidx_ds % fmap_ds.shape[3]) * downsample_factor + downsample_factor//2
+        fidx = frow * fmap.shape[3] + fcol
+        return fidx, frow, fcol
+
+    def get_one_shot_scanpath(self, x):
+        '''
+        Approximates the sequential scanpath computed in get_fixations_from_model with a
+        single pass of the fixation model. All K fixations are selected from the fixation
+        map of the centrally foveated image, with inhibition of return applied to it after
+        each fixation as the fixation model would, instead of recomputing the map on the
+        image foveated at the previous fixation. Returns the preprocessed images, the (N, K, 2)
+        fixation points, and the (N, K, h, w) fixation maps after each step of masking.
+        '''
+        x = self.preprocess(x)
+        K = self.params.num_train_fixation_points if self.training else self.params.num_eval_fixation_points
+        fmap = self.fixation_model(self._apply_retina_at_center(x))
+        mask_kernel = getattr(self.fixation_model, 'mask_kernel', None)
+        if not getattr(self.fixation_model, 'mask_past_fixations', True):
+            mask_kernel = None
+        fmaps = []
+        locs = []
+        for k in range(K):
+            fmaps.append(fmap)
+            fidx, frow, fcol = self._sample_fixation(fmap)
+            locs.append(torch.stack([frow, fcol], 1))
+            if (k < K-1) and (mask_kernel is not None):
+                fmap = fmap + stamp_inhibition_of_return(torch.ones_like(fmap), fidx, mask_kernel).log()
+        return x, torch.stack(locs, 1), torch.cat(fmaps, 1)
+
+    def get_one_shot_fixations_from_model(self, x):
+        # foveates the images at all their fixations in a single call to the retina
+        x, locs, fmaps = self.get_one_shot_scanpath(x)
+        K = locs.shape[1]
+        x_out = self.apply_retina_at_locs(torch.repeat_interleave(x, K, 0), rearrange(locs, 'b k d -> (b k) d'))
+        return x_out, fmaps
+
     def get_fixations_from_model(self, x):
+        if self.params.scanpath_mode == 'one_shot':
+            return self.get_one_shot_fixations_from_model(x)
         x = self.preprocess(x)
         K = self.params.num_train_fixation_points if self.training else self.params.num_eval_fixation_points
         fxidxs = [torch.zeros(x.shape[0], dtype=x.dtype, device=x.device)]
@@ -1213,41 +1590,11 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
             if (k > 0):
                 fmap = self.fixation_model(x_out[:, k-1], fidx)
             else:
-                if self.params.apply_retina_before_fixation:
-                    if isinstance(self.retina, RBlur2):
-                        # self.retina.params.loc = tuple(self.loc_offset - np.array(x.shape[2:])//2)
-                        self.retina.params.loc = (self.loc_offset, self.loc_offset)
-                    else:
-                        # self.retina.params.loc = tuple(np.array(x.shape[2:])//2)
-                        self.retina.params.loc = (0,0)
-                    x_blurred = self.retina(x)
-                else:
-                    x_blurred = x
+                x_blurred = self._apply_retina_at_center(x)
                 fmap = self.fixation_model(x_blurred)
             fmaps.append(fmap)
 
-            fmap_ds = self._maybe_downsample_fmap(fmap)
-            downsample_factor = self.params.target_downsample_factor
-            
-            if hasattr(self.fixation_model, 'sample_fixation'):
-                fidx_ds = self.fixation_model.sample_fixation(fmap_ds)
-            else:
-                if self.training:
-                    masked_flat_prob_map = gumbel_softmax(torch.flatten(fmap_ds, 1), tau=self.params.loc_sampling_temp, hard=True)
-                else:
-                    soft_masked_flat_prob_map = torch.softmax(torch.flatten(fmap_ds, 1), 1)
-                    index = masked_flat_prob_map.max(1, keepdim=True)[1]
-                    hard_masked_flat_prob_map = torch.zeros_like(masked_flat_prob_map, memory_format=torch.legacy_contiguous_format).scatter_(1, index, 1.0)
-                    masked_flat_prob_map = hard_masked_flat_prob_map - soft_masked_flat_prob_map.detach() + soft_masked_flat_prob_map
-                    # fidx_ds = masked_flat_prob_map.argmax(1)
-
-                index_tensor = torch.arange(masked_flat_prob_map.shape[1], dtype=masked_flat_prob_map.dtype, device=masked_flat_prob_map.device).unsqueeze(1)
-                fidx_ds = masked_flat_prob_map.mm(index_tensor).squeeze(-1).int()
-            
-            if self.training:
-                rand_fidx = torch.randint_like(fidx_ds, torch.flatten(fmap_ds, 1).shape[1])
-                rand_idx = (torch.rand(fidx_ds.shape[0]) < self.params.random_fixation_prob)
-                fidx_ds[rand_idx] = rand_fidx[rand_idx]
+            fidx, frow, fcol = self._sample_fixation(fmap)
 
             # if k == 0:
             #     plt.subplot(2, K+1, k+1)
@@ -1272,26 +1619,11 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
             # plt.imshow(convert_image_tensor_to_ndarray(masked_flat_prob_map[0].reshape(*(fmap_ds[0].shape))))
             # plt.axis('off')
 
-            frow = (fidx_ds // fmap_ds.shape[3]) * downsample_factor + downsample_factor//2
-            fcol = (fidx_ds % fmap_ds.shape[3]) * downsample_factor + downsample_factor//2
-            fidx = frow * fmap.shape[3] + fcol
-
             fxidxs.append(fidx)
             fxcols.append(fcol)
             fxrows.append(frow)
 
-            locs = fidx.cpu().detach().numpy()
-            loc_set = set(fidx.cpu().detach().numpy().tolist())
-            x_out_ = x_out[:, k]
-            for loc in loc_set:
-                r = loc // fmap.shape[3]
-                c = loc % fmap.shape[3]
-                # print(loc, (locs == loc))
-                x_ = x[(locs == loc)]
-                self.retina.params.loc = (r,c)
-                x_ = self.retina(x_)
-                x_out_[(locs == loc)] = x_
-            x_out[:, k] = x_out_
+            x_out[:, k] = self.apply_retina_at_locs(x, torch.stack([frow, fcol], 1))
         # plt.subplot(2, K+1, K+2)
         # plt.imshow(convert_image_tensor_to_ndarray(x_out[0].mean(0)))
         x_out = x_out.reshape(-1, *(x_out.shape[2:]))
@@ -1326,17 +1658,10 @@ class RetinaFilterWithFixationPrediction(AbstractModel):
             x = self.preprocess(x)
             locs = self.get_loc_from_fmaps(fixation_maps)
             n_locs_per_img = locs.shape[1]
-            locs = rearrange(locs, 'b n d -> (b n) d').numpy()
-            loc_set = list(set([tuple(l) for l in locs]))
-            loc_set = np.expand_dims(np.array(loc_set), 1)
+            locs = rearrange(locs, 'b n d -> (b n) d')
             if n_locs_per_img > 1:
                 x = torch.repeat_interleave(x, n_locs_per_img, 0)
-            x_out = torch.zeros_like(x)
-            for loc in loc_set:
-                x_ = x[(locs == loc).all(1)]
-                self.retina.params.loc = tuple(loc[0])
-                x_ = self.retina(x_)
-                x_out[(locs == loc).all(1)] = x_
+            x_out = self.apply_retina_at_locs(x, locs)
         else:
             x_out, fixation_maps = self.get_fixations_from_model(x)
         
@@ -1436,7 +1761,29 @@ class MultiFixationTiedBackboneClassifier(RetinaFilterWithFixationPrediction):
         ensembling_mode: Literal['logit_mean', 'prob_sum'] = 'logit_mean'
         return_fixated_images: bool = False
 
+    def get_one_shot_fixations_from_model(self, x):
+        # all the fixated views are classified in one batched pass of the backbone
+        x, locs, fmaps = self.get_one_shot_scanpath(x)
+        n, K = locs.shape[:2]
+        x_out = self.apply_retina_at_locs(torch.repeat_interleave(x, K, 0), rearrange(locs, 'b k d -> (b k) d'))
+        if isinstance(self.fixation_model, CustomBackboneDeepGazeIII) and isinstance(self.fixation_model.fixation_predictor.features, mFeatureExtractor):
+            self.fixation_model(x_out)
+            logits = self.fixation_model.fixation_predictor.features.final_output
+        else:
+            raise NotImplementedError('fixation_model must be CustomBackboneDeepGazeIII')
+        all_logits = rearrange(logits, '(b k) c -> b k c', b=n)
+        return x_out, fmaps, self.ensemble_logits(all_logits)
+
+    def ensemble_logits(self, all_logits):
+        if self.params.ensembling_mode == 'logit_mean':
+            all_logits = all_logits.mean(1)
+        if self.params.ensembling_mode == 'prob_sum':
+            all_logits = torch.log_softmax(all_logits, -1).logsumexp(1)
+        return all_logits
+
     def get_fixations_from_model(self, x):
+        if self.params.scanpath_mode == 'one_shot':
+            return self.get_one_shot_fixations_from_model(x)
         x = self.preprocess(x)
         K = self.params.num_train_fixation_points if self.training else self.params.num_eval_fixation_points
         fxidxs = [torch.zeros(x.shape[0], dtype=x.dtype, device=x.device)]
@@ -1450,16 +1797,7 @@ class MultiFixationTiedBackboneClassifier(RetinaFilterWithFixationPrediction):
             if (k > 0):
                 fmap = self.fixation_model(x_out[:, k-1], fidx)
             else:
-                if self.params.apply_retina_before_fixation:
-                    if isinstance(self.retina, RBlur2):
-                        # self.retina.params.loc = tuple(self.loc_offset - np.array(x.shape[2:])//2)
-                        self.retina.params.loc = (self.loc_offset, self.loc_offset)
-                    else:
-                        # self.retina.params.loc = tuple(np.array(x.shape[2:])//2)
-                        self.retina.params.loc = (0,0)
-                    x_blurred = self.retina(x)
-                else:
-                    x_blurred = x
+                x_blurred = self._apply_retina_at_center(x)
                 fmap = self.fixation_model(x_blurred)
             
             if isinstance(self.fixation_model, CustomBackboneDeepGazeIII) and isinstance(self.fixation_model.fixation_predictor.features, mFeatureExtractor):
@@ -1474,56 +1812,17 @@ class MultiFixationTiedBackboneClassifier(RetinaFilterWithFixationPrediction):
 
             fmaps.append(fmap)
 
-            fmap_ds = self._maybe_downsample_fmap(fmap)
-            downsample_factor = self.params.target_downsample_factor
-            
-            if hasattr(self.fixation_model, 'sample_fixation'):
-                fidx_ds = self.fixation_model.sample_fixation(fmap_ds)
-            else:
-                if self.training:
-                    masked_flat_prob_map = gumbel_softmax(torch.flatten(fmap_ds, 1), tau=self.params.loc_sampling_temp, hard=True)
-                else:
-                    soft_masked_flat_prob_map = torch.softmax(torch.flatten(fmap_ds, 1), 1)
-                    index = masked_flat_prob_map.max(1, keepdim=True)[1]
-                    hard_masked_flat_prob_map = torch.zeros_like(masked_flat_prob_map, memory_format=torch.legacy_contiguous_format).scatter_(1, index, 1.0)
-                    masked_flat_prob_map = hard_masked_flat_prob_map - soft_masked_flat_prob_map.detach() + soft_masked_flat_prob_map
-
-                index_tensor = torch.arange(masked_flat_prob_map.shape[1], dtype=masked_flat_prob_map.dtype, device=masked_flat_prob_map.device).unsqueeze(1)
-                fidx_ds = masked_flat_prob_map.mm(index_tensor).squeeze(-1).int()
-            
-            if self.training:
-                rand_fidx = torch.randint_like(fidx_ds, torch.flatten(fmap_ds, 1).shape[1])
-                rand_idx = (torch.rand(fidx_ds.shape[0]) < self.params.random_fixation_prob)
-                fidx_ds[rand_idx] = rand_fidx[rand_idx]
-
-            frow = (fidx_ds // fmap_ds.shape[3]) * downsample_factor + downsample_factor//2
-            fcol = (fidx_ds % fmap_ds.shape[3]) * downsample_factor + downsample_factor//2
-            fidx = frow * fmap.shape[3] + fcol
+            fidx, frow, fcol = self._sample_fixation(fmap)
 
             fxidxs.append(fidx)
             fxcols.append(fcol)
             fxrows.append(frow)
 
-            locs = fidx.cpu().detach().numpy()
-            loc_set = set(fidx.cpu().detach().numpy().tolist())
-            x_out_ = x_out[:, k]
-            for loc in loc_set:
-                r = loc // fmap.shape[3]
-                c = loc % fmap.shape[3]
-                # print(loc, (locs == loc))
-                x_ = x[(locs == loc)]
-                self.retina.params.loc = (r,c)
-                x_ = self.retina(x_)
-                x_out_[(locs == loc)] = x_
-            x_out[:, k] = x_out_
+            x_out[:, k] = self.apply_retina_at_locs(x, torch.stack([frow, fcol], 1))
         x_out = x_out.reshape(-1, *(x_out.shape[2:]))
         fmaps = torch.cat(fmaps, 1)
         all_logits = torch.stack(all_logits, 1)
-        if self.params.ensembling_mode == 'logit_mean':
-            all_logits = all_logits.mean(1)
-        if self.params.ensembling_mode == 'prob_sum':
-            all_logits = torch.log_softmax(all_logits, -1).logsumexp(1)
-        return x_out, fmaps, all_logits
+        return x_out, fmaps, self.ensemble_logits(all_logits)
     
     def forward(self, x, return_fixation_maps=False):
         if self.params.disable:
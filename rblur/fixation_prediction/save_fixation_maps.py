@@ -1,5 +1,6 @@
 from argparse import ArgumentParser
-from collections import Counter
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
 from importlib import import_module
 import torch
@@ -9,6 +10,7 @@ from rblur.runners import load_params_into_model
 from rblur.utils import load_pickle, load_json, write_json
 from rblur.retina_preproc import AbstractRetinaFilter
 from rblur.fixation_prediction.models import DeepGazeIIE
+from rblur.fixation_prediction.fixation_map_store import FixationMapShardWriter, get_sample_key
 from mllib.datasets.dataset_factory import SupportedDatasets
 from mllib.datasets.imagenet_filelist_dataset import ImagenetFileListDataset
 from deepgaze_pytorch import deepgaze_pytorch
@@ -20,6 +22,7 @@ from itertools import product
 from tqdm import tqdm
 from torchattacks import APGD
 from PIL import Image
+import threading
 
 def get_task_class_from_str(s):
     split = s.split('.')
@@ -54,6 +57,80 @@ class SupportedModels(AutoName):
     DEEPGAZE2E = auto()
     # DEEPGAZE3 = auto()
 SupportedModels.DEEPGAZE2E
+def get_resized_shape(w, h, size, max_size):
+    # shape (h, w) of an image of size (w, h) after torchvision.transforms.Resize(size, max_size=max_size)
+    short, long = min(w, h), max(w, h)
+    new_short, new_long = size, int(size * long / short)
+    if new_long > max_size:
+        new_short, new_long = int(max_size * new_short / new_long), max_size
+    return (new_long, new_short) if h > w else (new_short, new_long)
+
+def get_image_sizes(filenames, cache_file, num_threads=32):
+    # Reads the image sizes from the file headers, in parallel, and caches them.
+    sizes = load_json(cache_file) if os.path.exists(cache_file) else {}
+    missing = [fn for fn in filenames if fn not in sizes]
+    if len(missing) > 0:
+        def _get_size(fn):
+            with Image.open(fn) as img:
+                return img.size
+        with ThreadPoolExecutor(num_threads) as pool:
+            for fn, sz in zip(missing, tqdm(pool.map(_get_size, missing), total=len(missing), desc='reading image sizes')):
+                sizes[fn] = sz
+        write_json(sizes, cache_file)
+    return [sizes[fn] for fn in filenames]
+
+def make_aspect_ratio_batches(idxs, shapes, batch_size):
+    # groups the images with the same shape after resizing into batches
+    buckets = defaultdict(list)
+    for i, shp in zip(idxs, shapes):
+        buckets[tuple(shp)].append(i)
+    batches = []
+    for bucket in buckets.values():
+        batches.extend([bucket[j:j+batch_size] for j in range(0, len(bucket), batch_size)])
+    return batches
+
+def get_output_file(fn):
+    [label, fn] = fn.split('/')[-2:]
+    return f'{label}/{fn.split(".")[0]}.npz'
+
+class Manifest:
+    # Append-only list of the output files in root that have been completely written.
+    # If the manifest does not exist yet it is seeded with the files already in root.
+    def __init__(self, root) -> None:
+        self.path = f'{root}/manifest.txt'
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.done = set(l.strip() for l in f if len(l.strip()) > 0)
+            self.file = open(self.path, 'a')
+        else:
+            self.file = open(self.path, 'a')
+            for dirpath, _, filenames in os.walk(root):
+                for fn in filenames:
+                    if fn.endswith('.npz'):
+                        self.add(os.path.relpath(f'{dirpath}/{fn}', root))
+
+    def add(self, ofn):
+        with self.lock:
+            self.file.write(ofn + '\n')
+            self.file.flush()
+            self.done.add(ofn)
+
+    def close(self):
+        self.file.close()
+
+def save_fixation_map(odir, ofn, fmap, label, manifest, compress=False):
+    path = f'{odir}/{ofn}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so that interrupted writes do not leave
+    # partial files behind.
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        (np.savez_compressed if compress else np.savez)(f, fixation_probs=fmap, label=label)
+    os.replace(tmp_path, path)
+    manifest.add(ofn)
+
 parser = ArgumentParser()
 parser.add_argument('--model', required=True, type=lambda k: SupportedModels._value2member_map_[k], choices=SupportedModels)
 parser.add_argument('--input_image_size', type=int, default=1024)
@@ -64,6 +141,14 @@ parser.add_argument('--image_dir', type=str)
 parser.add_argument('--split', type=str, default='train')
 parser.add_argument('--output_dir', type=str)
 parser.add_argument('--overwrite', action='store_true')
+parser.add_argument('--batch_size', type=int, default=16, help='images with the same shape after resizing are batched together')
+parser.add_argument('--num_workers', type=int, default=8)
+parser.add_argument('--num_writers', type=int, default=4, help='number of background threads writing the fixation maps')
+parser.add_argument('--max_pending_writes', type=int, default=256)
+parser.add_argument('--compress', action='store_true')
+parser.add_argument('--output_format', type=str, default='npz', choices=['npz', 'shards'], help='one .npz file per image or memory-mappable shards (see fixation_map_store.py)')
+parser.add_argument('--shard_size', type=int, default=512)
+parser.add_argument('--shard_dtype', type=str, default='float16', choices=['float16', 'uint8'])
 
 args = parser.parse_args()
 print(args.model, SupportedModels.DEEPGAZE2E, args.model == SupportedModels.DEEPGAZE2E)
@@ -80,57 +165,60 @@ transform = torchvision.transforms.Compose([
     torchvision.transforms.ToTensor()
 ])
 class mDataset(ImagenetFileListDataset):
-    # def __init__(self, root: str, split='train', transforms = None, transform = None, target_transform = None) -> None:
-    #     super().__init__(root, split, transforms, transform, target_transform)
-    #     filesizes = [Image.open(fn).size for fn in self.samples]
-    #     filesizes = [max(fsz)/min(fsz) for fsz in filesizes]
-    #     fszcounter = Counter(filesizes)
-    #     print(fszcounter, max(fszcounter.keys()))
-    #     sorted_idxs = sorted(range(len(self.filesizes)), key=lambda i: fszcounter[filesizes[i]], reverse=True)
-    #     self.samples = self.samples[sorted_idxs]
-    #     self.targets = self.targets[sorted_idxs]
-
     def __getitem__(self, i):
         fn = self.samples[i]
         x, y = super().__getitem__(i)
         return fn, x, y
 test_dataset = mDataset(args.image_dir, split=args.split, transform=transform)
 nclasses = len(set(test_dataset.targets))
-test_dataset = torch.utils.data.Subset(test_dataset, range(args.start_idx, args.start_idx+args.num_test))
-print(len(test_dataset))
-loader = torch.utils.data.DataLoader(test_dataset, batch_size=1, shuffle=False)
 
-correct = 0
-adv_correct = 0
-total = 0
+odir = f'{args.output_dir}/{args.model.value}/{args.split}'
+os.makedirs(odir, exist_ok=True)
+if args.output_format == 'shards':
+    store = FixationMapShardWriter(f'{odir}/shards', shard_size=args.shard_size, dtype=args.shard_dtype)
+    is_done = lambda fn: get_sample_key(fn) in store
+    save = lambda fn, fmap, l: store.add(get_sample_key(fn), fmap, l)
+    # the shard writer is not thread-safe
+    num_writers = 1
+else:
+    manifest = Manifest(odir)
+    is_done = lambda fn: get_output_file(fn) in manifest.done
+    save = lambda fn, fmap, l: save_fixation_map(odir, get_output_file(fn), fmap, l, manifest, args.compress)
+    num_writers = args.num_writers
+end_idx = int(min(len(test_dataset), args.start_idx+args.num_test))
+idxs = list(range(args.start_idx, end_idx))
+if not args.overwrite:
+    idxs = [i for i in idxs if not is_done(test_dataset.samples[i])]
+print(f'{end_idx - args.start_idx - len(idxs)} fixation maps already computed, {len(idxs)} remaining')
+
+sizes = get_image_sizes([test_dataset.samples[i] for i in idxs], f'{args.output_dir}/{args.split}_image_sizes.json')
+shapes = [get_resized_shape(w, h, args.input_image_size-1, args.input_image_size) for w, h in sizes]
+batches = make_aspect_ratio_batches(idxs, shapes, args.batch_size)
+loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=batches, num_workers=args.num_workers, pin_memory=True)
+
+writer = ThreadPoolExecutor(num_writers)
+pending = []
 t = tqdm(loader)
+# the maps already submitted are written and the partial shard is flushed even if the
+# loop is interrupted, so that they are not recomputed when resuming
+try:
+    for batch in t:
+        filenames, x, y = batch
+        with torch.no_grad():
+            fixation_maps = model(x.cuda(non_blocking=True)).cpu().detach()
+            fixation_maps = torchvision.transforms.functional.resize(fixation_maps, args.output_image_size-1, max_size=args.output_image_size).numpy().astype('float16')
 
-for i,batch in enumerate(t):
-    # if not ((i > args.start_idx) and (i < args.start_idx + args.num_test)):
-    #     print(i, args.start_idx, args.num_test, 'skipping')
-    #     continue
-    filenames, x, y = batch
-    print(x.shape)
-    filenames = np.array(filenames)
-    idx_to_include = []
-    if not args.overwrite:
-        for i, fn in enumerate(filenames):
-            [label, fn] = fn.split('/')[-2:]
-            odir = f'{args.output_dir}/{args.model.value}/{args.split}/{label}/'
-            ofn = f'{odir}/{fn.split(".")[0]}.npz'
-            if not os.path.exists(ofn):
-                idx_to_include.append(i)
-        filenames, x, y = filenames[idx_to_include], x[idx_to_include], y[idx_to_include]
-    with torch.no_grad():
-        fixation_maps = model(x.cuda()).cpu().detach()
-        fixation_maps = torchvision.transforms.functional.resize(fixation_maps, args.output_image_size-1, max_size=args.output_image_size).numpy().astype('float16')
-
-    print('saving logit maps...')
-    for fn, fmap, l in zip(filenames, fixation_maps, y):
-        l = int(l)
-        [label, fn] = fn.split('/')[-2:]
-        odir = f'{args.output_dir}/{args.model.value}/{args.split}/{label}/'
-        if not os.path.exists(odir):
-            os.makedirs(odir)
-        fn = fn.split('.')[0]
-        np.savez(f'{odir}/{fn}.npz', fixation_probs=fmap, label=l)
\ No newline at end of file
+        for fn, fmap, l in zip(filenames, fixation_maps, y):
+            pending.append(writer.submit(save, fn, fmap, int(l)))
+        # bound the number of maps held in memory and surface write errors
+        while len(pending) > args.max_pending_writes:
+            pending.pop(0).result()
+        t.set_postfix({'pending_writes': len(pending)})
+finally:
+    writer.shutdown(wait=True)
+    if args.output_format == 'shards':
+        store.close()
+    else:
+        manifest.close()
+for p in pending:
+    p.result()
@@ -6,9 +6,11 @@ from rblur.fixation_prediction.models import (
     RetinaFilterWithFixationPrediction,
     TiedBackboneRetinaFixationPreditionClassifier,
     DeepGazeII, DeepGazeIIE, DeepGazeIII,
-    MultiFixationTiedBackboneClassifier, CustomBackboneDeepGazeIII)
+    MultiFixationTiedBackboneClassifier, CustomBackboneDeepGazeIII,
+    DistilledFixationPredictor)
 from rblur.fixation_prediction.trainers import (
     ClickmeImportanceMapLightningAdversarialTrainer,
+    FixationDistillationTrainer,
     FixationPointLightningAdversarialTrainer,
     RetinaFilterWithFixationPredictionLightningAdversarialTrainer)
 from rblur.mlp_mixer_models import (
@@ -1702,4 +1704,52 @@ class ImagenetNoisyRetinaBlurWRandomScalesXResNet2x18WTiedBackboneDeepGazeIIIEva
             AdamOptimizerConfig(lr=0.001, weight_decay=5e-4),
             ReduceLROnPlateauConfig(patience=3),
             logdir=LOGDIR, batch_size=64,
-        )
\ No newline at end of file
+        )
+class Ecoset10DeepGazeIIEDistillationUNet(AbstractTask):
+    imgs_size = 224
+    input_size = [3, imgs_size, imgs_size]
+
+    def get_dataset_params(self) :
+        p = get_dataset_params(f'{logdir_root}/ecoset-10', SupportedDatasets.ECOSET10wFIXATIONMAPS_FOLDER, num_train=50000, num_test=1000,
+        train_transforms=[
+                torchvision.transforms.Resize(self.imgs_size),
+                torchvision.transforms.CenterCrop(self.imgs_size),
+            ],
+        test_transforms=[
+            torchvision.transforms.Resize(self.imgs_size),
+            torchvision.transforms.CenterCrop(self.imgs_size),
+        ],
+        fixation_map_root=f'{logdir_root}/ecoset-10/fixation_maps/deepgaze2e/',
+        fmap_transform=torchvision.transforms.Compose([
+            torchvision.transforms.Resize(self.imgs_size),
+            torchvision.transforms.CenterCrop(self.imgs_size)
+        ])
+        )
+        return p
+
+    def get_model_params(self):
+        p = DistilledFixationPredictor.ModelParams(DistilledFixationPredictor, arch='unet', min_image_dim=self.imgs_size)
+        return p
+
+    def get_experiment_params(self) -> BaseExperimentConfig:
+        nepochs = 30
+        return BaseExperimentConfig(
+            FixationDistillationTrainer.TrainerParams(FixationDistillationTrainer,
+                TrainingParams(logdir=LOGDIR, nepochs=nepochs, early_stop_patience=50, tracked_metric='val_loss',
+                    tracking_mode='min', scheduler_step_after_epoch=False
+                )
+            ),
+            AdamOptimizerConfig(lr=0.001, weight_decay=5e-4),
+            OneCycleLRConfig(max_lr=0.001, epochs=nepochs, steps_per_epoch=782, pct_start=0.1, anneal_strategy='linear'),
+            logdir=LOGDIR, batch_size=64
+        )
+
+class Ecoset10NoisyRetinaBlurS2500WRandomScalesXResNet2x18WDistilledDeepGazeIIE(Ecoset10NoisyRetinaBlurS2500WRandomScalesXResNet2x18WDeepGazeIIE):
+    fixation_model_ckp = f'{LOGDIR}/ecoset10-0.0/Ecoset10DeepGazeIIEDistillationUNet/0/checkpoints/model_checkpoint.pt'
+
+    def get_model_params(self):
+        p = super().get_model_params()
+        retinafixp = p.feature_model_params.layer_params[1]
+        retinafixp.fixation_params = DistilledFixationPredictor.ModelParams(DistilledFixationPredictor, arch='unet', min_image_dim=self.imgs_size)
+        retinafixp.fixation_model_ckp = self.fixation_model_ckp
+        return p
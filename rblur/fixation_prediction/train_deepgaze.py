@@ -39,6 +39,9 @@ parser.add_argument('--layers', nargs='+', type=str)
 parser.add_argument('--expname', type=str, default='')
 parser.add_argument('--stage', type=str, choices=['pretrain', 'fine-tune', 'fine-tune-clickme'])
 parser.add_argument('--arch', type=str, choices=['deepgaze2', 'deepgaze3'])
+parser.add_argument('--clickme_root', type=str, default='/home/mshah1/workhorse3/clickme/shards')
+parser.add_argument('--clickme_cache', type=str, default=None, help='directory of the memory-mapped ClickMe cache (see clickme_cache.py), built from the webdataset shards if it does not exist. Defaults to {clickme_root}/../mmap_cache')
+parser.add_argument('--num_workers', type=int, default=8)
 args = parser.parse_args()
 
 def get_task_class_from_str(s):
@@ -355,27 +358,15 @@ elif args.stage == 'fine-tune':
     )
 
 elif args.stage == 'fine-tune-clickme':
-    import torchvision
     import webdataset as wds
-    import tqdm
-    from scipy.special import softmax
+    from rblur.fixation_prediction.clickme_cache import build_clickme_cache, ClickmeCacheDataset, collate_clickme_batch
 
-    def identity(x):
-        return x
-
-    def toFloatTensor(x):
-        return torch.FloatTensor(x)
-
-    def transpose_to_chw(x):
-        return x.transpose(2,1).transpose(1,0)
-
-    def get_clickme_webdataset(root, dataset_name, centerbias=None, first_shard_idx=0, nshards=None, split='train', transform=None, shuffle=10_000, len_shard=10_000):
+    def get_clickme_shard_urls(root, dataset_name, first_shard_idx=0, nshards=None, split='train'):
         if split =='train':
             urls = dataset_name+"-train-{}.tar"
         elif split =='val':
             urls = dataset_name+"-trainval-{}.tar"
         elif split == 'test':
-            shuffle = 0
             urls = dataset_name+"-val-{}.tar"
         else:
             raise ValueError(f'split must be one of train, val, or test, but got {split}')
@@ -385,120 +376,31 @@ elif args.stage == 'fine-tune-clickme':
             shard_str = f'{first_shard_idx:06d}'
         urls = os.path.join(root, urls.format(shard_str))
         print(nshards, urls)
-        dataset = wds.WebDataset(urls, shardshuffle=(split=='train'), nodesplitter=wds.split_by_node)
-        if split == 'train':
-            dataset = dataset.shuffle(shuffle, initial=shuffle//2)
-        dataset = dataset.decode("pil")
-        dataset = dataset.compose(wds.filters.associate(lambda x: {'weight':1.}))
-        if centerbias is not None:
-            dataset = dataset.compose(wds.filters.associate(lambda x: {'centerbias':centerbias}))
-            dataset = (
-                dataset
-        #         .to_tuple("jpg;png;jpeg cls heatmap.npy")
-        #         .map_tuple(transform, identity, toFloatTensor)
-                .map_dict(**({'jpg':transform, 'cls':identity, 'heatmap.npy': toFloatTensor, 'centerbias': toFloatTensor}))
-                .map_dict(**({'jpg':identity, 'cls':identity, 'heatmap.npy': transpose_to_chw, 'centerbias': identity}))
-                .rename(**({'image':'jpg', 'y':'cls', 'fixation_mask':'heatmap.npy', 'centerbias':'centerbias'}))        
-                # .with_length(nshards*len_shard)
-            )
-        else:
-            dataset = (
-                dataset
-        #         .to_tuple("jpg;png;jpeg cls heatmap.npy")
-        #         .map_tuple(transform, identity, toFloatTensor)
-                .map_dict(**({'jpg':transform, 'cls':identity, 'heatmap.npy': toFloatTensor}))
-                .map_dict(**({'jpg':identity, 'cls':identity, 'heatmap.npy': transpose_to_chw}))
-                .rename(**({'image':'jpg', 'y':'cls', 'fixation_mask':'heatmap.npy'}))        
-                # .with_length(nshards*len_shard)
-            )
-        return dataset
-    
-    transforms=torchvision.transforms.Compose([
-            torchvision.transforms.Resize(224, max_size=225),
-            torchvision.transforms.ToTensor()
-        ])
+        return urls
+
     num_train_shards = 39
     num_test_shards = 5
     num_val_shards = 1
-    clickme_train_dataset = get_clickme_webdataset('/home/mshah1/workhorse3/clickme/shards', 'clickme', nshards=num_train_shards, split='train', transform=transforms)
-    # val_dataset = get_clickme_webdataset('/home/mshah1/workhorse3/clickme/shards', 'clickme', nshards=num_val_shards, split='val', transform=transforms)
-    clickme_test_dataset = get_clickme_webdataset('/home/mshah1/workhorse3/clickme/shards', 'clickme', nshards=num_test_shards, split='test', transform=transforms)
-
-    def get_clickme_images_and_fixations(dataset, N):
-        clickme_images = []
-        clickme_fixmaps = []
-        def density_to_fixation(density_map):
-        #     prob_map = softmax(density_map.reshape(density_map.shape[0], -1), 1).reshape(density_map.shape)
-            prob_map = density_map / density_map.max()
-
-            rng = np.random.Generator(np.random.PCG64(69239841))
-            fixation_mask = rng.binomial(1, p=prob_map, size=prob_map.shape)
-            return fixation_mask
-        for batch in tqdm.tqdm(dataset.iterator()):
-            x, m = batch['image'], batch['fixation_mask']
-            m = m.squeeze(2).numpy()
-            x = x.transpose(0,1).transpose(1,2).numpy()
-            if x.max() <= 1:
-                x = (x * 255).astype(int).astype(np.ubyte)
-            m = density_to_fixation(m).astype(np.half)
-            clickme_fixmaps.append(m)
-            clickme_images.append(x)
-            if len(clickme_images) >= N:
-                break
-        return clickme_images, clickme_fixmaps
-    
-    clickme_train_images_10K, clickme_train_fixmaps_10K = get_clickme_images_and_fixations(clickme_train_dataset, 10_000)
-    clickme_val_images_10K, clickme_val_fixmaps_10K = get_clickme_images_and_fixations(clickme_test_dataset, 10_000)
-
-    clickme_train_stimuli_10K = pysaliency.Stimuli(clickme_train_images_10K)
-    clickme_val_stimuli_10K = pysaliency.Stimuli(clickme_val_images_10K)
-
-    clickme_train_fixations_10K = pysaliency.Fixations.from_fixation_matrices([x.squeeze() for x in clickme_train_fixmaps_10K])
-    clickme_val_fixations_10K = pysaliency.Fixations.from_fixation_matrices([x.squeeze() for x in clickme_val_fixmaps_10K])
-
-    # parameters taken from an early fit for MIT1003. Since SALICON has many more fixations, the bandwidth won't be too small
-    clickme_centerbias = BaselineModel(stimuli=clickme_train_stimuli_10K, fixations=clickme_train_fixations_10K, bandwidth=0.0217, eps=2e-13, caching=False)
+    # The shards are decoded, resized and written to a memory-mapped cache, along with
+    # the center bias fitted on the first 10K training images, the first time they are
+    # used. Later runs read the cache with random access instead of decoding the shards.
+    cache_root = args.clickme_cache or os.path.join(os.path.dirname(args.clickme_root.rstrip('/')), 'mmap_cache')
+    build_clickme_cache(cache_root, {
+            'train': wds.WebDataset(get_clickme_shard_urls(args.clickme_root, 'clickme', nshards=num_train_shards, split='train'), shardshuffle=False),
+            'test': wds.WebDataset(get_clickme_shard_urls(args.clickme_root, 'clickme', nshards=num_test_shards, split='test'), shardshuffle=False),
+        }, image_size=224, num_workers=args.num_workers)
 
     # takes quite some time, feel free to set to zero
     train_baseline_log_likelihood = 0.46408017115279737 # SALICON_centerbias.information_gain(SALICON_train_stimuli, SALICON_train_fixations, verbose=True, average='image')
     val_baseline_log_likelihood = 0.4291592320821603 # SALICON_centerbias.information_gain(SALICON_val_stimuli, SALICON_val_fixations, verbose=True, average='image')
 
-    centerbias = clickme_centerbias._log_density(clickme_train_images_10K[0])
-    transforms=torchvision.transforms.Compose([
-            torchvision.transforms.Resize(224, max_size=225),
-            torchvision.transforms.ToTensor()
-        ])
-    num_train_shards = 39
-    num_test_shards = 5
-    num_val_shards = 1
-    clickme_train_dataset = get_clickme_webdataset('/home/mshah1/workhorse3/clickme/shards', 'clickme', centerbias=centerbias, nshards=num_train_shards, split='train', transform=transforms)
-    # val_dataset = get_clickme_webdataset('/home/mshah1/workhorse3/clickme/shards', 'clickme', nshards=num_val_shards, split='val', transform=transforms)
-    clickme_test_dataset = get_clickme_webdataset('/home/mshah1/workhorse3/clickme/shards', 'clickme', centerbias=centerbias, nshards=num_test_shards, split='test', transform=transforms)
-
-    num_workers = 1 # 8 // torch.cuda.device_count()
     BATCH_SIZE=64
-
-    def density_to_fixation(density_map):
-    #     prob_map = torch.softmax(density_map.reshape(density_map.shape[0], -1), 1).reshape(density_map.shape)
-    #     prob_map[prob_map > 0] = 1.
-        prob_map = density_map / density_map.max()
-        prob_map = torch.bernoulli(prob_map)
-        return prob_map
-        
-    def _collate_fn(batch):
-        collated_batch = torch.utils.data.default_collate(batch)
-        collated_batch.pop('__key__')
-        collated_batch.pop('__url__')
-        collated_batch.pop('y')
-        for i in range(len(collated_batch['fixation_mask'])):
-            collated_batch['fixation_mask'][i] = density_to_fixation(collated_batch['fixation_mask'][i])
-        return collated_batch
-
-    clickme_train_dataset = clickme_train_dataset.shuffle(10_000).batched(BATCH_SIZE, partial=False, collation_fn=_collate_fn)
-    clickme_test_dataset = clickme_test_dataset.batched(BATCH_SIZE, partial=False, collation_fn=_collate_fn)
-
-    clickme_train_loader = wds.WebLoader(clickme_train_dataset, batch_size=None, shuffle=False, pin_memory=True, num_workers=num_workers)
-    clickme_val_loader = wds.WebLoader(clickme_test_dataset, batch_size=None, shuffle=False, pin_memory=True, num_workers=num_workers)
+    clickme_train_dataset = ClickmeCacheDataset(cache_root, 'train')
+    clickme_test_dataset = ClickmeCacheDataset(cache_root, 'test')
+    clickme_train_loader = torch.utils.data.DataLoader(clickme_train_dataset, batch_size=BATCH_SIZE, shuffle=True, drop_last=True, pin_memory=True,
+                                                        num_workers=args.num_workers, collate_fn=collate_clickme_batch, persistent_workers=args.num_workers > 0)
+    clickme_val_loader = torch.utils.data.DataLoader(clickme_test_dataset, batch_size=BATCH_SIZE, shuffle=False, drop_last=True, pin_memory=True,
+                                                        num_workers=args.num_workers, collate_fn=collate_clickme_batch, persistent_workers=args.num_workers > 0)
 
     model = model.to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
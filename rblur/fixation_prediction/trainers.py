@@ -1,13 +1,15 @@
 import torch
 import numpy as np
 from rblur.trainers import LightningAdversarialTrainer, MultiAttackEvaluationTrainer
-from rblur.fixation_prediction.models import RetinaFilterWithFixationPrediction
+from rblur.fixation_prediction.models import RetinaFilterWithFixationPrediction, topk_fixation_agreement
+from rblur.runners import load_params_into_model
 from mllib.trainers.base_trainers import PytorchLightningTrainer
 # from pysaliency.roc import general_roc
 # from pysaliency.numba_utils import auc_for_one_positive
 from mllib.utils.metric_utils import compute_accuracy
 from mllib.param import BaseParameters
 from attrs import define
+from contextlib import contextmanager
 from time import time
 
 def set_param(p:BaseParameters, param, value):
@@ -60,6 +62,58 @@ class ClickmeImportanceMapLightningAdversarialTrainer(FixationPointLightningAdve
         x,_,y = batch
         return super().test_step((x,y), batch_idx)
     
+class FixationDistillationTrainer(FixationPointLightningAdversarialTrainer):
+    '''
+    Trains a small fixation predictor (e.g. DistilledFixationPredictor) to match the
+    fixation maps of a teacher. The teacher maps are either precomputed and provided
+    in the batches as (x, y, m), or computed by the teacher model, if teacher_params is
+    set, for batches of (x, y). Besides the KL divergence, the top-K fixation agreement
+    with the teacher and the throughput of the student are logged.
+    '''
+    @define(slots=False)
+    class TrainerParams(FixationPointLightningAdversarialTrainer.TrainerParams):
+        teacher_params: BaseParameters = None
+        teacher_ckp_path: str = None
+        num_agreement_fixations: int = 5
+        agreement_downsample_factor: int = 16
+
+    def __init__(self, params: TrainerParams, *args, **kwargs):
+        super().__init__(params, *args, **kwargs)
+        self.teacher = None
+        if params.teacher_params is not None:
+            self.teacher = params.teacher_params.cls(params.teacher_params)
+            if params.teacher_ckp_path is not None:
+                load_params_into_model(torch.load(params.teacher_ckp_path), self.teacher)
+            self.teacher = self.teacher.eval().requires_grad_(False)
+
+    def get_teacher_fixation_maps(self, x):
+        if self.teacher is None:
+            raise ValueError('the batches must contain the teacher fixation maps if teacher_params is not set')
+        self.teacher.eval()
+        with torch.no_grad():
+            return self.teacher(x)
+
+    def forward_step(self, batch, batch_idx):
+        if len(batch) == 3:
+            x,_,m = batch
+        else:
+            x,_ = batch
+            m = self.get_teacher_fixation_maps(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        t0 = time()
+        fmap, loss = self._get_outputs_and_loss(x, m)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        throughput = x.shape[0] / (time() - t0)
+        agreement = topk_fixation_agreement(fmap.detach(), m.detach(), self.params.num_agreement_fixations, self.params.agreement_downsample_factor)
+
+        lr = self.scheduler.optimizer.param_groups[0]['lr']
+        loss = loss.mean()
+        t = time() - self.t0
+        logs = {'time': t, 'lr': lr, 'accuracy': 0, 'topk_agreement': agreement.detach(), 'images_per_sec': throughput, 'loss': loss.detach()}
+        return {'loss':loss, 'logs':logs}
+
 class PrecomputedFixationMapMultiAttackEvaluationTrainer(MultiAttackEvaluationTrainer):
     @define(slots=False)
     class TrainerParams(MultiAttackEvaluationTrainer.TrainerParams):
@@ -77,6 +131,7 @@ class PrecomputedFixationMapMultiAttackEvaluationTrainer(MultiAttackEvaluationTr
         while m.dim() < 4:
             m = m.unsqueeze(1)
         b, w = m.shape[0], m.shape[-1]
+        self.fixation_locs = None
         rfmodule = self.get_retina_fixation_module()
         if rfmodule and rfmodule.params.salience_map_provided_as_input_channel:
             x = torch.cat([x,m], dim=1)
@@ -89,9 +144,23 @@ class PrecomputedFixationMapMultiAttackEvaluationTrainer(MultiAttackEvaluationTr
             set_param(self.model.params, 'loc_mode', 'const')
             set_param(self.model.params, 'loc', locs)
             set_param(self.model.params, 'batch_size', 1)
+            self.fixation_locs = locs
         # print(self.model.feature_model.layers[1].params.loc_mode)
         return super().test_step((x,y), batch_idx)
 
+    @contextmanager
+    def _select_samples(self, idxs):
+        # the fixation locations are looked up by the position of the sample in the batch
+        locs = getattr(self, 'fixation_locs', None)
+        if locs is None:
+            yield
+            return
+        set_param(self.model.params, 'loc', [locs[i] for i in idxs.tolist()])
+        try:
+            yield
+        finally:
+            set_param(self.model.params, 'loc', locs)
+
 class RetinaFilterWithFixationPredictionLightningAdversarialTrainer(LightningAdversarialTrainer):
     @define(slots=False)    
     class TrainerParams(LightningAdversarialTrainer.TrainerParams):
@@ -1,6 +1,6 @@
 from copy import deepcopy
 from time import time
-from typing import List, Union
+from typing import List, Literal, Union
 import torch
 from torch import nn
 import torchvision
@@ -12,6 +12,7 @@ from attrs import define
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from rblur.retina_preproc import AbstractRetinaFilter, gaussian_fn, seperable_gaussian_blur_pytorch, dist_to_prob, get_isodensity_box_width, convert_image_tensor_to_ndarray
+from rblur.retina_preproc import _get_isobox_level_map, _get_isobox_masks, _stack_isobox_kernels, isobox_filter_bank_blur_pytorch, _gather_isobox_levels, _get_isobox_density
 
 class Rectangle:
     def __init__(self, x1, y1, x2, y2) -> None:
@@ -57,6 +58,11 @@ class Rectangle:
         return isinstance(__o, Rectangle) and (all([self.x1 == __o.x1, self.x2 == __o.x2, self.y1 == __o.y1, self.y2 == __o.y2]))
 
 def embed_and_foveate(vfwidth, loc_idx, img, isobox_w, avg_bins, kernels, gblur_fn=None):
+    if isinstance(loc_idx, torch.Tensor) and (loc_idx.dim() == 2):
+        outputs = [embed_and_foveate(vfwidth, tuple(li), img[[i]], isobox_w, avg_bins, kernels, gblur_fn=gblur_fn)
+                    for i, li in enumerate(loc_idx.cpu().numpy().tolist())]
+        bimg, density_mat = zip(*outputs)
+        return torch.cat(bimg, 0), torch.cat(density_mat, 0)
     center = vfwidth//2
     # Cocentric squares defining regions of equal visual acuity (isoboxes). 
     # isobox_w contains the width of the squares.
@@ -100,6 +106,66 @@ def embed_and_foveate(vfwidth, loc_idx, img, isobox_w, avg_bins, kernels, gblur_
             density_mat[..., r.y1:r.y1+bcrop.shape[2], r.x1:r.x1+bcrop.shape[3]] = p
     return bimg, density_mat
 
+def _get_embedded_filter_bank(kernels, img):
+    # Clip the kernels to the image size (as in embed_and_foveate) and zero-pad
+    # them to a common odd width so that they can be stacked. embed_and_foveate
+    # pads each crop by ks//2 on both sides, so a kernel of even size ks starts ks//2
+    # pixels before the output pixel, and is padded with one more zero on the right.
+    clipped_kernels = []
+    for K in kernels:
+        ks = min(K.shape[-1], min(img.shape[2:])-1)
+        offset = (K.shape[-1] - ks)//2
+        clipped_kernels.append(K[offset:offset+ks])
+    maxks = max([K.shape[-1] for K in clipped_kernels])
+    maxks += int((maxks % 2) == 0)
+    padded_kernels = []
+    for K in clipped_kernels:
+        left = maxks//2 - K.shape[-1]//2
+        padded_kernels.append(nn.functional.pad(K, (left, maxks - K.shape[-1] - left)))
+    return _stack_isobox_kernels(padded_kernels, img.dtype, img.device)
+
+def _blur_with_embedded_filter_bank(img, kernels):
+    bank = _get_embedded_filter_bank(kernels, img)
+    pimg = nn.functional.pad(img, (bank.shape[-1]//2,)*4, mode='reflect')
+    return isobox_filter_bank_blur_pytorch(pimg, bank, separable=True)
+
+def embed_and_foveate_vectorized(vfwidth, loc_idx, img, isobox_w, avg_bins, kernels):
+    '''
+    Vectorized equivalent of embed_and_foveate with separable kernels. The image is
+    blurred with all the isobox kernels in one grouped convolution and the outputs
+    are composited using the isobox masks. loc_idx may be a single (row, col) location
+    or a (b, 2) tensor containing one location per sample.
+    '''
+    b, c, h, w = img.shape
+    center = vfwidth//2
+    # The isoboxes are centered at the center of the visual field and the top-left
+    # corner of the image is placed at loc_idx, so, in image coordinates, the
+    # isoboxes are centered at center-loc_idx.
+    if isinstance(loc_idx, torch.Tensor) and (loc_idx.dim() == 2):
+        isobox_center = center - loc_idx
+    else:
+        isobox_center = (center - int(loc_idx[0]), center - int(loc_idx[1]))
+    level_map = _get_isobox_level_map(isobox_w, isobox_center, h, w, device=img.device)
+    masks = _get_isobox_masks(level_map, len(isobox_w), img.dtype)
+    p = torch.as_tensor(np.asarray(avg_bins), dtype=img.dtype, device=img.device).view(1, -1, 1, 1)
+    density_mat = (masks * p).sum(1, keepdim=True).expand_as(img)
+    blurred = _blur_with_embedded_filter_bank(img, kernels)
+    bimg = (blurred * masks.unsqueeze(2)).sum(1)
+    return bimg, density_mat
+
+def embed_and_foveate_at_fixations(vfwidth, locs, img, isobox_w, avg_bins, kernels):
+    '''
+    Foveates img at each of the K locations in locs ((K, 2) tensor). The image is
+    blurred once with every isobox kernel and the foveated images are gathered from
+    the blurred stack. Returns a (b, K, c, h, w) tensor and the (K, 1, h, w) density
+    matrices.
+    '''
+    h, w = img.shape[-2:]
+    level_map = _get_isobox_level_map(isobox_w, vfwidth//2 - locs, h, w, device=img.device)
+    density_mat = _get_isobox_density(level_map, avg_bins, img.dtype).unsqueeze(1)
+    blurred = _blur_with_embedded_filter_bank(img, kernels)
+    return _gather_isobox_levels(blurred, level_map), density_mat
+
 class GaussianBlurLayer(AbstractModel):
     @define(slots=False)
     class ModelParams(BaseParameters):
@@ -197,6 +263,7 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         min_res: int = -np.inf
         rescale_img_with_distance: bool = False
         gnoise_params: GaussianNoiseLayer.ModelParams = None
+        blur_engine: Literal['loop', 'vectorized'] = 'vectorized'
 
     def __init__(self, params, eps=1e-5) -> None:
         super().__init__(params)
@@ -265,6 +332,8 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         #                                                     gblur_fn=seperable_gaussian_blur_pytorch
         #                                                     )
         if self.apply_blur:
+            if self.params.blur_engine == 'vectorized':
+                return embed_and_foveate_vectorized(self.input_shape[1], loc_idx, img, isobox_w, avg_bins, kernels)
             return embed_and_foveate(self.input_shape[1], loc_idx, img, isobox_w, avg_bins, kernels, seperable_gaussian_blur_pytorch)
         else:
             return img, None
@@ -348,9 +417,7 @@ class RetinaBlurFilter(AbstractRetinaFilter):
     def forward(self, x, loc_idx=None):
         if self.params.loc_mode == 'hscan_fixations':
             locs = self._get_hscan_fixations(x)
-            filtered = [self._forward_batch(x, loc) for loc in locs]
-            filtered = torch.stack(filtered, dim=1)
-            filtered = filtered.reshape(-1, *(filtered.shape[2:]))
+            filtered = self._forward_fixations(x, locs)
         else:
             filtered = super().forward(x, loc_idx=loc_idx)
         return filtered
@@ -362,6 +429,8 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         elif self.params.loc_mode == 'const':
             if isinstance(self.params.loc, tuple):
                 loc = self.params.loc
+            elif isinstance(self.params.loc, torch.Tensor):
+                loc = self.params.loc[batch_idx*self.params.batch_size:(batch_idx+1)*self.params.batch_size]
             elif np.iterable(self.params.loc):
                 loc = self.params.loc[batch_idx]
         elif (self.params.loc_mode in ['random_uniform', 'random_uniform_2', 'random_in_image']):
@@ -378,39 +447,61 @@ class RetinaBlurFilter(AbstractRetinaFilter):
             raise ValueError('params.loc_mode must be "center" or "random_uniform" or "random_uniform_2" or "const"')
         return loc
 
+    def _get_isoboxes(self, name, s):
+        isobox_w = getattr(self, f'{name}_isobox_w')
+        avg_bins = getattr(self, f'{name}_avg_bins')
+        kernels = getattr(self, f'{name}_kernels')
+        if s > 0:
+            return isobox_w[:-s], avg_bins[s:], kernels[s:]
+        return isobox_w, avg_bins, kernels
+
+    def _add_noise_and_rescale(self, img, clr_isobox_w):
+        noise = self.gnoise(img) - img
+        clr_rescale_factor = self.clr_isobox_w[-1]/(self.clr_isobox_w[-1]+2*(clr_isobox_w[-1] - self.clr_isobox_w[-1]))
+        # gry_rescale_factor = self.gry_isobox_w[-1]/(self.gry_isobox_w[-1]+2*(gry_isobox_w[-1] - self.gry_isobox_w[-1]))
+        if (clr_rescale_factor < 1) and self.params.rescale_img_with_distance:
+            # print(s, clr_rescale_factor, gry_rescale_factor)
+            img = nn.functional.interpolate(nn.functional.interpolate(img, scale_factor=clr_rescale_factor, mode='bilinear'), size=tuple(img.shape[2:]), mode='bilinear')
+        img = img + noise
+        return img
+
+    def _forward_fixations(self, img, locs):
+        if (self.params.blur_engine != 'vectorized') or (not self.apply_blur):
+            return super()._forward_fixations(img, locs)
+        b, c, h, w = img.shape
+        s = self._get_view_scale()
+        assert not ((self.params.view_scale is None) and (s > 0))
+        if not isinstance(locs, torch.Tensor):
+            locs = torch.tensor(np.array(locs, dtype=np.int64))
+        locs = locs.to(img.device)
+        clr_isobox_w, clr_avg_bins, clr_kernels = self._get_isoboxes('clr', s)
+        # The noise is sampled once and shared by all the fixations.
+        img = self._add_noise_and_rescale(img, clr_isobox_w)
+        clr_filtered_img, cone_density_mat = embed_and_foveate_at_fixations(self.input_shape[1], locs, img, clr_isobox_w, clr_avg_bins, clr_kernels)
+        if self.include_gry_img:
+            gry_isobox_w, gry_avg_bins, gry_kernels = self._get_isoboxes('gry', s)
+            grey_img = img.mean(1, keepdims=True)
+            gry_filtered_img, rod_density_mat = embed_and_foveate_at_fixations(self.input_shape[1], locs, grey_img, gry_isobox_w, gry_avg_bins, gry_kernels)
+            final_img = (rod_density_mat*gry_filtered_img + cone_density_mat*clr_filtered_img) / (rod_density_mat+cone_density_mat)
+        else:
+            final_img = clr_filtered_img
+        final_img = torch.clamp(final_img, 0, 1.)
+        return final_img.reshape(-1, c, h, w)
+
     def _forward_batch(self, img, loc_idx):
         s = self._get_view_scale()
         # print(f'view_scale={s}')
         assert not ((self.params.view_scale is None) and (s > 0))
-        if s > 0:
-            if self.include_gry_img:
-                gry_isobox_w = self.gry_isobox_w[:-s]
-                gry_avg_bins = self.gry_avg_bins[s:]
-                gry_kernels = self.gry_kernels[s:]
-            clr_isobox_w = self.clr_isobox_w[:-s]
-            clr_avg_bins = self.clr_avg_bins[s:]
-            clr_kernels = self.clr_kernels[s:]
-        else:
-            if self.include_gry_img:
-                gry_isobox_w = self.gry_isobox_w
-                gry_avg_bins = self.gry_avg_bins
-                gry_kernels = self.gry_kernels
-            clr_isobox_w = self.clr_isobox_w
-            clr_avg_bins = self.clr_avg_bins
-            clr_kernels = self.clr_kernels
+        if self.include_gry_img:
+            gry_isobox_w, gry_avg_bins, gry_kernels = self._get_isoboxes('gry', s)
+        clr_isobox_w, clr_avg_bins, clr_kernels = self._get_isoboxes('clr', s)
 
         # print(clr_isobox_w, self.clr_isobox_w)
         # print([self.prob2std(p) for p in clr_avg_bins], [self.prob2std(p) for p in self.clr_avg_bins])
         # print(gry_isobox_w, self.gry_isobox_w)
         # print([self.prob2std(p) for p in gry_avg_bins], [self.prob2std(p) for p in self.gry_avg_bins])
         # t0 = time()
-        noise = self.gnoise(img) - img
-        clr_rescale_factor = self.clr_isobox_w[-1]/(self.clr_isobox_w[-1]+2*(clr_isobox_w[-1] - self.clr_isobox_w[-1]))
-        # gry_rescale_factor = self.gry_isobox_w[-1]/(self.gry_isobox_w[-1]+2*(gry_isobox_w[-1] - self.gry_isobox_w[-1]))
-        if (clr_rescale_factor < 1) and self.params.rescale_img_with_distance:
-            # print(s, clr_rescale_factor, gry_rescale_factor)
-            img = nn.functional.interpolate(nn.functional.interpolate(img, scale_factor=clr_rescale_factor, mode='bilinear'), size=tuple(img.shape[2:]), mode='bilinear')
-        img = img + noise
+        img = self._add_noise_and_rescale(img, clr_isobox_w)
         clr_filtered_img, cone_density_mat = self.apply_kernel(img, clr_isobox_w, clr_avg_bins, loc_idx, clr_kernels)
         if self.include_gry_img:
             # if (gry_rescale_factor < 1) and self.params.rescale_img_with_distance:
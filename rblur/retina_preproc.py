@@ -1,5 +1,7 @@
+from collections import OrderedDict
 from copy import deepcopy
 from enum import Enum, auto
+from itertools import groupby
 from random import shuffle
 from turtle import forward
 from types import FunctionType
@@ -20,6 +22,7 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 from einops import rearrange
 from retinawarp.retina import retina_pt
+from rblur.blur_backends import BLUR_BACKENDS, select_blur_backend
 
 def convert_image_tensor_to_ndarray(img):
     return img.cpu().detach().transpose(0,1).transpose(1,2).numpy()
@@ -78,11 +81,16 @@ def seperable_DoG_blur_pytorch(img, kernels):
     return img1-img2
 
 def _get_gaussian_filtered_image_and_density_mat_pytorch(img, isobox_w, avg_bins, loc_idx, kernels, kernel_width, shuffle_pixels=True, blur=True, gblur_fn=gaussian_blur_pytorch):
+    if isinstance(loc_idx, torch.Tensor) and (loc_idx.dim() == 2):
+        outputs = [_get_gaussian_filtered_image_and_density_mat_pytorch(img[[i]], isobox_w, avg_bins, tuple(li), kernels, kernel_width,
+                                                                        shuffle_pixels=shuffle_pixels, blur=blur, gblur_fn=gblur_fn)
+                    for i, li in enumerate(loc_idx.cpu().numpy().tolist())]
+        filtered_img, density_mat = zip(*outputs)
+        return torch.cat(filtered_img, 0), torch.cat(density_mat, 0)
     filtered_img = torch.zeros_like(img) if blur else img
     density_mat = torch.zeros_like(img)
-    padded_img = nn.ReflectionPad2d(kernel_width//2)(img)
-    half_ks = kernel_width//2
-    loc_idx_ = np.array(loc_idx)+half_ks
+    pad = max(k.shape[-1] for k in kernels)//2 if blur else kernel_width//2
+    padded_img = nn.ReflectionPad2d(pad)(img)
     # print(loc_idx_, padded_img.shape)
     imgsize = max(img.shape[2:])
     if (len(isobox_w) > 0) and (isobox_w >= imgsize).any():
@@ -96,8 +104,12 @@ def _get_gaussian_filtered_image_and_density_mat_pytorch(img, isobox_w, avg_bins
             # fimg = gaussian_blur_pytorch(img, kern)
             # filtered_crop = fimg[:,:, max(0,loc_idx[0]-w):loc_idx[0]+w][:,:,:,max(0,loc_idx[1]-w):loc_idx[1]+w]
             # crop = img[:,:, max(0,loc_idx[0]-w):loc_idx[0]+w][:,:,:,max(0,loc_idx[1]-w):loc_idx[1]+w]
+            # the crop is padded by the half width of this isobox's kernel, which may be
+            # smaller than the padding of the image.
             half_ks = kern.shape[-1] // 2
-            crop = padded_img[:,:, max(0,loc_idx_[0]-w-half_ks):loc_idx_[0]+w+half_ks][:,:,:,max(0,loc_idx_[1]-w-half_ks):loc_idx_[1]+w+half_ks]
+            r0, r1 = max(0, loc_idx[0]-w)+pad-half_ks, min(img.shape[2], loc_idx[0]+w)+pad+half_ks
+            c0, c1 = max(0, loc_idx[1]-w)+pad-half_ks, min(img.shape[3], loc_idx[1]+w)+pad+half_ks
+            crop = padded_img[:,:, r0:r1][:,:,:, c0:c1]
             # if shuffle_pixels and (w==max(isobox_w)):
             #     crop = local_pixel_shuffle(crop, 4)
             # print(w, half_ks, padded_img.shape, crop.shape, max(0,loc_idx_[0]-w-half_ks), loc_idx_[0]+w+half_ks, max(0,loc_idx_[1]-w-half_ks), loc_idx_[1]+w+half_ks)
@@ -108,6 +120,191 @@ def _get_gaussian_filtered_image_and_density_mat_pytorch(img, isobox_w, avg_bins
         density_mat[:,:,max(0,loc_idx[0]-w):loc_idx[0]+w][:,:,:,max(0,loc_idx[1]-w):loc_idx[1]+w] = p
     return filtered_img, density_mat
 
+def _get_active_isoboxes(isobox_w, imgsize):
+    # Isoboxes wider than the smallest isobox that covers the whole image are
+    # completely overwritten by it, so they can be skipped.
+    isobox_w = np.asarray(isobox_w)
+    if (isobox_w >= imgsize).any():
+        maxw = isobox_w[isobox_w >= imgsize].min()
+    else:
+        maxw = isobox_w.max()
+    return isobox_w <= maxw
+
+def _get_isobox_level_map(isobox_w, loc_idx, h, w, device=None):
+    '''
+    Returns a (h, w) tensor containing the index of the innermost isobox that covers
+    each pixel, or -1 if the pixel is not covered by any isobox. isobox_w must be
+    sorted in decreasing order. A pixel (i, j) lies in the isobox of width w_k iff
+    loc-w_k <= i < loc+w_k along both axes. If loc_idx is a (b, 2) tensor with one
+    location per sample, a (b, h, w) tensor is returned instead. With tensor isobox_w
+    and loc_idx only tensor operations are used, so the map can be traced.
+    '''
+    if not isinstance(isobox_w, torch.Tensor):
+        isobox_w = torch.as_tensor(np.asarray(isobox_w, dtype=np.int64), device=device)
+    if isinstance(loc_idx, torch.Tensor) and (loc_idx.dim() == 2):
+        loc_idx = loc_idx.to(device=device, dtype=torch.long)
+        di = torch.arange(h, device=device).unsqueeze(0) - loc_idx[:, [0]]
+        dj = torch.arange(w, device=device).unsqueeze(0) - loc_idx[:, [1]]
+    else:
+        di = torch.arange(h, device=device) - int(loc_idx[0])
+        dj = torch.arange(w, device=device) - int(loc_idx[1])
+    ri = torch.maximum(di, -di-1)
+    rj = torch.maximum(dj, -dj-1)
+    r = torch.maximum(ri.unsqueeze(-1), rj.unsqueeze(-2))
+    level_map = (isobox_w.view(-1, *([1]*r.dim())) > r.unsqueeze(0)).sum(0) - 1
+    return level_map
+
+def _pad_kernel(kernel, width, separable):
+    # zero-pads a 1D (separable) or 2D kernel symmetrically to the given width.
+    p = (width - kernel.shape[-1]) // 2
+    if p == 0:
+        return kernel
+    return nn.functional.pad(kernel, (p, p) if separable else (p, p, p, p))
+
+def _crop_kernel(kernel, width, separable):
+    # crops the central width taps of a 1D (separable) or 2D kernel, or of a bank of them.
+    c = kernel.shape[-1] // 2
+    r = width // 2
+    if width == kernel.shape[-1]:
+        return kernel
+    if separable:
+        return kernel[..., c-r:c+r+1]
+    return kernel[..., c-r:c+r+1, c-r:c+r+1]
+
+def _stack_isobox_kernels(kernels, dtype, device):
+    # Kernels with at most one tap >= 1e-4 are treated as identities by the
+    # per-isobox loop, so they are replaced by delta kernels here. Kernels of
+    # different sizes are zero-padded to the largest one.
+    kernels = list(kernels)
+    width = max(k.shape[-1] for k in kernels)
+    bank = torch.stack([_pad_kernel(k, width, k.dim() == 1) for k in kernels], 0).to(device=device, dtype=dtype)
+    delta = torch.zeros_like(bank)
+    center = bank.shape[-1] // 2
+    if bank.dim() == 2:
+        delta[:, center] = 1
+    else:
+        delta[:, center, center] = 1
+    is_blur = (bank >= 1e-4).flatten(1).sum(1) > 1
+    bank = torch.where(is_blur.view(-1, *([1]*(bank.dim()-1))), bank, delta)
+    return bank
+
+def isobox_filter_bank_blur_pytorch(img, bank, separable=False):
+    '''
+    Blurs img with every kernel in bank using a single grouped convolution (two if
+    the kernels are separable). img must already be padded by bank.shape[-1]//2.
+    Returns a tensor of shape (b, n_kernels, c, h, w).
+    '''
+    b, c = img.shape[:2]
+    L, ks = bank.shape[0], bank.shape[-1]
+    x = img.repeat(1, L, 1, 1)
+    W = torch.repeat_interleave(bank, c, 0).unsqueeze(1)
+    if separable:
+        x = nn.functional.conv2d(x, W.view(L*c, 1, 1, ks), groups=L*c)
+        x = nn.functional.conv2d(x, W.view(L*c, 1, ks, 1), groups=L*c)
+    else:
+        x = nn.functional.conv2d(x, W, groups=L*c)
+    return x.view(b, L, c, *(x.shape[2:]))
+
+def _blur_isobox_levels(img, bank, sizes, separable=False):
+    '''
+    Blurs the (unpadded) img with every kernel in bank and returns a (b, L, c, h, w)
+    tensor. bank is zero-padded to a common width and sizes contains the actual size
+    of each kernel. Consecutive kernels of the same size are applied together.
+    '''
+    stack = []
+    i = 0
+    for ks, group in groupby(sizes):
+        n = len(list(group))
+        sub_bank = _crop_kernel(bank[i:i+n], ks, separable)
+        padded_img = nn.ReflectionPad2d(ks // 2)(img)
+        stack.append(isobox_filter_bank_blur_pytorch(padded_img, sub_bank, separable=separable))
+        i += n
+    return torch.cat(stack, 1)
+
+def _reflection_pad_adjoint(x, p):
+    # Adjoint of nn.ReflectionPad2d(p): the gradient w.r.t. the padded border is added
+    # to the pixels it was reflected from.
+    if p == 0:
+        return x
+    h, w = x.shape[-2] - 2*p, x.shape[-1] - 2*p
+    x = x.clone()
+    x[..., :, p+1:2*p+1] += x[..., :, :p].flip(-1)
+    x[..., :, w-1:w+p-1] += x[..., :, w+p:].flip(-1)
+    x = x[..., :, p:p+w]
+    x[..., p+1:2*p+1, :] += x[..., :p, :].flip(-2)
+    x[..., h-1:h+p-1, :] += x[..., h+p:, :].flip(-2)
+    return x[..., p:p+h, :]
+
+def _blur_isobox_levels_adjoint(grad, bank, sizes, separable=False):
+    # Adjoint of _blur_isobox_levels. grad has shape (b, L, c, h, w) and the output has
+    # shape (b, c, h, w). The transpose of a convolution is a transposed convolution
+    # with the same kernel.
+    b, L, c, h, w = grad.shape
+    out = 0
+    i = 0
+    for ks, group in groupby(sizes):
+        n = len(list(group))
+        sub_bank = _crop_kernel(bank[i:i+n], ks, separable)
+        W = torch.repeat_interleave(sub_bank, c, 0).unsqueeze(1)
+        g = grad[:, i:i+n].reshape(b, n*c, h, w)
+        if separable:
+            g = nn.functional.conv_transpose2d(g, W.view(n*c, 1, ks, 1), groups=n*c)
+            g = nn.functional.conv_transpose2d(g, W.view(n*c, 1, 1, ks), groups=n*c)
+        else:
+            g = nn.functional.conv_transpose2d(g, W, groups=n*c)
+        g = g.view(b, n, c, *(g.shape[2:])).sum(1)
+        out = out + _reflection_pad_adjoint(g, ks // 2)
+        i += n
+    return out
+
+class IsoboxBlurComposite(torch.autograd.Function):
+    '''
+    Computes sum_l weights[:, l] * blur(img, bank[l]), i.e. blurs img with every kernel
+    in bank and composites the results using the per-pixel weights of shape
+    (1 or b, L, 1, h, w). The operation is linear in img so, instead of keeping the
+    blurred stack for the backward pass, the gradient is computed by applying the
+    adjoint operator. Only the kernels and the weights (which are cached by
+    RetinaBlurFilter) are saved. No gradients are computed for bank and weights.
+    '''
+    @staticmethod
+    def forward(ctx, img, bank, weights, sizes, separable):
+        ctx.save_for_backward(bank, weights)
+        ctx.sizes = sizes
+        ctx.separable = separable
+        return (_blur_isobox_levels(img, bank, sizes, separable) * weights).sum(1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        bank, weights = ctx.saved_tensors
+        grad_img = None
+        if ctx.needs_input_grad[0]:
+            grad_img = _blur_isobox_levels_adjoint(grad_output.unsqueeze(1) * weights, bank, ctx.sizes, ctx.separable)
+        return grad_img, None, None, None, None
+
+def _get_isobox_masks(level_map, nlevels, dtype):
+    # Returns one-hot (1 or b, nlevels, h, w) masks from a (h, w) or (b, h, w) level map.
+    if level_map.dim() == 2:
+        level_map = level_map.unsqueeze(0)
+    levels = torch.arange(nlevels, device=level_map.device).view(1, -1, 1, 1)
+    return (level_map.unsqueeze(1) == levels).to(dtype)
+
+def _gather_isobox_levels(stack, level_map):
+    '''
+    Gathers one foveated image per level map from a stack of blurred images.
+    stack has shape (b, L, c, h, w) and level_map has shape (K, h, w); the
+    output has shape (b, K, c, h, w). Pixels not covered by any isobox are 0.
+    '''
+    b, L, c, h, w = stack.shape
+    K = level_map.shape[0]
+    idx = level_map.clamp(min=0).view(1, K, 1, h, w).expand(b, K, c, h, w)
+    valid = (level_map >= 0).view(1, K, 1, h, w).to(stack.dtype)
+    return torch.gather(stack, 1, idx) * valid
+
+def _get_isobox_density(level_map, avg_bins, dtype):
+    # density of each pixel in level_map, 0 for pixels not covered by any isobox.
+    p = torch.as_tensor(np.asarray(avg_bins), dtype=dtype, device=level_map.device)
+    return torch.where(level_map >= 0, p[level_map.clamp(min=0)], torch.zeros((), dtype=dtype, device=level_map.device))
+
 def _merge_small_bins(hist, bins, min_count):
     new_bins = [bins[-1]]
     new_hist = []
@@ -135,6 +332,83 @@ def get_isodensity_box_width(probs, nbins, min_bincount=2):
     avg_bins = np.array(avg_bins)
     return np.cumsum(hist[::-1])[::-1], avg_bins, bins
 
+def _gaussian_kernel_l1_distance(std1, std2):
+    r = int(np.ceil(4*max(std1, std2)))
+    n = np.arange(-r, r+1)
+    g1 = np.exp(-n**2 / (2*std1**2))
+    g2 = np.exp(-n**2 / (2*std2**2))
+    return np.abs(g1/g1.sum() - g2/g2.sum()).sum()
+
+def _merged_isobox_densities(isobox_w, avg_bins, groups):
+    # density of every level once the levels of each group are merged, i.e. the average
+    # of the densities of the group weighted by the widths of its levels.
+    counts = isobox_w - np.append(isobox_w[1:], 0)
+    p = np.empty(len(isobox_w))
+    for g in groups:
+        p[g] = (counts[g] * avg_bins[g]).sum() / counts[g].sum()
+    return p
+
+def merge_isobox_levels(clr_isobox_w, clr_avg_bins, gry_isobox_w, gry_avg_bins, prob2std, budget):
+    '''
+    Greedily merges adjacent isobox levels of the cone (clr) and rod (gry) images,
+    cheapest first, as long as the foveated image changes by at most budget at every
+    pixel, for images in [0, 1] and view scale 0. Merging changes the blur kernel of a
+    pixel and also the weight a = p_clr / (p_clr + p_gry) with which the blurred cone
+    image C and rod image G are composited. The change of a*C + (1-a)*G is bounded by
+    a'*e_clr + (1-a')*e_gry + |a' - a|, where e is the L1 distance between the 1D
+    Gaussians of the original and merged levels, which bounds the change of a separable
+    blur. The bound only depends on the distance of the pixel to the fixation and is
+    evaluated at every distance covered by the isoboxes. gry_isobox_w is None if there
+    is no rod image. Returns the merged (isobox_w, avg_bins) of the cone and rod images
+    (None for the rods if gry_isobox_w is None) and the bound of the output error.
+    '''
+    names = ['clr'] if gry_isobox_w is None else ['clr', 'gry']
+    isobox_w = {'clr': np.asarray(clr_isobox_w), 'gry': None if gry_isobox_w is None else np.asarray(gry_isobox_w)}
+    avg_bins = {'clr': np.asarray(clr_avg_bins), 'gry': None if gry_avg_bins is None else np.asarray(gry_avg_bins)}
+    # level of the pixels at each distance from the fixation (see _get_isobox_level_map),
+    # merging keeps the outermost width so the covered distances do not change
+    rmax = min(isobox_w[n][0] for n in names)
+    levels = {n: (isobox_w[n][:, None] > np.arange(rmax)).sum(0) - 1 for n in names}
+    kernel_errors = {}
+
+    def kernel_error(p0, p1):
+        if (p0, p1) not in kernel_errors:
+            kernel_errors[(p0, p1)] = _gaussian_kernel_l1_distance(prob2std(p0), prob2std(p1))
+        return kernel_errors[(p0, p1)]
+
+    def output_error(groups):
+        d0, d1, e = {}, {}, {}
+        for n in names:
+            p = _merged_isobox_densities(isobox_w[n], avg_bins[n], groups[n])
+            e[n] = np.array([kernel_error(p0, p1) for p0, p1 in zip(avg_bins[n], p)])[levels[n]]
+            d0[n], d1[n] = avg_bins[n][levels[n]], p[levels[n]]
+        if len(names) == 1:
+            return float(e['clr'].max())
+        a0 = d0['clr'] / (d0['clr'] + d0['gry'])
+        a1 = d1['clr'] / (d1['clr'] + d1['gry'])
+        return float((a1*e['clr'] + (1-a1)*e['gry'] + np.abs(a1 - a0)).max())
+
+    groups = {n: [[i] for i in range(len(isobox_w[n]))] for n in names}
+    error = 0.
+    while True:
+        candidates = []
+        for n in names:
+            for i in range(len(groups[n])-1):
+                merged = dict(groups)
+                merged[n] = groups[n][:i] + [groups[n][i] + groups[n][i+1]] + groups[n][i+2:]
+                candidates.append((output_error(merged), merged))
+        if len(candidates) == 0:
+            break
+        cost, merged = min(candidates, key=lambda c: c[0])
+        if cost > budget:
+            break
+        groups, error = merged, cost
+    merged = {n: None for n in ['clr', 'gry']}
+    for n in names:
+        p = _merged_isobox_densities(isobox_w[n], avg_bins[n], groups[n])
+        merged[n] = (np.array([isobox_w[n][g[0]] for g in groups[n]]), np.array([p[g[0]] for g in groups[n]]))
+    return merged['clr'], merged['gry'], error
+
 def dist_to_prob(d, scale):
     rv = laplace(scale=scale)
     # # rv = levy_stable(1, 0, scale=scale)
@@ -296,7 +570,7 @@ class AbstractRetinaFilter(AbstractModel):
     @define(slots=False)
     class ModelParams(BaseParameters):
         input_shape: Union[int, List[int]] = None
-        loc_mode: Literal['center', 'random_uniform', 'random_five_fixations', 'five_fixations', 'const'] = 'random_uniform'
+        loc_mode: Literal['center', 'random_uniform', 'random_five_fixations', 'five_fixations', 'multi_fixations', 'const'] = 'random_uniform'
         loc: Tuple[int, int] = None
         batch_size: int = 128
         straight_through: bool = False
@@ -324,10 +598,13 @@ class AbstractRetinaFilter(AbstractModel):
         elif self.params.loc_mode == 'const':
             if isinstance(self.params.loc, tuple):
                 loc = self.params.loc
+            elif isinstance(self.params.loc, torch.Tensor):
+                # (N, 2) tensor with one location per sample
+                loc = self.params.loc[batch_idx*self.params.batch_size:(batch_idx+1)*self.params.batch_size]
             elif np.iterable(self.params.loc):
                 loc = self.params.loc[batch_idx]
             else:
-                raise ValueError(f'params.loc must be tuple or (nested) iterable of tuples, but got {self.params.loc}')
+                raise ValueError(f'params.loc must be tuple, (N, 2) tensor or (nested) iterable of tuples, but got {self.params.loc}')
         else:
             raise ValueError('params.loc_mode must be "center" or "random_uniform"')
         return loc
@@ -335,19 +612,30 @@ class AbstractRetinaFilter(AbstractModel):
     def _forward_batch(self, x, loc_idx):
         pass
 
+    def _forward_fixations(self, x, locs):
+        # Foveates every image in x at each location in locs and returns the 
+        # foveated images ordered as (image, fixation).
+        filtered = [self._forward_batch(x, loc) for loc in locs]
+        filtered = torch.stack(filtered, dim=1)
+        filtered = filtered.reshape(-1, *(filtered.shape[2:]))
+        return filtered
+
     def forward(self, x, loc_idx=None):
         if self.params.loc_mode in ['five_fixations', 'random_five_fixations']:
             locs = self._get_five_fixations(x, self.params.loc_mode.startswith('random'))
-            filtered = [self._forward_batch(x, loc) for loc in locs]
-            filtered = torch.stack(filtered, dim=1)
-            filtered = filtered.reshape(-1, *(filtered.shape[2:]))
+            filtered = self._forward_fixations(x, locs)
+        elif self.params.loc_mode == 'multi_fixations':
+            filtered = self._forward_fixations(x, self.params.loc)
         else:
             batches = torch.split(x, self.params.batch_size)
             # filtered = [self._forward_batch(b, self._get_loc(b,i) if loc_idx is None else loc_idx) for i,b in enumerate(batches)]
             filtered = []
             for i,b in enumerate(batches):
-                _loc_idx = self._get_loc(b,i) if loc_idx is None else loc_idx
-                if isinstance(_loc_idx, tuple):
+                if isinstance(loc_idx, torch.Tensor):
+                    _loc_idx = loc_idx[i*self.params.batch_size:(i+1)*self.params.batch_size]
+                else:
+                    _loc_idx = self._get_loc(b,i) if loc_idx is None else loc_idx
+                if isinstance(_loc_idx, (tuple, torch.Tensor)):
                     filtered.append(self._forward_batch(b, _loc_idx))
                 if isinstance(_loc_idx, list) and isinstance(_loc_idx[0], tuple):
                     fimg = torch.cat([self._forward_batch(b, li) for li in _loc_idx], 0)
@@ -374,6 +662,26 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         use_1d_gkernels: bool = False
         min_bincount: int = 224//16
         set_min_bin_to_1: bool = False
+        # adjacent isobox levels are merged as long as the worst-case change of the
+        # foveated image, due to the changes of the blur kernels and of the cone/rod
+        # composite weights, stays below isobox_merge_budget (see merge_isobox_levels).
+        # The bound is reported in isobox_merge_report. An integer view_scale is not
+        # supported with merging, since it counts levels.
+        isobox_merge_budget: float = 0.
+        blur_engine: Literal['loop', 'vectorized', 'auto'] = 'vectorized'
+        cache_size: int = 16
+        # used when blur_engine='auto' to pick the fastest Gaussian blur backend for
+        # each isobox among blur_backends (all registered backends if None) whose
+        # maximum error w.r.t. the direct convolution is below blur_backend_tolerance.
+        blur_backends: List[str] = None
+        blur_backend_tolerance: float = 1e-3
+        # the kernel of each isobox is truncated to the smallest support whose tail
+        # mass along each axis is at most kernel_tail_mass. If 0, all the kernels
+        # have size kernel_size.
+        kernel_tail_mass: float = 0.
+        # if True, the vectorized engine does not keep the blurred images for the backward
+        # pass and computes the gradient w.r.t. the input with the adjoint blur instead.
+        memory_efficient_grad: bool = False
 
     def __init__(self, params, eps=1e-5) -> None:
         super().__init__(params)
@@ -403,10 +711,27 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         self.gry_avg_bins = -gry_avg_bins
         self.gry_isobox_w = gry_isobox_w
 
+        if self.params.isobox_merge_budget > 0:
+            if isinstance(self.params.view_scale, int) and (self.params.view_scale > 0):
+                raise ValueError(f'an integer view_scale skips that many isobox levels, which is not meaningful once they are merged, but got view_scale={self.params.view_scale} with isobox_merge_budget={self.params.isobox_merge_budget}')
+            gry = (self.gry_isobox_w, self.gry_avg_bins) if self.include_gry_img else (None, None)
+            clr_merged, gry_merged, error = merge_isobox_levels(self.clr_isobox_w, self.clr_avg_bins, *gry, self.prob2std,
+                                                                self.params.isobox_merge_budget)
+            self.isobox_merge_report = {'clr_nlevels': len(self.clr_isobox_w), 'clr_merged_nlevels': len(clr_merged[0])}
+            self.clr_isobox_w, self.clr_avg_bins = clr_merged
+            if gry_merged is not None:
+                self.isobox_merge_report.update({'gry_nlevels': len(self.gry_isobox_w), 'gry_merged_nlevels': len(gry_merged[0])})
+                self.gry_isobox_w, self.gry_avg_bins = gry_merged
+            self.isobox_merge_report['max_output_error'] = error
+            clr_isobox_w, gry_isobox_w = self.clr_isobox_w, self.gry_isobox_w
+            print('isobox merging:', self.isobox_merge_report)
+
         clr_stds = [self.prob2std(p) for p in self.clr_avg_bins]
         gry_stds = [self.prob2std(p) for p in self.gry_avg_bins]
         print(clr_isobox_w, clr_stds)
         print(gry_isobox_w, gry_stds)
+        self.clr_stds = clr_stds
+        self.gry_stds = gry_stds
 
         if isinstance(self.params.view_scale, int):
             self.view_scale = min(self.params.view_scale, len(clr_stds), len(gry_stds))
@@ -427,21 +752,231 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         else:
             self.clr_kernels = [None]*len(self.clr_avg_bins)
             self.gry_kernels = [None]*len(self.gry_avg_bins)
+
+        # The kernels are also kept as (non-persistent) buffers so that they move
+        # with the module, and copies for other devices/dtypes are cached. Truncated
+        # kernels are zero-padded to kernel_size in the buffers.
+        if self.apply_blur:
+            self.clr_kernel_sizes = [k.shape[-1] for k in self.clr_kernels]
+            self.register_buffer('clr_kernel_bank', torch.stack([_pad_kernel(k, self.kernel_size, self.params.use_1d_gkernels) for k in self.clr_kernels], 0), persistent=False)
+            if self.include_gry_img:
+                self.gry_kernel_sizes = [k.shape[-1] for k in self.gry_kernels]
+                self.register_buffer('gry_kernel_bank', torch.stack([_pad_kernel(k, self.kernel_size, self.params.use_1d_gkernels) for k in self.gry_kernels], 0), persistent=False)
+            if self.params.kernel_tail_mass > 0:
+                print('kernel truncation:', self.get_kernel_truncation_report())
+        self._kernel_cache = {}
+        self._weight_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
     
+    def get_truncated_kernel_size(self, std):
+        if self.params.kernel_tail_mass <= 0:
+            return self.kernel_size
+        g = gaussian_fn(self.kernel_size, std=std).double()
+        c = self.kernel_size // 2
+        # mass outside [c-r, c+r] for r = 0, 1, ..., c
+        tail = 1 - torch.cumsum(torch.cat([g[c:c+1], 2*g[c+1:]]), 0)
+        r = int((tail > self.params.kernel_tail_mass).sum())
+        return 2*r+1
+
     def create_kernels(self, std_list):
+        sizes = [self.get_truncated_kernel_size(s) for s in std_list]
         if self.params.use_1d_gkernels:
-            return [gaussian_fn(self.kernel_size, std=s) for s in std_list]
+            return [gaussian_fn(k, std=s) for k, s in zip(sizes, std_list)]
         else:
-            return [gkern(self.kernel_size, s) for s in std_list]
+            return [gkern(k, s) for k, s in zip(sizes, std_list)]
+
+    def get_kernel_truncation_report(self):
+        '''
+        Compares the truncated kernels with the untruncated ones of size kernel_size.
+        Reports the number of multiply-adds per pixel and channel needed to blur with
+        all the kernels, and the worst-case absolute pixel error caused by the truncation
+        for images in [0, 1], which is half the L1 distance between the kernels.
+        '''
+        report = {}
+        separable = self.params.use_1d_gkernels
+        names = ['clr', 'gry'] if self.include_gry_img else ['clr']
+        for name in names:
+            full_flops = trunc_flops = max_err = 0
+            for std, kern in zip(getattr(self, f'{name}_stds'), getattr(self, f'{name}_kernels')):
+                full = gaussian_fn(self.kernel_size, std=std) if separable else gkern(self.kernel_size, std)
+                trunc = _pad_kernel(kern, self.kernel_size, separable)
+                full_flops += 2*self.kernel_size if separable else self.kernel_size**2
+                trunc_flops += 2*kern.shape[-1] if separable else kern.shape[-1]**2
+                max_err = max(max_err, 0.5*float((full - trunc).abs().sum()))
+            report[name] = {
+                'kernel_sizes': getattr(self, f'{name}_kernel_sizes'),
+                'flops': trunc_flops,
+                'untruncated_flops': full_flops,
+                'flop_reduction': full_flops / trunc_flops,
+                'max_pixel_error': max_err
+            }
+        return report
         # return nn.ParameterList([nn.parameter.Parameter(gaussian_fn(int(np.ceil(4*s)), std=s), requires_grad=False) for s in std_list])
     
     def apply_kernel(self, img, isobox_w, avg_bins, loc_idx, kernels):
+        # only used by the 'loop' engine, the others go through _forward_batch_vectorized
         gfn = seperable_gaussian_blur_pytorch if self.params.use_1d_gkernels else gaussian_blur_pytorch
         return _get_gaussian_filtered_image_and_density_mat_pytorch(img, isobox_w, avg_bins, loc_idx, 
                                                             kernels, self.kernel_size, blur=self.apply_blur,
                                                             gblur_fn=gfn
                                                             )
     
+    def _get_kernels(self, name, dtype, device):
+        key = (name, str(device), dtype)
+        if key not in self._kernel_cache:
+            if self.apply_blur:
+                bank = getattr(self, f'{name}_kernel_bank').to(device=device, dtype=dtype)
+                sizes = getattr(self, f'{name}_kernel_sizes')
+                self._kernel_cache[key] = [_crop_kernel(k, ks, self.params.use_1d_gkernels) for k, ks in zip(bank, sizes)]
+            else:
+                self._kernel_cache[key] = getattr(self, f'{name}_kernels')
+        return self._kernel_cache[key]
+
+    def _get_filter_bank(self, name, dtype, device):
+        key = (f'{name}_bank', str(device), dtype)
+        if key not in self._kernel_cache:
+            self._kernel_cache[key] = _stack_isobox_kernels(self._get_kernels(name, dtype, device), dtype, device)
+        return self._kernel_cache[key]
+
+    def _get_identity_levels(self, name):
+        key = (f'{name}_identity',)
+        if key not in self._kernel_cache:
+            bank = getattr(self, f'{name}_kernel_bank')
+            self._kernel_cache[key] = ((bank >= 1e-4).flatten(1).sum(1) <= 1).tolist()
+        return self._kernel_cache[key]
+
+    def _blur_stack(self, name, img, start):
+        # Returns img blurred with each of the kernels from start onwards as a
+        # (b, L, c, h, w) tensor.
+        if self.params.blur_engine == 'auto':
+            kernels = self._get_kernels(name, img.dtype, img.device)[start:]
+            stds = getattr(self, f'{name}_stds')[start:]
+            is_identity = self._get_identity_levels(name)[start:]
+            stack = []
+            for k, std, ident in zip(kernels, stds, is_identity):
+                if ident:
+                    stack.append(img)
+                else:
+                    backend = select_blur_backend(img, std, k, tolerance=self.params.blur_backend_tolerance, backends=self.params.blur_backends)
+                    stack.append(BLUR_BACKENDS[backend](img, std, k))
+            return torch.stack(stack, 1)
+        bank = self._get_filter_bank(name, img.dtype, img.device)[start:]
+        sizes = getattr(self, f'{name}_kernel_sizes')[start:]
+        return _blur_isobox_levels(img, bank, sizes, separable=self.params.use_1d_gkernels)
+
+    def _blur_and_composite(self, name, img, start, weights):
+        if self.params.memory_efficient_grad and (self.params.blur_engine == 'vectorized'):
+            bank = self._get_filter_bank(name, img.dtype, img.device)[start:]
+            sizes = tuple(getattr(self, f'{name}_kernel_sizes')[start:])
+            return IsoboxBlurComposite.apply(img, bank, weights, sizes, self.params.use_1d_gkernels)
+        return (self._blur_stack(name, img, start) * weights).sum(1)
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self._weight_cache), 'maxsize': self.params.cache_size}
+
+    def clear_cache(self):
+        self._kernel_cache.clear()
+        self._weight_cache.clear()
+        self.cache_hits = self.cache_misses = 0
+
+    def _get_isobox_weights(self, isobox_w, avg_bins, loc_idx, h, w, dtype, device):
+        active = _get_active_isoboxes(isobox_w, max(h, w))
+        nskip = int((~active).sum())
+        isobox_w = np.asarray(isobox_w)[nskip:]
+        avg_bins = np.asarray(avg_bins)[nskip:]
+        masks = _get_isobox_masks(_get_isobox_level_map(isobox_w, loc_idx, h, w, device=device), len(isobox_w), dtype)
+        p = torch.as_tensor(avg_bins, dtype=dtype, device=device).view(1, -1, 1, 1)
+        density_mat = (masks * p).sum(1, keepdim=True)
+        return nskip, masks, density_mat
+
+    def _get_isoboxes(self, name, s):
+        isobox_w = getattr(self, f'{name}_isobox_w')
+        avg_bins = getattr(self, f'{name}_avg_bins')
+        if s > 0:
+            return isobox_w[:-s], avg_bins[s:]
+        return isobox_w, avg_bins
+
+    def _compute_composite_weights(self, img_shape, loc_idx, s, dtype, device):
+        # Returns, for the color and grey images, the number of isoboxes that can be skipped
+        # and the weight of each blurred image in the final image at each pixel.
+        h, w = img_shape[-2:]
+        clr_isobox_w, clr_avg_bins = self._get_isoboxes('clr', s)
+        clr_nskip, clr_wts, cone_density_mat = self._get_isobox_weights(clr_isobox_w, clr_avg_bins, loc_idx, h, w, dtype, device)
+        if self.include_gry_img:
+            gry_isobox_w, gry_avg_bins = self._get_isoboxes('gry', s)
+            gry_nskip, gry_wts, rod_density_mat = self._get_isobox_weights(gry_isobox_w, gry_avg_bins, loc_idx, h, w, dtype, device)
+            total_density = rod_density_mat + cone_density_mat
+            clr_wts = clr_wts * (cone_density_mat / total_density)
+            gry_wts = gry_wts * (rod_density_mat / total_density)
+            gry_wts = gry_wts.unsqueeze(2)
+        else:
+            gry_nskip, gry_wts = 0, None
+        return clr_nskip, clr_wts.unsqueeze(2), gry_nskip, gry_wts
+
+    def _get_composite_weights(self, img, loc_idx, s):
+        if isinstance(loc_idx, torch.Tensor) and (loc_idx.dim() == 2):
+            # per-sample locations are not cached
+            return self._compute_composite_weights(img.shape, loc_idx, s, img.dtype, img.device)
+        key = (tuple(img.shape[1:]), tuple(int(l) for l in loc_idx), s, img.dtype, str(img.device))
+        if key in self._weight_cache:
+            self.cache_hits += 1
+            self._weight_cache.move_to_end(key)
+            return self._weight_cache[key]
+        self.cache_misses += 1
+        weights = self._compute_composite_weights(img.shape, loc_idx, s, img.dtype, img.device)
+        if self.params.cache_size > 0:
+            self._weight_cache[key] = weights
+            if len(self._weight_cache) > self.params.cache_size:
+                self._weight_cache.popitem(last=False)
+        return weights
+
+    def _forward_batch_vectorized(self, img, loc_idx, s):
+        if (not self.apply_blur) and (not self.include_gry_img):
+            return img
+        clr_nskip, clr_wts, gry_nskip, gry_wts = self._get_composite_weights(img, loc_idx, s)
+        # all the channels of the grey image are identical so only one needs to be blurred
+        grey_img = img.mean(1, keepdims=True)
+        if self.apply_blur:
+            final_img = self._blur_and_composite('clr', img, s+clr_nskip, clr_wts)
+            if self.include_gry_img:
+                final_img = final_img + self._blur_and_composite('gry', grey_img, s+gry_nskip, gry_wts)
+        else:
+            final_img = img * clr_wts.sum(1) + grey_img * gry_wts.sum(1)
+        return final_img
+
+    def _foveate_at_fixations(self, name, img, locs, s):
+        # Blurs img once with every kernel of the filter bank and gathers the foveated
+        # image for each location in locs from the blurred stack.
+        h, w = img.shape[-2:]
+        isobox_w, avg_bins = self._get_isoboxes(name, s)
+        nskip = int((~_get_active_isoboxes(isobox_w, max(h, w))).sum())
+        level_map = _get_isobox_level_map(np.asarray(isobox_w)[nskip:], locs, h, w, device=img.device)
+        density_mat = _get_isobox_density(level_map, np.asarray(avg_bins)[nskip:], img.dtype).unsqueeze(1)
+        if self.apply_blur:
+            stack = self._blur_stack(name, img, s+nskip)
+            fimg = _gather_isobox_levels(stack, level_map)
+        else:
+            fimg = img.unsqueeze(1)
+        return fimg, density_mat
+
+    def _forward_fixations(self, img, locs):
+        if self.params.blur_engine == 'loop':
+            return super()._forward_fixations(img, locs)
+        b, c, h, w = img.shape
+        s = self._get_view_scale()
+        assert not ((self.params.view_scale is None) and (s > 0))
+        if not isinstance(locs, torch.Tensor):
+            locs = torch.tensor(np.array(locs, dtype=np.int64))
+        locs = locs.to(img.device)
+        clr_filtered_img, cone_density_mat = self._foveate_at_fixations('clr', img, locs, s)
+        if self.include_gry_img:
+            gry_filtered_img, rod_density_mat = self._foveate_at_fixations('gry', img.mean(1, keepdims=True), locs, s)
+            final_img = (rod_density_mat*gry_filtered_img + cone_density_mat*clr_filtered_img) / (rod_density_mat+cone_density_mat)
+        else:
+            final_img = clr_filtered_img.expand(b, len(locs), c, h, w)
+        return final_img.reshape(-1, c, h, w)
+
     def __repr__(self):
         return f'RetinaBlurFilter(loc_mode={self.params.loc_mode}, cone_std={self.cone_std}, rod_std={self.rod_std}, max_rod_density={self.max_rod_density}, kernel_size={self.kernel_size}, view_scale={self.view_scale}, beta={self.scale})'
     
@@ -466,30 +1001,30 @@ class RetinaBlurFilter(AbstractRetinaFilter):
         s = self._get_view_scale()
         # print(f'view_scale={s}')
         assert not ((self.params.view_scale is None) and (s > 0))
+        if self.params.blur_engine != 'loop':
+            return self._forward_batch_vectorized(img, loc_idx, s)
         if s > 0:
             if self.include_gry_img:
                 gry_isobox_w = self.gry_isobox_w[:-s]
                 gry_avg_bins = self.gry_avg_bins[s:]
-                gry_kernels = self.gry_kernels[s:]
+                gry_kernels = self._get_kernels('gry', img.dtype, img.device)[s:]
             clr_isobox_w = self.clr_isobox_w[:-s]
             clr_avg_bins = self.clr_avg_bins[s:]
-            clr_kernels = self.clr_kernels[s:]
+            clr_kernels = self._get_kernels('clr', img.dtype, img.device)[s:]
         else:
             if self.include_gry_img:
                 gry_isobox_w = self.gry_isobox_w
                 gry_avg_bins = self.gry_avg_bins
-                gry_kernels = self.gry_kernels
+                gry_kernels = self._get_kernels('gry', img.dtype, img.device)
             clr_isobox_w = self.clr_isobox_w
             clr_avg_bins = self.clr_avg_bins
-            clr_kernels = self.clr_kernels
-        clr_kernels = [k.type(img.dtype).to(img.device) if k is not None else k for k in clr_kernels]
+            clr_kernels = self._get_kernels('clr', img.dtype, img.device)
         # print(clr_isobox_w, self.clr_isobox_w)
         # print([self.prob2std(p) for p in clr_avg_bins], [self.prob2std(p) for p in self.clr_avg_bins])
         # print(gry_isobox_w, self.gry_isobox_w)
         # print([self.prob2std(p) for p in gry_avg_bins], [self.prob2std(p) for p in self.gry_avg_bins])
         clr_filtered_img, cone_density_mat = self.apply_kernel(img, clr_isobox_w, clr_avg_bins, loc_idx, clr_kernels)
         if self.include_gry_img:
-            gry_kernels = [k.type(img.dtype).to(img.device) if k is not None else k for k in gry_kernels]
             grey_img = torch.repeat_interleave(img.mean(1, keepdims=True), 3, 1)
             gry_filtered_img, rod_density_mat = self.apply_kernel(grey_img, gry_isobox_w, gry_avg_bins, loc_idx, gry_kernels)
 
@@ -533,6 +1068,7 @@ class RetinDoGBlurFilter(RetinaBlurFilter):
     @define(slots=False)
     class ModelParams(RetinaBlurFilter.ModelParams):
         DoG_factor: int = 5
+        blur_engine: Literal['loop'] = 'loop'
 
     # def prob2std(self, p):
     #     s = self.params.DoG_factor*self.scale*max(self.input_shape[1:])*(1-p) + 1e-5
@@ -551,6 +1087,97 @@ class RetinDoGBlurFilter(RetinaBlurFilter):
                                                             gblur_fn=gfn
                                                             )
 
+class StaticRetinaBlurFilter(nn.Module):
+    '''
+    Equivalent of the vectorized RetinaBlurFilter for a fixed input shape that only
+    uses tensor operations in its forward pass, so that it can be compiled with
+    torch.compile or exported with TorchScript and ONNX. The active isoboxes, kernel
+    sizes and view scale are resolved at construction and, for the 'center' and 'const'
+    loc modes, the composite weights are precomputed. Locations can also be passed
+    to forward as a (b, 2) tensor, in which case the weights are computed on the fly.
+    Only this RetinaBlurFilter has a static version; RetinaSampleFilter and the
+    RetinaBlurFilter of retina_blur2 (embed_and_foveate) do not.
+    '''
+    def __init__(self, retina: RetinaBlurFilter, input_shape=None) -> None:
+        super().__init__()
+        params = retina.params
+        if isinstance(retina, RetinDoGBlurFilter):
+            raise ValueError('RetinDoGBlurFilter is not supported')
+        if params.loc_mode not in ['center', 'const', 'random_uniform']:
+            raise ValueError(f'loc_mode must be center, const or random_uniform but got {params.loc_mode}')
+        if (params.loc_mode == 'const') and not isinstance(params.loc, tuple):
+            raise ValueError(f'loc must be a tuple in const mode but got {params.loc}')
+        if not ((retina.view_scale is None) or isinstance(retina.view_scale, int)):
+            raise ValueError(f'view_scale must be None or an int but got {retina.view_scale}')
+        c, h, w = input_shape if input_shape is not None else retina.input_shape
+        self.h, self.w = h, w
+        self.loc_mode = params.loc_mode
+        self.straight_through = params.straight_through
+        self.apply_blur = retina.apply_blur
+        self.include_gry_img = retina.include_gry_img
+        self.separable = params.use_1d_gkernels
+        s = retina._get_view_scale()
+
+        self.names = ['clr', 'gry'] if self.include_gry_img else ['clr']
+        for name in self.names:
+            isobox_w, avg_bins = retina._get_isoboxes(name, s)
+            nskip = int((~_get_active_isoboxes(isobox_w, max(h, w))).sum())
+            self.register_buffer(f'{name}_isobox_w', torch.as_tensor(np.asarray(isobox_w, dtype=np.int64)[nskip:]))
+            self.register_buffer(f'{name}_avg_bins', torch.as_tensor(np.asarray(avg_bins, dtype=np.float32)[nskip:]))
+            if self.apply_blur:
+                self.register_buffer(f'{name}_bank', retina._get_filter_bank(name, torch.float32, 'cpu')[s+nskip:].clone())
+                setattr(self, f'{name}_kernel_sizes', tuple(getattr(retina, f'{name}_kernel_sizes')[s+nskip:]))
+
+        if self.loc_mode != 'random_uniform':
+            loc = (h//2, h//2) if self.loc_mode == 'center' else params.loc
+            clr_wts, gry_wts = self._get_composite_weights(torch.tensor([loc]), self.clr_isobox_w.device)
+            self.register_buffer('clr_wts', clr_wts)
+            self.register_buffer('gry_wts', gry_wts)
+
+    def _get_composite_weights(self, loc, device):
+        clr_masks = _get_isobox_masks(_get_isobox_level_map(self.clr_isobox_w, loc, self.h, self.w, device=device), len(self.clr_isobox_w), self.clr_avg_bins.dtype)
+        if not self.include_gry_img:
+            return clr_masks.unsqueeze(2), torch.zeros_like(clr_masks[:, :1]).unsqueeze(2)
+        gry_masks = _get_isobox_masks(_get_isobox_level_map(self.gry_isobox_w, loc, self.h, self.w, device=device), len(self.gry_isobox_w), self.gry_avg_bins.dtype)
+        cone_density = (clr_masks * self.clr_avg_bins.view(1, -1, 1, 1)).sum(1, keepdim=True)
+        rod_density = (gry_masks * self.gry_avg_bins.view(1, -1, 1, 1)).sum(1, keepdim=True)
+        total_density = cone_density + rod_density
+        clr_wts = clr_masks * (cone_density / total_density)
+        gry_wts = gry_masks * (rod_density / total_density)
+        return clr_wts.unsqueeze(2), gry_wts.unsqueeze(2)
+
+    def forward(self, x, loc=None):
+        if loc is not None:
+            clr_wts, gry_wts = self._get_composite_weights(loc.long(), x.device)
+        elif self.loc_mode == 'random_uniform':
+            loc = torch.cat([torch.randint(0, self.h, (1, 1), device=x.device), torch.randint(0, self.w, (1, 1), device=x.device)], 1)
+            clr_wts, gry_wts = self._get_composite_weights(loc, x.device)
+        else:
+            clr_wts, gry_wts = self.clr_wts, self.gry_wts
+        clr_wts = clr_wts.to(x.dtype)
+        gry_wts = gry_wts.to(x.dtype)
+        if (not self.apply_blur) and (not self.include_gry_img):
+            filtered = x
+        elif self.apply_blur:
+            filtered = (_blur_isobox_levels(x, self.clr_bank.to(x.dtype), self.clr_kernel_sizes, self.separable) * clr_wts).sum(1)
+            if self.include_gry_img:
+                grey_img = x.mean(1, keepdim=True)
+                filtered = filtered + (_blur_isobox_levels(grey_img, self.gry_bank.to(x.dtype), self.gry_kernel_sizes, self.separable) * gry_wts).sum(1)
+        else:
+            filtered = x * clr_wts.sum(1) + x.mean(1, keepdim=True) * gry_wts.sum(1)
+        if self.straight_through:
+            return filtered.detach() + x - x.detach()
+        return filtered
+
+    def compute_loss(self, x, y, return_logits=True):
+        out = self.forward(x)
+        logits = out
+        loss = torch.zeros((x.shape[0],), dtype=x.dtype, device=x.device)
+        if return_logits:
+            return logits, loss
+        else:
+            return loss
+
 class RetinaSampleFilter(AbstractModel):
     @define(slots=False)
     class ModelParams(BaseParameters):
@@ -49,6 +49,7 @@ parser.add_argument('--N', type=int, default=49)
 parser.add_argument('--worst_case', action='store_true')
 parser.add_argument('--plot_examples', action='store_true')
 parser.add_argument('--num_examples', type=int, default=9)
+parser.add_argument('--fixations_per_pass', type=int, default=7, help='number of fixation points evaluated in one forward pass when eps=0')
 
 args = parser.parse_args()
 
@@ -100,7 +101,22 @@ if not args.plot_examples:
         total += x.shape[0]
         lmap = np.zeros((x.shape[0], nclasses, x.shape[2], x.shape[3]))
         c = np.zeros((x.shape[0],), dtype=bool)
-        for i, l in enumerate(locs):
+        if args.eps == 0:
+            # Without an attack the retina can foveate each image at several fixation
+            # points in one pass while blurring the image only once.
+            loc_correct = []
+            for i in range(0, len(locs), args.fixations_per_pass):
+                locs_ = locs[i:i+args.fixations_per_pass]
+                set_param(model.params, 'loc_mode', 'multi_fixations')
+                set_param(model.params, 'loc', locs_)
+                logits = model(x).detach().cpu().reshape(x.shape[0], len(locs_), -1)
+                loc_correct.append((torch.argmax(logits, -1) == y.unsqueeze(1)).numpy())
+            loc_correct = np.concatenate(loc_correct, 1)
+            c = loc_correct.all(1) if args.worst_case else loc_correct.any(1)
+            locs_to_eval = []
+        else:
+            locs_to_eval = locs
+        for i, l in enumerate(locs_to_eval):
             if (not c.all()) or i==0:
                 if not args.plot_examples:
                     if (args.worst_case) and (i>0):
@@ -158,7 +158,10 @@ class AdversarialAttackBatteryRunner(AdversarialExperimentRunner):
             while is_exp_complete(exp_num):
                 exp_num += 1
             logdir = os.path.join(logdir, str(exp_num))
-            if os.path.exists(logdir):
+            # an incomplete experiment with battery checkpoints is resumed instead of restarted
+            if os.path.exists(os.path.join(logdir, 'battery_checkpoints')):
+                print(f'resuming incomplete attack battery in {logdir}')
+            elif os.path.exists(logdir):
                 shutil.rmtree(logdir)
             print(f'writing logs to {logdir}')
             return logdir
@@ -51,6 +51,7 @@ parser.add_argument('--image_dir', type=str)
 parser.add_argument('--split', type=str, default='train')
 parser.add_argument('--logit_map_output_dir', type=str)
 parser.add_argument('--overwrite', action='store_true')
+parser.add_argument('--fixations_per_pass', type=int, default=7, help='number of fixation points evaluated in one forward pass when eps=0')
 
 args = parser.parse_args()
 
@@ -120,13 +121,25 @@ for i,batch in enumerate(t):
     loc_correct = []
     loc_probs = []
     c = np.zeros((x.shape[0],), dtype=bool)
-    for l in locs:
-        set_param(model.params, 'loc_mode', 'const')
-        # set_param(model.params, 'loc', (vf_rad - l[0], vf_rad - l[1]))
-        set_param(model.params, 'loc', (l[0], l[1]))
-        if args.eps > 0:
+    if args.eps > 0:
+        all_loc_logits = []
+        for l in locs:
+            set_param(model.params, 'loc_mode', 'const')
+            # set_param(model.params, 'loc', (vf_rad - l[0], vf_rad - l[1]))
+            set_param(model.params, 'loc', (l[0], l[1]))
             x = APGD(model, eps=args.eps)(x, y)
-        logits = model(x).detach().cpu()
+            all_loc_logits.append(model(x).detach().cpu())
+    else:
+        # Without an attack the retina can foveate each image at several fixation
+        # points in one pass while blurring the image only once.
+        all_loc_logits = []
+        for i in range(0, len(locs), args.fixations_per_pass):
+            locs_ = locs[i:i+args.fixations_per_pass]
+            set_param(model.params, 'loc_mode', 'multi_fixations')
+            set_param(model.params, 'loc', locs_)
+            logits = model(x).detach().cpu().reshape(x.shape[0], len(locs_), -1)
+            all_loc_logits.extend(logits.unbind(1))
+    for l, logits in zip(locs, all_loc_logits):
         yp = torch.argmax(logits,1)
         c_ = (y == yp).numpy()
         c |= c_
@@ -5,6 +5,7 @@ from mllib.datasets.dataset_factory import (ImageDatasetFactory,
 import torchvision
 from rblur.trainers import AdversarialParams, AdversarialTrainer
 from rblur.utils import gethostname
+from rblur.fixation_prediction.fixation_map_store import FixationMapStoreDatasetFactory, has_fixation_map_store
 from mllib.adversarial.attacks import (AttackParamFactory, SupportedAttacks,
                                        SupportedBackend)
 from mllib.runners.configs import BaseExperimentConfig
@@ -59,6 +60,8 @@ def get_dataset_params(datafolder, dataset, num_train=13_000, num_test=500, trai
     p.max_num_train = num_train
     p.max_num_test = num_test
     p.kwargs = kwargs
+    if ('fixation_map_root' in kwargs) and has_fixation_map_store(kwargs['fixation_map_root']):
+        p.cls = FixationMapStoreDatasetFactory
     if train_transforms is not None:
         train_transforms.append(torchvision.transforms.ToTensor())
     else:
@@ -1,6 +1,8 @@
+from contextlib import contextmanager
 from copy import deepcopy
 from enum import Enum, auto
 from hashlib import sha224
+import json
 import os
 import shutil
 from time import time
@@ -28,6 +30,8 @@ import pytorch_lightning as pl
 from mllib.adversarial.attacks import AbstractAttackConfig, FoolboxAttackWrapper, FoolboxCWL2AttackWrapper, AutoAttackkWrapper
 from mllib.adversarial.randomized_smoothing.core import Smooth
 from rblur.pruning import PruningMixin
+from rblur.warm_start_attacks import WarmStartMixin
+from rblur.stacked_attacks import StackedEpsilonAPGDAttack
 from rblur.utils import aggregate_dicts, merge_iterables_in_dict, write_json, write_pickle, load_json, recursive_dict_update, load_pickle
 
 import torchmetrics
@@ -49,6 +53,21 @@ def get_hash(x: Union[List, np.ndarray, torch.Tensor]):
 class AdversarialParams:
     training_attack_params: AbstractAttackConfig = None
     testing_attack_params: List[AbstractAttackConfig] = [None]
+    # Used by MultiAttackEvaluationTrainer. If not 'off', the attacks of each family are
+    # run in increasing order of epsilon and samples that are misclassified at a smaller
+    # epsilon are not attacked again. In the 'exact' mode the adversarial examples carried
+    # over from the smaller epsilon are re-evaluated, and the samples that are correctly
+    # classified again (e.g. if the model is stochastic) are attacked.
+    epsilon_ladder_pruning: Literal['off', 'monotone', 'exact'] = 'off'
+    # Used by MultiAttackEvaluationTrainer. If True, the attacks with the same epsilon are
+    # run as a cascade, in the given order, and each attack is only run on the samples
+    # that the previous ones did not break. Samples are reused as in the epsilon ladder,
+    # in the 'monotone' mode unless epsilon_ladder_pruning is 'exact'.
+    attack_cascade: bool = False
+    # Used by MultiAttackEvaluationTrainer. If True, the results of every (attack, batch)
+    # pair are checkpointed as soon as they are computed, and the attacks that have been
+    # completed on a batch are skipped when the evaluation is restarted.
+    checkpoint_battery: bool = False
 
 class AdversarialTrainer(_Trainer, PruningMixin):    
     @define(slots=False)    
@@ -253,6 +272,13 @@ def save_pred_and_label_csv(logdir, outfile, preds, labels, logits, atk_norms):
             for p,l,r,sl,nrm in zip(preds[atkname], labels, label_ranks, sorted_logits, atk_norms[atkname]):
                 f.write(f'{l},{p},{sl[-2]},{sl[-3]},{sl[-4]},{sl[-5]},{r},{nrm}\n')
 
+# torchattacks attacks without a norm attribute whose perturbations are bounded in each norm
+_TORCHATTACKS_NORMS = {
+    'Linf': ['FGSM', 'BIM', 'PGD', 'MIFGSM', 'TPGD', 'RFGSM', 'FFGSM', 'EOTPGD', 'DIFGSM', 'TIFGSM', 'NIFGSM',
+             'SINIFGSM', 'VMIFGSM', 'VNIFGSM', 'PIFGSM', 'PIFGSMPP', 'Jitter', 'UPGD', 'PGDRS', 'SPSA'],
+    'L2': ['PGDL2', 'PGDRSL2'],
+}
+
 def save_pred_and_label_csv_2(logdir, outfile, preds, labels, batch_idx):
     mode = 'a' if batch_idx > 0 else 'w'
     for atkname in preds.keys():
@@ -279,6 +305,16 @@ class MultiAttackEvaluationTrainer(AdversarialTrainer):
             os.makedirs(self.per_sample_logdir)
         if not os.path.exists(self.per_attack_logdir):
             os.makedirs(self.per_attack_logdir)
+        self.epsilon_ladder_stats = {'attacked': 0, 'pruned': 0}
+        self.attack_cascade_stats = {}
+        if self.params.adversarial_params.checkpoint_battery:
+            self.battery_ckp_dir = self._get_battery_checkpoint_dir()
+            self.battery_manifest_path = os.path.join(self.battery_ckp_dir, 'progress.jsonl')
+            self.battery_progress, csv_sizes = self._load_battery_manifest()
+            self._truncate_uncommitted_csv_rows(csv_sizes)
+            if len(self.battery_progress) > 0:
+                print(f'resuming attack battery from {self.battery_ckp_dir} ({len(self.battery_progress)} batches checkpointed)')
+            os.makedirs(self.battery_ckp_dir, exist_ok=True)
 
     def _maybe_initialize_logger(self):
         self.global_step = 0
@@ -318,11 +354,277 @@ class MultiAttackEvaluationTrainer(AdversarialTrainer):
 
         print('test metrics:')
         print(metrics)
+        if self.params.adversarial_params.epsilon_ladder_pruning != 'off':
+            print('epsilon ladder pruning:', self.epsilon_ladder_stats)
+        if self.params.adversarial_params.attack_cascade:
+            cascade_stats = self.get_attack_cascade_stats()
+            for k, v in cascade_stats.items():
+                print(k, v)
+            write_json(cascade_stats, os.path.join(self.logdir, 'attack_cascade_stats.json'))
+        warm_start_stats = self.get_warm_start_stats()
+        if len(warm_start_stats) > 0:
+            print('warm start:', warm_start_stats)
+            write_json(warm_start_stats, os.path.join(self.logdir, 'warm_start_stats.json'))
         self.save_logs_after_test({'train_accuracy': 0.}, outputs)
+        if self.params.adversarial_params.checkpoint_battery:
+            # the results are merged into the final outputs, so the checkpoints are no longer needed
+            shutil.rmtree(self.battery_ckp_dir, ignore_errors=True)
         return new_outputs, metrics
 
+    def _get_battery_checkpoint_dir(self):
+        # The checkpoints are specific to the attacks in the battery, since several
+        # batteries may write to the same logdir.
+        names = [self._get_attack_name(name, atk, self._get_attack_eps(atk)) for name, atk in self.testing_adv_attacks]
+        return os.path.join(self.logdir, 'battery_checkpoints', get_hash(names)[:16])
+
+    def _load_battery_manifest(self):
+        # The manifest has one line per checkpointed (attack, batch) pair. A line that was
+        # cut short by an interruption is ignored, and its attack is recomputed. Also
+        # returns the size of the CSV of each attack after its last checkpointed batch.
+        progress = {}
+        csv_sizes = {}
+        if os.path.exists(self.battery_manifest_path):
+            with open(self.battery_manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    progress.setdefault(entry['batch'], {})[entry['attack']] = entry['labels_hash']
+                    if 'csv_size' in entry:
+                        csv_sizes[entry['attack']] = max(csv_sizes.get(entry['attack'], 0), entry['csv_size'])
+        return progress, csv_sizes
+
+    def _get_pred_csv_path(self, atk_name):
+        return os.path.join(self.per_attack_logdir, f'{atk_name}_label_and_preds_2.csv')
+
+    def _get_csv_size(self, atk_name):
+        path = self._get_pred_csv_path(atk_name)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _truncate_uncommitted_csv_rows(self, csv_sizes):
+        # The CSV rows of an (attack, batch) pair are written before the pair is added to
+        # the manifest. Rows written after the last checkpoint of an attack belong to a
+        # batch that is recomputed, so they are removed to avoid writing them twice.
+        for atk_name, size in csv_sizes.items():
+            path = self._get_pred_csv_path(atk_name)
+            if os.path.exists(path) and (os.path.getsize(path) > size):
+                with open(path, 'r+') as f:
+                    f.truncate(size)
+
+    def _get_battery_checkpoint_path(self, batch_idx, atk_name):
+        return os.path.join(self.battery_ckp_dir, f'batch_{batch_idx:06d}_{get_hash([atk_name])[:16]}.pkl')
+
+    def _load_battery_checkpoint(self, batch_idx, labels):
+        # Returns the results of the attacks that have been completed on the batch. The
+        # labels are compared with the checkpointed ones to catch changes in the order of
+        # the test set.
+        entries = self.battery_progress.get(batch_idx, {})
+        labels_hash = get_hash(labels)
+        completed = {k: load_pickle(self._get_battery_checkpoint_path(batch_idx, k)) for k, h in entries.items() if h == labels_hash}
+        if len(completed) < len(entries):
+            print(f'labels of batch {batch_idx} do not match the checkpoint, recomputing {len(entries) - len(completed)} attacks')
+        return completed
+
+    def _save_battery_checkpoint(self, batch_idx, labels, atk_name, result):
+        # The result is written before it is added to the manifest, and is replaced
+        # atomically, so the manifest never lists results that are not on disk. It must
+        # be called after the CSV rows of the result have been written.
+        path = self._get_battery_checkpoint_path(batch_idx, atk_name)
+        write_pickle(result, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        labels_hash = get_hash(labels)
+        with open(self.battery_manifest_path, 'a') as f:
+            f.write(json.dumps({'batch': batch_idx, 'attack': atk_name, 'labels_hash': labels_hash,
+                                'csv_size': self._get_csv_size(atk_name)}) + '\n')
+        self.battery_progress.setdefault(batch_idx, {})[atk_name] = labels_hash
+
+    def _get_attack_eps(self, atk):
+        if isinstance(atk, FoolboxCWL2AttackWrapper):
+            eps = atk.attack.confidence
+        elif isinstance(atk, FoolboxAttackWrapper):
+            eps = atk.run_kwargs.get('epsilons', [float('inf')])[0]
+        elif isinstance(atk, AutoAttackkWrapper):
+            eps = atk.attack.epsilon
+        # elif isinstance(atk, torchattacks.attack.Attack):
+        elif hasattr(atk, 'eps'):
+            eps = atk.eps
+        else:
+            raise NotImplementedError(f'{type(atk)} is not supported')
+        return eps
+
+    def _get_attack_name(self, name, atk, eps):
+        return f"{atk.__class__.__name__ if name is None else name}-{eps}"
+
+    def get_warm_start_stats(self):
+        # success rates of the warm-started runs and of the random restarts of the attacks
+        # that were warm-started
+        stats = {}
+        for name, atk in self.testing_adv_attacks:
+            if isinstance(atk, WarmStartMixin) and (atk.warm_start_stats['attacked'] > 0):
+                s = dict(atk.warm_start_stats)
+                s['warm_start_success_rate'] = s['warm_start_success'] / s['attacked']
+                s['cold_restart_success_rate'] = s['cold_restart_success'] / s['attacked']
+                stats[self._get_attack_name(name, atk, self._get_attack_eps(atk))] = s
+        return stats
+
+    def get_attack_cascade_stats(self):
+        # stage_robust_acc is the fraction of the samples attacked by a stage that it did not
+        # break, cumulative_robust_acc is the robust accuracy after the stage.
+        stats = {}
+        for k, s in self.attack_cascade_stats.items():
+            s = dict(s)
+            s['stage_robust_acc'] = 1 - s['num_broken'] / max(s['num_attacked'], 1)
+            s['cumulative_robust_acc'] = s['num_robust'] / max(s['num_samples'], 1)
+            stats[k] = s
+        return stats
+
+    def _update_attack_cascade_stats(self, atk_name, prev_broken, broken, t):
+        s = self.attack_cascade_stats.setdefault(atk_name, {'num_samples': 0, 'num_attacked': 0, 'num_broken': 0, 'num_robust': 0, 'time': 0.})
+        s['num_samples'] += len(broken)
+        s['num_attacked'] += int((~prev_broken).sum())
+        s['num_broken'] += int((broken & ~prev_broken).sum())
+        s['num_robust'] += int((~broken).sum())
+        s['time'] += t
+
+    def _get_attack_norm(self, atk):
+        # Returns None if the norm of the attack is unknown
+        if isinstance(atk, AutoAttackkWrapper):
+            return atk.attack.norm
+        if isinstance(atk, FoolboxAttackWrapper):
+            # foolbox attacks have an LpDistance
+            p = getattr(getattr(atk.attack, 'distance', None), 'p', None)
+            return {np.inf: 'Linf', 2: 'L2', 1: 'L1'}.get(p)
+        if isinstance(atk, torchattacks.attack.Attack) and not hasattr(atk, 'norm'):
+            # torchattacks PGD, FGSM etc. do not have a norm attribute. Attacks that are
+            # not known to be bounded in Linf or L2 (DeepFool, EADL1, OnePixel, etc.) have
+            # no norm.
+            for norm, names in _TORCHATTACKS_NORMS.items():
+                if isinstance(atk, tuple(getattr(torchattacks, n) for n in names if hasattr(torchattacks, n))):
+                    return norm
+            return None
+        return getattr(atk, 'norm', None)
+
+    def _get_attack_family(self, name, atk, eps):
+        # Attacks in the same family differ only in epsilon, so an adversarial example found
+        # with a smaller epsilon is also valid for a larger one. This does not hold for
+        # targeted attacks, for CW-L2, whose "epsilon" is the confidence, or for attacks
+        # whose norm is unknown, which are not grouped with any other. In a cascade the
+        # family is made of the attacks with the same epsilon and norm. The epsilons of a
+        # family of StackedEpsilonAPGDAttack are run together, outside of a cascade.
+        adv_params = self.params.adversarial_params
+        stacked = isinstance(atk, StackedEpsilonAPGDAttack) and (not adv_params.attack_cascade)
+        if (adv_params.epsilon_ladder_pruning == 'off') and (not adv_params.attack_cascade) and (not stacked):
+            return None
+        if isinstance(atk, FoolboxCWL2AttackWrapper):
+            return None
+        if isinstance(atk, torchattacks.attack.Attack) and atk._targeted:
+            return None
+        norm = self._get_attack_norm(atk)
+        if norm is None:
+            return None
+        if adv_params.attack_cascade:
+            return ('cascade', eps, str(norm))
+        return (name, atk.__class__.__name__, str(norm))
+
+    def _get_attack_schedule(self):
+        # Returns (idx, name, atk, eps, family) tuples in the order in which the attacks should be
+        # run. Attacks of the same family are grouped at the position of the first one and
+        # sorted by epsilon, or kept in the given order in a cascade. The others are run in
+        # the given order.
+        schedule = []
+        first_idx = {}
+        cascade = self.params.adversarial_params.attack_cascade
+        for i, (name, atk) in enumerate(self.testing_adv_attacks):
+            eps = self._get_attack_eps(atk)
+            family = self._get_attack_family(name, atk, eps)
+            order = (first_idx.setdefault(family, i), 0 if cascade else eps) if family is not None else (i, 0)
+            schedule.append((order, i, (i, name, atk, eps, family)))
+        return [x for _, _, x in sorted(schedule, key=lambda x: x[:2])]
+
+    def _run_stacked_attack(self, batch, family):
+        # Runs the attack with all the epsilons of the family in a single batch, made of E
+        # copies of the batch, and returns a dict mapping each epsilon to the adversarial
+        # examples.
+        x = batch[0]
+        members = []
+        for name, atk in self.testing_adv_attacks:
+            eps = self._get_attack_eps(atk)
+            if self._get_attack_family(name, atk, eps) == family:
+                members.append((atk, eps))
+        adv = {eps: x for _, eps in members if eps <= 0}
+        epsilons = sorted(set(eps for _, eps in members if eps > 0))
+        if len(epsilons) > 0:
+            E = len(epsilons)
+            stacked_batch = tuple(b.repeat(E, *([1] * (b.dim() - 1))) for b in batch)
+            # the attack sees (b n) rows if the batch has several images per sample
+            rows_per_eps = x.shape[0] * x.shape[1] if x.dim() == 5 else x.shape[0]
+            atk = members[0][0]
+            atk.set_sample_epsilons(torch.tensor(epsilons).repeat_interleave(rows_per_eps))
+            with self._select_samples(torch.arange(x.shape[0]).repeat(E)):
+                adv_x = self._maybe_attack_batch(stacked_batch, atk)[0]
+            adv.update(zip(epsilons, adv_x.split(x.shape[0])))
+        return adv
+
+    @contextmanager
+    def _select_samples(self, idxs):
+        # The model is run on the samples of the batch at idxs (possibly repeated) within
+        # this context. Subclasses that keep per-sample state outside of the batch (e.g.
+        # fixation locations in the model params) must re-index it here.
+        yield
+
+    def _attack_subset(self, batch, adv_attack, x, idxs, x_init=None):
+        # attacks the samples in batch at idxs and writes the adversarial examples into x.
+        # Attacks that support it are warm-started from x_init.
+        if len(idxs) > 0:
+            sub_batch = tuple(b[idxs] for b in batch)
+            if isinstance(adv_attack, WarmStartMixin) and (x_init is not None):
+                x_init = x_init[idxs]
+                if x_init.dim() == 5:
+                    x_init = rearrange(x_init, 'b n c h w -> (b n) c h w')
+                adv_attack.set_warm_start(x_init)
+            with self._select_samples(idxs):
+                x[idxs] = self._maybe_attack_batch(sub_batch, adv_attack)[0]
+        return x
+
+    def _attack_along_epsilon_ladder(self, batch, atk, eps, prev_x, prev_logits, broken, prev_eps):
+        # Only the samples that were not broken at the previous epsilon of the family are
+        # attacked, the adversarial examples of the rest are reused. The attacked samples
+        # are warm-started from their adversarial examples at the previous epsilon.
+        mode = self.params.adversarial_params.epsilon_ladder_pruning
+        y = batch[1].detach().cpu()
+        device_broken = broken.to(batch[0].device)
+        x = batch[0].clone()
+        x[device_broken] = prev_x[device_broken]
+        # samples are not warm-started from the clean images or from the previous stage of
+        # a cascade, which has the same epsilon
+        x_init = prev_x if 0 < prev_eps < eps else None
+        unbroken_idxs = (~broken).nonzero().squeeze(1)
+        x = self._attack_subset(batch, atk if eps > 0 else None, x, unbroken_idxs, x_init)
+        num_attacked = len(unbroken_idxs)
+
+        adv_batch = (x, *batch[1:])
+        logits, loss = self._get_outputs_and_loss(*adv_batch)
+        logits = logits.detach().cpu()
+        if mode == 'exact':
+            preds = get_preds_from_logits(logits)
+            recovered_idxs = (broken & (preds == y)).nonzero().squeeze(1)
+            if len(recovered_idxs) > 0:
+                x = self._attack_subset(batch, atk if eps > 0 else None, x, recovered_idxs, x_init)
+                num_attacked += len(recovered_idxs)
+                adv_batch = (x, *batch[1:])
+                logits, loss = self._get_outputs_and_loss(*adv_batch)
+                logits = logits.detach().cpu()
+        else:
+            logits[broken] = prev_logits[broken]
+        if eps > 0:
+            self.epsilon_ladder_stats['attacked'] += num_attacked
+            self.epsilon_ladder_stats['pruned'] += len(y) - num_attacked
+        return adv_batch, logits, loss
+
     def test_step(self, batch, batch_idx):
         clean_x = batch[0].clone()
+        clean_y = batch[1].detach().cpu()
 
         test_pred = {}
         adv_x = {}
@@ -331,27 +633,48 @@ class MultiAttackEvaluationTrainer(AdversarialTrainer):
         test_logits = {}
         target_labels = {}
         test_atk_norm = {}
-        for name, atk in self.testing_adv_attacks:
-            if isinstance(atk, FoolboxCWL2AttackWrapper):
-                eps = atk.attack.confidence
-            elif isinstance(atk, FoolboxAttackWrapper):
-                eps = atk.run_kwargs.get('epsilons', [float('inf')])[0]
-            elif isinstance(atk, AutoAttackkWrapper):
-                eps = atk.attack.epsilon
-            # elif isinstance(atk, torchattacks.attack.Attack):
-            elif hasattr(atk, 'eps'):
-                eps = atk.eps
-            else:
-                raise NotImplementedError(f'{type(atk)} is not supported')
-            atk_name = f"{atk.__class__.__name__ if name is None else name}-{eps}"
+        atk_names = [None] * len(self.testing_adv_attacks)
+        # adversarial examples, logits and misclassified samples at the last epsilon of each
+        # attack family, if epsilon ladder pruning is enabled
+        ladder_state = {}
+        # adversarial examples for each epsilon of each family of stacked attacks
+        stacked_adv = {}
+        schedule = self._get_attack_schedule()
+        checkpoint = self.params.adversarial_params.checkpoint_battery
+        completed = self._load_battery_checkpoint(batch_idx, clean_y) if checkpoint else {}
+        family_atk_names = {}
+        for _, name, atk, eps, family in schedule:
+            family_atk_names.setdefault(family, set()).add(self._get_attack_name(name, atk, eps))
+        for atk_idx, name, atk, eps, family in schedule:
+            atk_name = self._get_attack_name(name, atk, eps)
+            # the attacks in a family depend on each other, so they are restored only if the
+            # whole family has been completed
+            if (atk_name in completed) and ((family is None) or family_atk_names[family].issubset(completed.keys())):
+                r = completed[atk_name]
+                test_pred[atk_name] = r['preds']
+                test_acc[atk_name] = r['acc']
+                test_logits[atk_name] = r['logits']
+                target_labels[atk_name] = r['target_labels']
+                test_atk_norm[atk_name] = r['atk_norms']
+                atk_names[atk_idx] = atk_name
+                continue
+            t0 = time()
             # if batch_idx < 1119:
             #     logits = torch.rand(batch[0].shape[0], 10).detach().cpu()
             #     x, y = batch
             #     loss = torch.rand(batch[0].shape[0])
             # else:
-            adv_batch = self._maybe_attack_batch(batch, atk if eps > 0 else None)
+            if isinstance(atk, StackedEpsilonAPGDAttack) and (family is not None) and (not self.params.adversarial_params.attack_cascade):
+                if family not in stacked_adv:
+                    stacked_adv[family] = self._run_stacked_attack(batch, family)
+                adv_batch = (stacked_adv[family][eps], *batch[1:])
+                logits, loss = self._get_outputs_and_loss(*adv_batch)
+            elif family in ladder_state:
+                adv_batch, logits, loss = self._attack_along_epsilon_ladder(batch, atk, eps, *ladder_state[family])
+            else:
+                adv_batch = self._maybe_attack_batch(batch, atk if eps > 0 else None)
+                logits, loss = self._get_outputs_and_loss(*adv_batch)
             x, y = adv_batch[0], adv_batch[1]
-            logits, loss = self._get_outputs_and_loss(*adv_batch)
             logits = logits.detach().cpu()
             
             y = y.detach().cpu()
@@ -372,9 +695,26 @@ class MultiAttackEvaluationTrainer(AdversarialTrainer):
             target_labels[atk_name] = y_tgt.detach().cpu().numpy().tolist()
             test_atk_norm[atk_name] = atk_norm.detach().cpu().numpy().tolist()
             # self.save_per_sample_results(atk_name, clean_x.detach().cpu().numpy(), adv_x[atk_name], y.numpy().tolist(), test_pred[atk_name])
-            save_pred_and_label_csv_2(self.per_attack_logdir, 'label_and_preds_2.csv', test_pred, y.numpy().tolist(), batch_idx)
+            if atk_name not in completed:
+                # the rows of the attacks in the checkpoint have already been written. The
+                # rows are written before the checkpoint, and are truncated on resume if
+                # the checkpoint was not saved.
+                save_pred_and_label_csv_2(self.per_attack_logdir, 'label_and_preds_2.csv', {atk_name: test_pred[atk_name]}, y.numpy().tolist(), batch_idx)
+            if family is not None:
+                if self.params.adversarial_params.attack_cascade:
+                    prev_broken = ladder_state[family][2] if family in ladder_state else torch.zeros_like(preds != y)
+                    self._update_attack_cascade_stats(atk_name, prev_broken, preds != y, time() - t0)
+                ladder_state[family] = (x.detach(), logits, preds != y, eps)
+            atk_names[atk_idx] = atk_name
+            if checkpoint:
+                completed[atk_name] = {'preds': test_pred[atk_name], 'acc': acc, 'logits': test_logits[atk_name],
+                                       'target_labels': target_labels[atk_name], 'atk_norms': test_atk_norm[atk_name]}
+                self._save_battery_checkpoint(batch_idx, clean_y, atk_name, completed[atk_name])
+        # restore the order of the attacks in the config
+        test_pred, test_acc, test_logits, target_labels, test_atk_norm = [{k: d[k] for k in atk_names if k in d}
+                                                                          for d in [test_pred, test_acc, test_logits, target_labels, test_atk_norm]]
         metrics = {f'test_acc_{k}':v for k,v in test_acc.items()}
-        return {'preds':test_pred, 'labels':y.numpy().tolist(), 'inputs': 0., 'target_labels':target_labels, 'logits': test_logits, 'atk_norms':test_atk_norm}, metrics
+        return {'preds':test_pred, 'labels':clean_y.numpy().tolist(), 'inputs': 0., 'target_labels':target_labels, 'logits': test_logits, 'atk_norms':test_atk_norm}, metrics
     
     def save_per_sample_results(self, atk_name, X, adv_X, Y, P):
         for x, adv_x, y, p in zip(X, adv_X, Y, P):
@@ -0,0 +1,159 @@
+'''
+Attacks that can be warm-started from the adversarial examples found with a smaller
+epsilon, e.g. by the epsilon ladder of MultiAttackEvaluationTrainer. The initial point is
+projected into the current epsilon ball. For APGD only the first restart is
+warm-started, and the remaining restarts are random restarts that are only run on the
+samples that the warm-started run did not fool. The number of samples fooled by the
+warm-started run and by the random restarts are counted separately in warm_start_stats.
+'''
+import sys
+import time
+import torch
+from torch import nn
+import torchattacks
+from torchattacks.attacks.apgd import APGD
+
+def project_to_ball(x_adv, x, eps, norm):
+    if norm == 'Linf':
+        x_adv = x + torch.clamp(x_adv - x, -eps, eps)
+    elif norm == 'L2':
+        delta = x_adv - x
+        delta_norm = torch.flatten(delta, 1).norm(2, 1).view(-1, *([1] * (x.dim() - 1)))
+        x_adv = x + delta * torch.clamp(eps / (delta_norm + 1e-12), max=1.)
+    else:
+        raise NotImplementedError(f'norm must be Linf or L2 but got {norm}')
+    return x_adv.clamp(0., 1.)
+
+class WarmStartMixin:
+    def _init_warm_start(self):
+        self.x_init = None
+        self.warm_start_stats = {'attacked': 0, 'warm_start_success': 0, 'cold_restart_success': 0}
+
+    def set_warm_start(self, x_init):
+        # x_init is used as the initial point of the next call and then discarded
+        self.x_init = x_init
+
+    def _pop_warm_start(self, x, norm):
+        x_init = self.x_init
+        self.x_init = None
+        if x_init is not None:
+            x_init = project_to_ball(x_init.to(x.device), x, self.eps, norm).detach()
+        return x_init
+
+class _InitialPointOverride:
+    # Wraps get_logits of an APGD attack. torchattacks draws the random initial point,
+    # copies it to x_best and x_best_adv and then calls get_logits on it. At that first
+    # call the three tensors are overwritten in-place with x_init, so that the loss of the
+    # initial point is measured at x_init and the step size reductions of the loop, which
+    # reset x_adv to x_best, return to x_init and not to the random point.
+    def __init__(self, get_logits, x_init) -> None:
+        self.get_logits = get_logits
+        self.x_init = x_init
+
+    def __call__(self, x_adv, *args, **kwargs):
+        if self.x_init is not None:
+            caller = sys._getframe(1).f_locals
+            if not all(isinstance(caller.get(k), torch.Tensor) for k in ['x_best', 'x_best_adv']):
+                raise RuntimeError('the APGD loop of this torchattacks version does not define x_best and x_best_adv')
+            with torch.no_grad():
+                for k in ['x_best', 'x_best_adv']:
+                    caller[k].copy_(self.x_init)
+            x_adv.data.copy_(self.x_init)
+            self.x_init = None
+        return self.get_logits(x_adv, *args, **kwargs)
+
+class WarmStartAPGDAttack(WarmStartMixin, APGD):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._init_warm_start()
+
+    def attack_single_run(self, x_in, y_in, x_init=None, eps=None):
+        # Runs the APGD loop of torchattacks. eps defaults to self.eps, and can be a tensor
+        # of shape (N, 1, 1, 1) containing the epsilon of each sample, since the loop only
+        # uses self.eps arithmetically. If x_init is given it replaces the random initial
+        # point of the loop.
+        self_eps = self.eps
+        if eps is not None:
+            self.eps = eps
+        if x_init is not None:
+            self.get_logits = _InitialPointOverride(self.get_logits, x_init)
+        try:
+            return super().attack_single_run(x_in, y_in)
+        finally:
+            self.eps = self_eps
+            self.__dict__.pop('get_logits', None)
+
+    def perturb(self, x_in, y_in, best_loss=False, cheap=True):
+        assert self.norm in ['Linf', 'L2']
+        x = x_in.clone() if len(x_in.shape) == 4 else x_in.clone().unsqueeze(0)
+        y = y_in.clone() if len(y_in.shape) == 1 else y_in.clone().unsqueeze(0)
+        x_init = self._pop_warm_start(x, self.norm)
+        if (x_init is None) or best_loss or (not cheap):
+            return super().perturb(x_in, y_in, best_loss=best_loss, cheap=cheap)
+
+        adv = x.clone()
+        with torch.no_grad():
+            acc = self.get_logits(x).max(1)[1] == y
+        if self.verbose:
+            print('-------------------------- running warm-started {}-attack with epsilon {:.4f} --------------------------'.format(self.norm, self.eps))
+            print('initial accuracy: {:.2%}'.format(acc.float().mean()))
+        startt = time.time()
+        torch.random.manual_seed(self.seed)
+        torch.cuda.random.manual_seed(self.seed)
+        self.warm_start_stats['attacked'] += int(acc.sum())
+        # the samples that the warm start already fools are not attacked
+        with torch.no_grad():
+            fooled = acc & (self.get_logits(x_init).max(1)[1] != y)
+        acc[fooled] = 0
+        adv[fooled] = x_init[fooled]
+        self.warm_start_stats['warm_start_success'] += int(fooled.sum())
+
+        for counter in range(self.n_restarts):
+            ind_to_fool = acc.nonzero().squeeze(1)
+            if ind_to_fool.numel() == 0:
+                break
+            x_to_fool, y_to_fool = x[ind_to_fool].clone(), y[ind_to_fool].clone()
+            # only the first restart starts from the warm start, the others are random
+            _, acc_curr, _, adv_curr = self.attack_single_run(x_to_fool, y_to_fool, x_init[ind_to_fool] if counter == 0 else None)
+            ind_curr = (acc_curr == 0).nonzero().squeeze(1)
+            acc[ind_to_fool[ind_curr]] = 0
+            adv[ind_to_fool[ind_curr]] = adv_curr[ind_curr].clone()
+            self.warm_start_stats['warm_start_success' if counter == 0 else 'cold_restart_success'] += len(ind_curr)
+            if self.verbose:
+                print('restart {} - robust accuracy: {:.2%} - cum. time: {:.1f} s'.format(
+                    counter, acc.float().mean(), time.time() - startt))
+
+        return acc, adv
+
+class WarmStartPGDAttack(WarmStartMixin, torchattacks.PGD):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._init_warm_start()
+
+    def forward(self, images, labels):
+        images = images.clone().detach().to(self.device)
+        labels = labels.clone().detach().to(self.device)
+        x_init = self._pop_warm_start(images, 'Linf')
+        if x_init is None:
+            return super().forward(images, labels)
+
+        loss = nn.CrossEntropyLoss()
+        adv_images = x_init
+        for _ in range(self.steps):
+            adv_images.requires_grad = True
+            outputs = self.get_logits(adv_images)
+            cost = loss(outputs, labels)
+            grad = torch.autograd.grad(cost, adv_images,
+                                       retain_graph=False, create_graph=False)[0]
+            adv_images = adv_images.detach() + self.alpha*grad.sign()
+            delta = torch.clamp(adv_images - images, min=-self.eps, max=self.eps)
+            adv_images = torch.clamp(images + delta, min=0, max=1).detach()
+
+        with torch.no_grad():
+            # PGD has no restarts, so every success is a warm start success. As for APGD,
+            # only the samples that are correctly classified on the clean input are counted.
+            acc = self.get_logits(images).max(1)[1] == labels
+            fooled = acc & (self.get_logits(adv_images).max(1)[1] != labels)
+        self.warm_start_stats['attacked'] += int(acc.sum())
+        self.warm_start_stats['warm_start_success'] += int(fooled.sum())
+        return adv_images
@@ -0,0 +1,44 @@
+import pytest
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+retina_preproc = pytest.importorskip('rblur.retina_preproc')
+retina_blur2 = pytest.importorskip('rblur.retina_blur2')
+
+LOC_MODES = ['center', 'const', 'random_uniform', 'five_fixations']
+
+def get_loc(loc_mode, size):
+    return (size//3, size-3) if loc_mode == 'const' else None
+
+def make_rblur(blur_engine, size, view_scale, loc_mode):
+    p = retina_preproc.RetinaBlurFilter.ModelParams(retina_preproc.RetinaBlurFilter, [3, size, size], cone_std=0.12, rod_std=0.09,
+                                                    max_rod_density=0.12, view_scale=view_scale, loc_mode=loc_mode,
+                                                    loc=get_loc(loc_mode, size), min_bincount=2, blur_engine=blur_engine)
+    return retina_preproc.RetinaBlurFilter(p)
+
+def make_rblur2(blur_engine, size, view_scale, loc_mode):
+    # the visual field is twice as large as the image
+    p = retina_blur2.RetinaBlurFilter.ModelParams(retina_blur2.RetinaBlurFilter, [3, 2*size, 2*size], cone_std=0.12, rod_std=0.09,
+                                                  max_rod_density=0.12, view_scale=view_scale, loc_mode=loc_mode,
+                                                  loc=get_loc(loc_mode, size), scale=4, blur_engine=blur_engine)
+    return retina_blur2.RetinaBlurFilter(p)
+
+def run(retina, x):
+    # the random locations and view scales are drawn in the same order by both engines
+    np.random.seed(0)
+    with torch.no_grad():
+        return retina(x)
+
+@pytest.mark.parametrize('make_retina', [make_rblur, make_rblur2])
+@pytest.mark.parametrize('size', [32, 33])
+@pytest.mark.parametrize('view_scale', [None, 'random_uniform'])
+@pytest.mark.parametrize('loc_mode', LOC_MODES)
+def test_vectorized_engine_matches_loop(make_retina, size, view_scale, loc_mode):
+    if (loc_mode == 'five_fixations') and (view_scale is not None):
+        # the loop engine draws a view scale per fixation, the vectorized one per batch
+        pytest.skip('the engines draw different view scales')
+    torch.manual_seed(0)
+    x = torch.rand(2, 3, size, size)
+    loop_out = run(make_retina('loop', size, view_scale, loc_mode), x)
+    vec_out = run(make_retina('vectorized', size, view_scale, loc_mode), x)
+    assert loop_out.shape == vec_out.shape
+    assert torch.allclose(loop_out, vec_out, atol=1e-5)
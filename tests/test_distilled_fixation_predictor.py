@@ -0,0 +1,17 @@
+import pytest
+torch = pytest.importorskip('torch')
+models = pytest.importorskip('rblur.fixation_prediction.models')
+
+def test_distillation_loss_backward():
+    # the image is not rescaled when its size is min_image_dim, so the center bias mask
+    # is added directly to the log-softmax output of predict_fixation_map
+    p = models.DistilledFixationPredictor.ModelParams(models.DistilledFixationPredictor, arch='unet', num_filters=[4, 8, 8, 8, 8], min_image_dim=64)
+    model = models.DistilledFixationPredictor(p).train()
+    x = torch.rand(2, 3, 64, 64)
+    target = torch.log_softmax(torch.randn(2, 64*64), 1).reshape(2, 1, 64, 64)
+    fmap, loss = model.compute_loss(x, target)
+    assert fmap.shape == (2, 1, 64, 64)
+    assert torch.isfinite(loss)
+    loss.backward()
+    grads = [p.grad for p in model.fixation_predictor.parameters() if p.requires_grad]
+    assert all(g is not None for g in grads)
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+from contextlib import contextmanager
+import pytest
+torch = pytest.importorskip('torch')
+torchattacks = pytest.importorskip('torchattacks')
+trainers = pytest.importorskip('rblur.trainers')
+
+class PositionalBiasModel(torch.nn.Module):
+    # deterministic model with per-sample state that is looked up by the position of the
+    # sample in the batch, like the fixation locations of the precomputed-fixation battery
+    def __init__(self, n, d, nclasses) -> None:
+        super().__init__()
+        self.linear = torch.nn.Linear(d, nclasses)
+        self.bias = torch.randn(n, nclasses) * 3
+
+    def forward(self, x):
+        return self.linear(torch.flatten(x, 1)) + self.bias[:len(x)]
+
+class Trainer(trainers.MultiAttackEvaluationTrainer):
+    def __init__(self, model, mode) -> None:
+        self.model = model
+        self.params = SimpleNamespace(adversarial_params=trainers.AdversarialParams(epsilon_ladder_pruning=mode))
+        self.epsilon_ladder_stats = {'attacked': 0, 'pruned': 0}
+
+    def _get_outputs_and_loss(self, x, y):
+        logits = self.model(x)
+        return logits, torch.nn.functional.cross_entropy(logits, y, reduction='none')
+
+    @contextmanager
+    def _select_samples(self, idxs):
+        bias = self.model.bias
+        self.model.bias = bias[idxs]
+        try:
+            yield
+        finally:
+            self.model.bias = bias
+
+@pytest.mark.parametrize('mode', ['monotone', 'exact'])
+def test_ladder_matches_full_batch(mode):
+    torch.manual_seed(0)
+    n, nclasses = 32, 5
+    model = PositionalBiasModel(n, 3*4*4, nclasses).eval()
+    trainer = Trainer(model, mode)
+    x = torch.rand(n, 3, 4, 4)
+    y = torch.randint(0, nclasses, (n,))
+    atk1, atk2 = torchattacks.FGSM(model, eps=0.02), torchattacks.FGSM(model, eps=0.1)
+
+    x1 = atk1(x, y)
+    logits1 = model(x1).detach()
+    broken = logits1.argmax(1) != y
+    assert 0 < broken.sum() < n
+    (x2, _), logits2, _ = trainer._attack_along_epsilon_ladder((x, y), atk2, 0.1, x1, logits1, broken, 0.02)
+
+    full_x2 = atk2(x, y)
+    full_logits2 = model(full_x2).detach()
+    assert torch.allclose(x2[~broken], full_x2[~broken])
+    assert torch.allclose(logits2[~broken], full_logits2[~broken], atol=1e-5)
+    assert torch.equal(x2[broken], x1[broken])
+    assert trainer.epsilon_ladder_stats['attacked'] >= int((~broken).sum())
@@ -0,0 +1,40 @@
+import pytest
+torch = pytest.importorskip('torch')
+retina_preproc = pytest.importorskip('rblur.retina_preproc')
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_isobox_blur_composite_gradcheck(separable):
+    # random images, kernels and weights in double precision
+    torch.manual_seed(0)
+    b, c, n = 2, 2, 16
+    sizes = [7, 5, 5]
+    width = max(sizes)
+    kernels = [retina_preproc.gaussian_fn(ks, std=ks/4) if separable else retina_preproc.gkern(ks, ks/4) for ks in sizes]
+    bank = torch.stack([retina_preproc._pad_kernel(k, width, separable) for k in kernels], 0).double()
+    weights = torch.rand(b, len(sizes), 1, n, n, dtype=torch.double)
+    img = torch.rand(b, c, n, n, dtype=torch.double, requires_grad=True)
+    fn = lambda x: retina_preproc.IsoboxBlurComposite.apply(x, bank, weights, tuple(sizes), separable)
+    assert torch.autograd.gradcheck(fn, (img,))
+
+    grad_out = torch.rand(b, c, n, n, dtype=torch.double)
+    grad, = torch.autograd.grad(fn(img), img, grad_out)
+    ref_grad, = torch.autograd.grad((retina_preproc._blur_isobox_levels(img, bank, sizes, separable) * weights).sum(1), img, grad_out)
+    assert torch.allclose(grad, ref_grad)
+
+def make_retina_blur(blur_engine, **kwargs):
+    p = retina_preproc.RetinaBlurFilter.ModelParams(retina_preproc.RetinaBlurFilter, [3, 32, 32], cone_std=0.12, rod_std=0.09,
+                                                    max_rod_density=0.12, loc_mode='const', loc=(10, 20), min_bincount=2,
+                                                    blur_engine=blur_engine, **kwargs)
+    return retina_preproc.RetinaBlurFilter(p)
+
+@pytest.mark.parametrize('use_1d_gkernels', [False, True])
+def test_memory_efficient_grad_matches_loop_engine(use_1d_gkernels):
+    torch.manual_seed(0)
+    x = torch.rand(2, 3, 32, 32)
+    grad_out = torch.rand(2, 3, 32, 32)
+    grads = []
+    for engine, mem_eff in [('loop', False), ('vectorized', True)]:
+        rblur = make_retina_blur(engine, use_1d_gkernels=use_1d_gkernels, memory_efficient_grad=mem_eff)
+        x_ = x.clone().requires_grad_(True)
+        grads.append(torch.autograd.grad(rblur(x_), x_, grad_out)[0])
+    assert torch.allclose(grads[0], grads[1], atol=1e-5)
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+import pytest
+torch = pytest.importorskip('torch')
+rblur_models = pytest.importorskip('rblur.models')
+fixation_aware_attack = pytest.importorskip('rblur.fixation_prediction.fixation_aware_attack')
+
+class ViewEnsembleModel(torch.nn.Module):
+    # classifies each foveated view and averages the logits of the L consecutive views of
+    # every image, like the classifiers with a LogitAverageEnsembler
+    def __init__(self, d, nclasses, L) -> None:
+        super().__init__()
+        self.linear = torch.nn.Linear(d, nclasses)
+        self.ensembler = rblur_models.LogitAverageEnsembler(rblur_models.LogitAverageEnsembler.ModelParams(rblur_models.LogitAverageEnsembler, n=L))
+
+    def forward(self, x):
+        return self.ensembler(self.linear(torch.flatten(x, 1)))
+
+class ShiftRetina:
+    # foveates every image by adding its fixation location, so that views at different
+    # locations are distinguishable
+    def __init__(self) -> None:
+        self.params = SimpleNamespace(loc_mode='const', disable=False)
+
+    def apply_retina_at_locs(self, x, locs):
+        return x + locs.sum(1).to(x.dtype).view(-1, 1, 1, 1)
+
+@pytest.mark.parametrize('L', [1, 3])
+def test_scanpath_selection_loss_uses_ensembled_logits(L):
+    torch.manual_seed(0)
+    n, nclasses = 4, 5
+    model = ViewEnsembleModel(3*8*8, nclasses, L)
+    retina = ShiftRetina()
+    atk = SimpleNamespace(model=model, rfmodule=retina, retina=retina)
+    x = torch.rand(n, 3, 8, 8)
+    y = torch.randint(0, nclasses, (n,))
+    scanpaths = torch.randint(0, 8, (n, L, 2))
+
+    loss, logits = fixation_aware_attack.FixationAwareAPGDAttack._compute_scanpath_selection_loss(atk, x, scanpaths, y)
+
+    views = torch.stack([retina.apply_retina_at_locs(x, scanpaths[:, i]) for i in range(L)], 1)
+    expected = model.linear(torch.flatten(views, 2)).mean(1)
+    assert logits.shape == (n, nclasses)
+    assert torch.allclose(logits, expected, atol=1e-5)
+    assert torch.allclose(loss, torch.nn.functional.cross_entropy(expected, y, reduction='none'), atol=1e-5)
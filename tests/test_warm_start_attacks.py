@@ -0,0 +1,27 @@
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchattacks')
+warm_start_attacks = pytest.importorskip('rblur.warm_start_attacks')
+
+class ConstantModel(torch.nn.Module):
+    # the loss never improves, so APGD keeps returning its initial point
+    def __init__(self, nclasses) -> None:
+        super().__init__()
+        self.w = torch.nn.Parameter(torch.zeros(1))
+        self.nclasses = nclasses
+
+    def forward(self, x):
+        return torch.zeros(x.shape[0], self.nclasses) + self.w * torch.flatten(x, 1).sum(1, keepdim=True)
+
+@pytest.mark.parametrize('norm', ['Linf', 'L2'])
+def test_apgd_starts_and_restarts_from_warm_start(norm):
+    torch.manual_seed(0)
+    eps = 0.1
+    atk = warm_start_attacks.WarmStartAPGDAttack(ConstantModel(3), norm=norm, eps=eps, steps=10, n_restarts=1)
+    x = torch.rand(4, 3, 8, 8)
+    y = torch.zeros(4, dtype=torch.long)
+    x_init = warm_start_attacks.project_to_ball(x + 0.05*torch.randn_like(x), x, eps, norm)
+    x_best, _, _, x_best_adv = atk.attack_single_run(x, y, x_init)
+    assert torch.allclose(x_best, x_init)
+    assert torch.allclose(x_best_adv, x_init)
+    assert 'get_logits' not in atk.__dict__